@@ -45,11 +45,17 @@ for k,v in pairs(typ) do
         if redis.call('srem', dval, sm..":"..deltyp) == 1 then
             dval = "TABLE:"..deltbl
             redis.call('srem', dval, deluve..":"..sm..":"..deltyp)
+            if redis.call('scard', dval) == 0 then
+                redis.call('srem', "TABLES", deltbl)
+            end
         else
             dval = "ALARM_ORIGINS:"..deluve
             redis.call('srem', dval, sm..":"..deltyp)
             dval = "ALARM_TABLE:"..deltbl
             redis.call('srem', dval, deluve..":"..sm..":"..deltyp)
+            if redis.call('scard', dval) == 0 then
+                redis.call('srem', "ALARM_TABLES", deltbl)
+            end
         end
 
         iter = iter + 2
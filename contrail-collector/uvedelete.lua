@@ -61,6 +61,13 @@ sub_del(_values)
 redis.call('zrem', _uves, key)
 redis.call('srem', _origins, sm..":"..typ)
 redis.call('srem', _table, key..":"..sm..":"..typ)
+if redis.call('scard', _table) == 0 then
+    if is_alarm == 0 then
+        redis.call('srem', "TABLES", string.sub(_table, 7))
+    else
+        redis.call('srem', "ALARM_TABLES", string.sub(_table, 13))
+    end
+end
 
 local lttt = redis.call('exists', _values)
 if lttt == 1 then
@@ -38,6 +38,12 @@ redis.call('expire', "NGENERATORS", 40)
 if is_alarm == 0 then
     redis.call('sadd',"PART2KEY:"..part, sm..":"..typ..":"..key)
     redis.call('hset',"KEY2PART:"..sm..":"..typ, key, part)
+    -- TABLES is the index of the TABLE:<table> sets, so that the
+    -- tables can be listed without scanning the keyspace
+    redis.call('sadd',"TABLES", string.sub(_table, 7))
+else
+    -- ALARM_TABLES is the index of the tables with alarms
+    redis.call('sadd',"ALARM_TABLES", string.sub(_table, 13))
 end
 
 redis.call('sadd',_types,typ)
@@ -19,6 +19,7 @@ import traceback
 import signal
 import random
 import hashlib
+import heapq
 import ConfigParser
 import logging
 try:
@@ -32,8 +33,7 @@ from pysandesh.sandesh_logger import SandeshLogger
 from pysandesh.gen_py.sandesh_alarm.ttypes import SandeshAlarmAckResponseCode
 import sandesh.viz.constants as viz_constants
 from sandesh.alarmgen_ctrl.sandesh_alarm_base.ttypes import AlarmTrace, \
-    UVEAlarms, UVEAlarmInfo, UVEAlarmConfig, AlarmOperand2, AlarmCondition, \
-    AlarmMatch, AlarmConditionMatch, AlarmAndList, AlarmRules
+    UVEAlarms, UVEAlarmInfo, UVEAlarmConfig, AlarmRules
 from sandesh.analytics.ttypes import *
 from sandesh.nodeinfo.ttypes import NodeStatusUVE, NodeStatus
 from sandesh.nodeinfo.cpuinfo.ttypes import *
@@ -44,8 +44,10 @@ from sandesh_common.vns.constants import ModuleNames, CategoryNames,\
      INSTANCE_ID_DEFAULT, ALARM_GENERATOR_SERVICE_NAME, \
      COLLECTOR_DISCOVERY_SERVICE_NAME
 from alarmgen_cfg import CfgParser
+from alarmgen_rules import AlarmRuleSet
 from uveserver import UVEServer
-from partition_handler import PartitionHandler, UveStreamProc
+from partition_handler import PartitionHandler, UveStreamProc, \
+    PartCheckpoint
 from alarmgen_config_handler import AlarmGenConfigHandler, _INVERSE_UVE_MAP
 from sandesh.alarmgen_ctrl.ttypes import PartitionOwnershipReq, \
     PartitionOwnershipResp, PartitionStatusReq, UVECollInfo, UVEGenInfo, \
@@ -56,6 +58,8 @@ from sandesh.alarmgen_ctrl.ttypes import PartitionOwnershipReq, \
     UVETableInfoReq, UVETableInfoResp, UVEObjectInfo, UVEStructInfo, \
     UVETablePerfReq, UVETablePerfResp, UVETableInfo, \
     UVEAlarmStateMachineInfo, UVEAlarmState, UVEAlarmOperState,\
+    AlarmTimerStatsReq, AlarmTimerStatsResp, PartitionConsumeStatsReq, \
+    PartitionConsumeStatsResp, PartitionConsumeStats, HistogramBucket, \
     AlarmStateChangeTrace, UVEQTrace, AlarmConfig, AlarmConfigRequest, \
     AlarmConfigResponse, AlarmgenUVEStats, AlarmgenAlarmStats, \
     AlarmgenPartitionTrace, AlarmExceptionTrace
@@ -71,6 +75,62 @@ from kafka import common, KafkaProducer
 
 OutputRow = namedtuple("OutputRow",["key","typ","val"])
 
+# Server side version of Controller.send_agg_uve, which updates the
+# aggregated UVEs of an alarmgen partition in a single round-trip.
+# ARGV: inst, part, acq_time, change list to publish, followed by
+# (op, key, type, value) for every row, where op is
+#   D - remove the UVE
+#   R - remove the struct "type" of the UVE
+#   U - set the struct "type" of the UVE to "value"
+# Returns the acq_time state of the partition (new/stale/same), the
+# previous acq_time and the keys that had no structs left after removal
+_AGG_UVE_SCRIPT = """
+local inst, part, acq_time = ARGV[1], ARGV[2], ARGV[3]
+local parts = 'AGPARTS:' .. inst
+local ckpts = 'AGPARTCKPT:' .. inst
+local partkeys = 'AGPARTKEYS:' .. inst .. ':' .. part
+local prefix = 'AGPARTVALUES:' .. inst .. ':' .. part .. ':'
+local state = 'same'
+local old_acq_time = redis.call('HGET', parts, part)
+if not old_acq_time then
+    state = 'new'
+    old_acq_time = ''
+    redis.call('HDEL', ckpts, part)
+    redis.call('HSET', parts, part, acq_time)
+elseif tonumber(old_acq_time) ~= tonumber(acq_time) then
+    state = 'stale'
+    for _, key in ipairs(redis.call('SMEMBERS', partkeys)) do
+        redis.call('DEL', prefix .. key)
+    end
+    redis.call('DEL', partkeys)
+    redis.call('HDEL', ckpts, part)
+    redis.call('HSET', parts, part, acq_time)
+end
+local check_keys = {}
+for i = 5, #ARGV, 4 do
+    local op, key = ARGV[i], ARGV[i + 1]
+    if op == 'D' then
+        redis.call('SREM', partkeys, key)
+        redis.call('DEL', prefix .. key)
+    elseif op == 'R' then
+        redis.call('HDEL', prefix .. key, ARGV[i + 2])
+        check_keys[key] = true
+    else
+        redis.call('SADD', partkeys, key)
+        redis.call('HSET', prefix .. key, ARGV[i + 2], ARGV[i + 3])
+    end
+end
+local empty_keys = {}
+for key in pairs(check_keys) do
+    if redis.call('EXISTS', prefix .. key) == 0 then
+        redis.call('SREM', partkeys, key)
+        table.insert(empty_keys, key)
+    end
+end
+redis.call('PUBLISH', 'AGPARTPUB:' .. inst .. ':' .. part, ARGV[4])
+return {state, old_acq_time, empty_keys}
+"""
+
 class AGTabStats(object):
     """ This class is used to store per-UVE-table information
         about the time taken and number of instances when
@@ -225,8 +285,14 @@ class AlarmProcessor(object):
             if hasattr(alarm, '__call__'):
                 or_list = alarm.__call__(uv, local_uve)
             else:
-                or_list = self._evaluate_uve_for_alarms(
-                    alarm.config(), uv, local_uve)
+                # The config handler compiles the rules when the alarm
+                # config is updated. Alarms that it did not compile are
+                # compiled here, which raises for invalid rules.
+                rule_set = alarm.rule_set()
+                if rule_set is None:
+                    rule_set = AlarmRuleSet(alarm.config())
+                    alarm.set_rule_set(rule_set)
+                or_list = rule_set.evaluate(uv, local_uve)
             self._logger.debug("Alarm[%s] %s: %s" %
                 (uv, alarm_fqname, str(or_list)))
             if or_list:
@@ -247,285 +313,77 @@ class AlarmProcessor(object):
                     description=alarm.description(), ack=False)
     # end process_alarms
 
-    def _get_uve_attribute(self, tuve, attr_list, uve_path=None):
-        if uve_path is None:
-            uve_path = []
-        if tuve is None or not attr_list:
-            return {'value': tuve, 'uve_path': uve_path,
-                    'status': False if len(attr_list) else True}
-        if isinstance(tuve, dict):
-            if attr_list[0] in ('*', '__value'):
-                return [self._get_uve_attribute(val, attr_list[1:],
-                        uve_path+[{key: val}]) \
-                        for key, val in tuve.iteritems()]
-            elif attr_list[0] == '__key':
-                return [self._get_uve_attribute(key, attr_list[1:],
-                        uve_path+[{key: val}]) \
-                        for key, val in tuve.iteritems()]
-            else:
-                tuve = tuve.get(attr_list[0])
-                uve_path.append({attr_list[0]: tuve})
-                return self._get_uve_attribute(tuve, attr_list[1:], uve_path)
-        elif isinstance(tuve, list):
-            return [self._get_uve_attribute(elem, attr_list,
-                    uve_path+[{'__list_element__': elem}]) \
-                    for elem in tuve]
-        elif isinstance(tuve, str):
-            try:
-                json_elem = json.loads(tuve)
-            except ValueError:
-                return {'value': None, 'uve_path': uve_path, 'status': False}
-            else:
-                return self._get_uve_attribute(json_elem, attr_list, uve_path)
-    # end _get_uve_attribute
-
-    def _get_operand_value(self, uve, operand):
-        attr_list = operand.split('.')
-        return self._get_uve_attribute(uve, attr_list)
-    # end _get_operand_value
+    def _evaluate_uve_for_alarms(self, alarm_cfg, uve_key, uve):
+        return AlarmRuleSet(alarm_cfg).evaluate(uve_key, uve)
+    # end _evaluate_uve_for_alarms
 
-    def _get_json_value(self, val):
-        try:
-            tval = json.loads(val)
-        except (ValueError, TypeError):
-            return json.dumps(val)
-        else:
-            return val
-    # end _get_json_value
-
-    def _get_attribute_from_uve_path(self, attr, uve_path):
-        attr_list = attr.split('.')
-        ai = ui = 0
-        pnode = uve_path[ui]
-        while (ai < len(attr_list) and ui < len(uve_path)):
-            if attr_list[ai] == '__key':
-                return uve_path[ui].iterkeys().next()
-            elif attr_list[ai] == '__value':
-                return uve_path[ui].itervalues().next()
-            if attr_list[ai] != '*' and attr_list[ai] not in uve_path[ui]:
-                break
-            pnode = uve_path[ui]
-            ui += 1
-            ai += 1
-            if len(uve_path) > ui and '__list_element__' in uve_path[ui]:
-                pnode = uve_path[ui]
-                ui += 1
-        if not ui:
-            return None
-        val = pnode.itervalues().next()
-        for a in attr_list[ai:]:
-            if val is None or not isinstance(val, dict):
-                return None
-            val = val.get(a)
-        return val
-    # end _get_attribute_from_uve_path
-
-    def _get_json_variables(self, uve, exp, operand1_val,
-                            operand2_val, is_operand2_json_val):
-        json_vars = {}
-        for var in exp.variables:
-            p1 = os.path.commonprefix([exp.operand1.split('.'),
-                var.split('.')])
-            if not is_operand2_json_val:
-                p2 = os.path.commonprefix(
-                    [exp.operand2.uve_attribute.split('.'), var.split('.')])
-                if p1 > p2:
-                    var_val = self._get_attribute_from_uve_path(var,
-                        operand1_val['uve_path'])
-                else:
-                    var_val = self._get_attribute_from_uve_path(var,
-                        operand2_val['uve_path'])
-            else:
-                var_val = self._get_attribute_from_uve_path(var,
-                    operand1_val['uve_path'])
-            json_vars[var] = self._get_json_value(var_val)
-        return json_vars
-    # end _get_json_variables
 
-    def _compare_operand_vals(self, val1, val2, operation):
-        try:
-            val1 = json.loads(val1)
-        except (TypeError, ValueError):
-            pass
-        try:
-            val2 = json.loads(val2)
-        except (TypeError, ValueError):
-            pass
-        if operation == '==':
-            return val1 == val2
-        elif operation == '!=':
-            return val1 != val2
-        elif operation == '<':
-            return val1 < val2
-        elif operation == '<=':
-            return val1 <= val2
-        elif operation == '>':
-            return val1 > val2
-        elif operation == '>=':
-            return val1 >= val2
-        elif operation == 'in':
-            if not isinstance(val2, list):
-                return False
-            return val1 in val2
-        elif operation == 'not in':
-            if not isinstance(val2, list):
-                return True
-            return val1 not in val2
-        elif operation == 'range':
-            return val2[0] <= val1 <= val2[1]
-        elif operation == 'size==':
-            if not isinstance(val1, list):
-                return False
-            return len(val1) == val2
-        elif operation == 'size!=':
-            if not isinstance(val1, list):
-                return True
-            return len(val1) != val2
-    # end _compare_operand_vals
-
-    def _get_alarm_match(self, uve, exp, operand1_val, operand2_val,
-                         is_operand2_json_val):
-        json_vars = self._get_json_variables(uve, exp, operand1_val,
-            operand2_val, is_operand2_json_val)
-        json_operand1_val = self._get_json_value(operand1_val['value'])
-        if not is_operand2_json_val:
-            json_operand2_val = self._get_json_value(operand2_val['value'])
-        else:
-            json_operand2_val = None
-        return AlarmMatch(json_operand1_value=json_operand1_val,
-            json_operand2_value=json_operand2_val, json_variables=json_vars)
-    # end _get_alarm_match
-
-    def _get_alarm_condition_match(self, uve, exp, operand1_val, operand2_val,
-                                   is_operand2_json_val, match_list=None):
-        if not match_list:
-            match_list = [self._get_alarm_match(uve, exp, operand1_val,
-                operand2_val, is_operand2_json_val)]
-        return AlarmConditionMatch(
-            condition=AlarmCondition(operation=exp.operation,
-                operand1=exp.operand1, operand2=AlarmOperand2(
-                    uve_attribute=exp.operand2.uve_attribute,
-                    json_value=exp.operand2.json_value),
-                variables=exp.variables),
-            match=match_list)
-    # end _get_alarm_condition_match
-
-    def _get_uve_parent_fqname(self, table, uve_name, uve):
-        try:
-            # virtual-machine UVE key doesn't have project name in the prefix.
-            # Hence extract the project name from the interface_list.
-            if table == viz_constants.VM_TABLE:
-                return uve['UveVirtualMachineAgent']['interface_list'][0].\
-                    rsplit(':', 1)[0]
-            else:
-                return uve_name.rsplit(':', 1)[0]
-        except (KeyError, IndexError):
-            return None
-    # end _get_uve_parent_fqname
+class AlarmTimerQueue(object):
+    """ Pending soak/delete timers of the alarm state machines,
+        ordered by expiry time in a heap.
+        There is at most one timer per (tab, uv, nm); cancelling a timer
+        only marks its heap entry, which is dropped when it reaches the
+        top of the heap.
+    """
+    def __init__(self):
+        self._heap = []
+        self._timers = {}
+        self._stale = 0
+        self.fired = 0
+        self.lag = 0
+        self.max_lag = 0
+        self.last_run = None
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def keys(self):
+        return self._timers.keys()
+
+    def add(self, key, expiry):
+        self.cancel(key)
+        entry = [expiry, key, True]
+        self._timers[key] = entry
+        heapq.heappush(self._heap, entry)
+
+    def cancel(self, key):
+        entry = self._timers.pop(key, None)
+        if entry is None:
+            return
+        entry[2] = False
+        self._stale += 1
+        # Do not let the cancelled entries pile up in the heap
+        if self._stale > 64 and self._stale > len(self._timers):
+            self._heap = [ent for ent in self._heap if ent[2]]
+            heapq.heapify(self._heap)
+            self._stale = 0
+
+    def expired(self, curr_time):
+        """ Yields (expiry, key) of the timers that expire at or before
+            curr_time in the order of expiry. Timers added while iterating
+            are also yielded if they expire by curr_time
+        """
+        self.lag = 0
+        while self._heap and self._heap[0][0] <= curr_time:
+            expiry, key, valid = heapq.heappop(self._heap)
+            if not valid:
+                self._stale -= 1
+                continue
+            del self._timers[key]
+            self.fired += 1
+            self.lag = max(self.lag, curr_time - expiry)
+            yield expiry, key
+        self.max_lag = max(self.max_lag, self.lag)
+        self.last_run = curr_time
 
-    def _evaluate_uve_for_alarms(self, alarm_cfg, uve_key, uve):
-        table, uve_name = uve_key.split(':', 1)
-        # For alarms configured under project, the parent fq_name of the uve
-        # should match with that of the alarm config
-        if alarm_cfg.parent_type == 'project':
-            uve_parent_fqname = self._get_uve_parent_fqname(table,
-                uve_name, uve)
-            if uve_parent_fqname != alarm_cfg.get_parent_fq_name_str():
-                return None
-        or_list = []
-        for cfg_and_list in alarm_cfg.alarm_rules.or_list:
-            and_list = []
-            and_list_fail = False
-            for exp in cfg_and_list.and_list:
-                operand1_val = self._get_operand_value(uve, exp.operand1)
-                if isinstance(operand1_val, dict) and \
-                    operand1_val['status'] is False:
-                    and_list_fail = True
-                    break
-                if exp.operand2.json_value is not None:
-                    operand2_val = json.loads(exp.operand2.json_value)
-                    is_operand2_json_val = True
-                else:
-                    operand2_val = self._get_operand_value(uve,
-                        exp.operand2.uve_attribute)
-                    if isinstance(operand2_val, dict) and \
-                        operand2_val['status'] is False:
-                        and_list_fail = True
-                        break
-                    is_operand2_json_val = False
-                if isinstance(operand1_val, list) or \
-                    (is_operand2_json_val is False and \
-                        isinstance(operand2_val, list)):
-                    match_list = []
-                    # both operand1_val and operand2_val are list
-                    if isinstance(operand1_val, list) and \
-                        (is_operand2_json_val is False and \
-                            isinstance(operand2_val, list)):
-                            if len(operand1_val) != len(operand2_val):
-                                and_list_fail = True
-                                break
-                            for i in range(0, len(operand1_val)):
-                                if self._compare_operand_vals(
-                                    operand1_val[i]['value'],
-                                    operand2_val[i]['value'],
-                                    exp.operation):
-                                    match_list.append(
-                                        self._get_alarm_match(
-                                        uve, exp, operand1_val[i],
-                                        operand2_val[i],
-                                        is_operand2_json_val))
-                    # operand1_val is list and operand2_val is not list
-                    elif isinstance(operand1_val, list):
-                        val2 = operand2_val
-                        if not is_operand2_json_val:
-                            val2 = operand2_val['value']
-                        for val1 in operand1_val:
-                            if self._compare_operand_vals(val1['value'],
-                                val2, exp.operation):
-                                match_list.append(self._get_alarm_match(
-                                    uve, exp, val1, operand2_val,
-                                    is_operand2_json_val))
-                    # operand1_val is not list and operand2_val is list
-                    elif is_operand2_json_val is False and \
-                        isinstance(operand2_val, list):
-                        for val2 in operand2_val:
-                            if self._compare_operand_vals(
-                                operand1_val['value'], val2['value'],
-                                exp.operation):
-                                match_list.append(self._get_alarm_match(
-                                    uve, exp, operand1_val, val2,
-                                    is_operand2_json_val))
-                    if match_list:
-                        and_list.append(self._get_alarm_condition_match(
-                            uve, exp, operand1_val, operand2_val,
-                            is_operand2_json_val, match_list))
-                    else:
-                        and_list_fail = True
-                        break
-                # Neither operand1_val nor operand2_val is a list
-                else:
-                    val1 = operand1_val['value']
-                    val2 = operand2_val
-                    if not is_operand2_json_val:
-                        val2 = operand2_val['value']
-                    if self._compare_operand_vals(val1, val2, exp.operation):
-                        and_list.append(self._get_alarm_condition_match(
-                            uve, exp, operand1_val, operand2_val,
-                            is_operand2_json_val))
-                    else:
-                        and_list_fail = True
-                        break
-            if not and_list_fail:
-                or_list.append(AlarmAndList(and_list))
-        if or_list:
-            return or_list
-        return None
-    # end _evaluate_uve_for_alarms
+# end class AlarmTimerQueue
 
 
 class AlarmStateMachine:
-    tab_alarms_timer = {}
-    last_timers_run = None
+    timers = AlarmTimerQueue()
     def __init__(self, tab, uv, nm, sandesh, activeTimer, idleTimer,
             freqCheck_Times, freqCheck_Seconds, freqExceededCheck):
         self._sandesh = sandesh
@@ -598,11 +456,11 @@ class AlarmStateMachine:
             return True
         return False
 
-    def _remove_timer_from_list(self, index):
-        AlarmStateMachine.tab_alarms_timer[index].discard((self.tab,\
-                                self.uv, self.nm))
-        if len(AlarmStateMachine.tab_alarms_timer[index]) == 0:
-            del AlarmStateMachine.tab_alarms_timer[index]
+    def _add_timer(self, timeout):
+        AlarmStateMachine.timers.add((self.tab, self.uv, self.nm), timeout)
+
+    def _remove_timer(self):
+        AlarmStateMachine.timers.cancel((self.tab, self.uv, self.nm))
 
     def set_alarms(self):
         """
@@ -613,11 +471,9 @@ class AlarmStateMachine:
         curr_time = int(time.time())
         if self.uas.state == UVEAlarmState.Soak_Idle:
             self.uas.state = UVEAlarmState.Active
-            self._remove_timer_from_list(self.idleTimeout)
+            self._remove_timer()
         elif self.uas.state == UVEAlarmState.Idle:
-            if self.deleteTimeout and (self.deleteTimeout in \
-                    AlarmStateMachine.tab_alarms_timer):
-                self._remove_timer_from_list(self.deleteTimeout)
+            self._remove_timer()
             if self.uac.FreqExceededCheck:
                 # log the timestamp
                 ts = int(self.uai.timestamp/1000000.0)
@@ -633,11 +489,7 @@ class AlarmStateMachine:
                 # put it on the timer
                 self.uas.state = UVEAlarmState.Soak_Active
                 self.activeTimeout = curr_time + self.uac.ActiveTimer
-                timeout_value = self.activeTimeout
-                if not timeout_value in AlarmStateMachine.tab_alarms_timer:
-                    AlarmStateMachine.tab_alarms_timer[timeout_value] = set()
-                AlarmStateMachine.tab_alarms_timer[timeout_value].add\
-                        ((self.tab, self.uv, self.nm))
+                self._add_timer(self.activeTimeout)
         self.send_state_change_trace(old_state, self.uas.state)
     #end set_alarms
 
@@ -666,14 +518,10 @@ class AlarmStateMachine:
         if self.uas.state == UVEAlarmState.Soak_Active:
             # stop the active timer and start idle timer
             self.uas.state = UVEAlarmState.Idle
-            self._remove_timer_from_list(self.activeTimeout)
+            self._remove_timer()
             if self.uac.FreqCheck_Seconds:
                 self.deleteTimeout = cur_time + self.uac.FreqCheck_Seconds
-                to_value = self.deleteTimeout
-                if not to_value in AlarmStateMachine.tab_alarms_timer:
-                    AlarmStateMachine.tab_alarms_timer[to_value] = set()
-                AlarmStateMachine.tab_alarms_timer[to_value].add\
-                    ((self.tab, self.uv, self.nm))
+                self._add_timer(self.deleteTimeout)
             else:
                 delete_alarm = True
         elif self.uas.state == UVEAlarmState.Active:
@@ -682,21 +530,13 @@ class AlarmStateMachine:
                 self.uas.state = UVEAlarmState.Idle
                 if self.uac.FreqCheck_Seconds:
                     self.deleteTimeout = cur_time + self.uac.FreqCheck_Seconds
-                    to_value = self.deleteTimeout
-                    if not to_value in AlarmStateMachine.tab_alarms_timer:
-                        AlarmStateMachine.tab_alarms_timer[to_value] = set()
-                    AlarmStateMachine.tab_alarms_timer[to_value].add\
-                        ((self.tab, self.uv, self.nm))
+                    self._add_timer(self.deleteTimeout)
                 else:
                     delete_alarm = True
             else:
                 self.uas.state = UVEAlarmState.Soak_Idle
                 self.idleTimeout = cur_time + self.uac.IdleTimer
-                to_value = self.idleTimeout
-                if not to_value in AlarmStateMachine.tab_alarms_timer:
-                    AlarmStateMachine.tab_alarms_timer[to_value] = set()
-                AlarmStateMachine.tab_alarms_timer[to_value].add\
-                        ((self.tab, self.uv, self.nm))
+                self._add_timer(self.idleTimeout)
         self.send_state_change_trace(old_state, self.uas.state)
         return delete_alarm
 
@@ -783,70 +623,34 @@ class AlarmStateMachine:
     #end run_uve_soaking_timer
 
     def delete_timers(self):
-        if self.uas.state == UVEAlarmState.Idle:
-            if self.deleteTimeout and self.deleteTimeout > 0:
-                self._remove_timer_from_list(self.deleteTimeout)
-        elif self.uas.state == UVEAlarmState.Soak_Active:
-            if self.activeTimeout and self.activeTimeout > 0:
-                self._remove_timer_from_list(self.activeTimeout)
-        elif self.uas.state == UVEAlarmState.Soak_Idle:
-            if self.idleTimeout and self.idleTimeout > 0:
-                self._remove_timer_from_list(self.idleTimeout)
+        self._remove_timer()
 
     @staticmethod
     def run_timers(curr_time, tab_alarms):
-        inputs = namedtuple('inputs', ['tab', 'uv', 'nm',
-                            'delete_alarm', 'timeout_val', 'old_to'])
+        """
+        Runs the timers that expired by curr_time. Each timer is run with
+        its own expiry time, so that the timers started from it are the
+        same as they would have been without any delay in running them
+        """
         delete_alarms = []
         update_alarms = []
-        if AlarmStateMachine.last_timers_run is None:
-            AlarmStateMachine.last_timers_run = curr_time
-        for next_timer in range(AlarmStateMachine.last_timers_run, curr_time + 1):
-          if next_timer in AlarmStateMachine.tab_alarms_timer:
-            update_timers = []
-            for (tab, uv, nm) in AlarmStateMachine.tab_alarms_timer[next_timer]:
+        timers = AlarmStateMachine.timers
+        for expiry, (tab, uv, nm) in timers.expired(curr_time):
+            try:
                 asm = tab_alarms[tab][uv][nm]
-                delete_alarm, update_alarm, timeout_val = \
-                                asm.run_uve_soaking_timer(next_timer)
-                if delete_alarm:
-                    delete_alarms.append((asm.tab, asm.uv, asm.nm))
-                if update_alarm:
-                    update_alarms.append((asm.tab, asm.uv, asm.nm))
-                update_timers.append(inputs(tab=asm.tab, uv=asm.uv, nm=asm.nm,
-                                    delete_alarm=delete_alarm,
-                                    timeout_val=timeout_val, old_to=next_timer))
-            for timer in update_timers:
-                if timer.timeout_val is not None or timer.delete_alarm:
-                    AlarmStateMachine.update_tab_alarms_timer(timer.tab,
-                                    timer.uv, timer.nm, timer.old_to,
-                                    timer.timeout_val, tab_alarms)
-        AlarmStateMachine.last_timers_run = curr_time + 1
+            except KeyError:
+                # The alarm was deleted without stopping its timer
+                continue
+            delete_alarm, update_alarm, timeout_val = \
+                            asm.run_uve_soaking_timer(expiry)
+            if delete_alarm:
+                delete_alarms.append((asm.tab, asm.uv, asm.nm))
+            if update_alarm:
+                update_alarms.append((asm.tab, asm.uv, asm.nm))
+            if timeout_val is not None and timeout_val >= 0:
+                timers.add((tab, uv, nm), timeout_val)
         return delete_alarms, update_alarms
 
-    @staticmethod
-    def update_tab_alarms_timer(tab, uv, nm, curr_index, timeout_val,
-            tab_alarms):
-        del_timers = []
-        if curr_index is not None and curr_index > 0:
-            timers = AlarmStateMachine.tab_alarms_timer[curr_index]
-            if (tab, uv, nm) in timers:
-                asm = tab_alarms[tab][uv][nm]
-                timers.discard((tab, uv, nm))
-            if len(timers) == 0:
-                del_timers.append(curr_index)
-        for timeout in del_timers:
-            del AlarmStateMachine.tab_alarms_timer[timeout]
-        if timeout_val >= 0:
-            if not timeout_val in AlarmStateMachine.tab_alarms_timer:
-                AlarmStateMachine.tab_alarms_timer[timeout_val] = set()
-            if (tab, uv, nm) in AlarmStateMachine.tab_alarms_timer\
-                    [timeout_val]:
-                self._logger.error("Timer error for (%s,%s,%s)" % \
-                    (tab, uv, nm))
-                raise SystemExit(1)
-            AlarmStateMachine.tab_alarms_timer[timeout_val].add\
-                        ((asm.tab, asm.uv, asm.nm))
-
 
 
 class Controller(object):
@@ -992,6 +796,12 @@ class Controller(object):
         self._us = UVEServer(redis_uve_list, self._logger,
                 self._conf.redis_password(), self._conf.redis_ssl_params(), freq=us_freq)
 
+        # Rows per call of send_agg_uve when the script is used
+        self._max_script_rows = 1000
+        # None until the script is registered, False if the aggregate
+        # redis cannot run it
+        self._agg_uve_script = None
+
         # Start AnalyticsDiscovery to monitor AlarmGen instances
         if self._conf.zk_list():
             self._ad = AnalyticsDiscovery(self._logger,
@@ -1013,7 +823,12 @@ class Controller(object):
         self._uvestats = {}
         self._alarmstats = {}
         self._uveq = {}
+        # Kafka offset at which each queued UVE was first queued
+        self._uveq_offsets = {}
         self._uveqf = {}
+        # Seconds between checkpoints of a partition
+        self._ckpt_interval = 30
+        self._ckpt_time = {}
         self._alarm_config_change_map = {}
 
         # Create config handler to read/update alarm config
@@ -1028,6 +843,9 @@ class Controller(object):
         UVETableInfoReq.handle_request = self.handle_UVETableInfoReq
         UVETablePerfReq.handle_request = self.handle_UVETablePerfReq
         AlarmConfigRequest.handle_request = self.handle_AlarmConfigRequest
+        AlarmTimerStatsReq.handle_request = self.handle_AlarmTimerStatsReq
+        PartitionConsumeStatsReq.handle_request = \
+            self.handle_PartitionConsumeStatsReq
 
     def partition_log(self, msg):
         self._logger.error(msg)
@@ -1110,7 +928,7 @@ class Controller(object):
             self._logger.error('Could not import libpartition: %s' % str(e))
             return None
 
-    def handle_uve_notifq(self, part, uves):
+    def handle_uve_notifq(self, part, uves, uve_offsets=None):
         """
         uves :
           This is a dict of UVEs that have changed, as per the following scheme:
@@ -1119,6 +937,10 @@ class Controller(object):
           <UVE-Key> : { <Struct>: {} }   # The given struct may have changed
           <UVE-Key> : { <Struct>: None } # The given struct may have gone
           Our treatment of the 2nd and 3rd case above is the same
+        uve_offsets :
+          The kafka offset of the first notification of each UVE, if the
+          UVEs come from kafka notifications. Otherwise, the current
+          offset of the partition is used
         """
         uveq_trace = UVEQTrace()
         uveq_trace.uves = [str((k,str(v))) for k,v in uves.iteritems()]
@@ -1132,7 +954,16 @@ class Controller(object):
         uveq_trace.trace_msg(name="UVEQTrace",\
                 sandesh=self._sandesh)
 
+        offsets = self._uveq_offsets.setdefault(part, {})
+        offset = None
+        if part in self._workers:
+            offset = self._workers[part].offset()
         for uv,types in uves.iteritems():
+            if uv not in offsets:
+                if uve_offsets and uv in uve_offsets:
+                    offsets[uv] = uve_offsets[uv]
+                elif offset is not None:
+                    offsets[uv] = offset
             if types is None:
                 self._uveq[part][uv] = None
             else:
@@ -1204,6 +1035,7 @@ class Controller(object):
             uveq_trace.trace_msg(name="UVEQTrace",\
                     sandesh=self._sandesh)
             del self._uveq[part]
+            self._uveq_offsets.pop(part, None)
 
     def clear_agg_uve(self, redish, inst, part, acq_time=None):
         if acq_time:
@@ -1213,6 +1045,7 @@ class Controller(object):
             self.partition_log('Agg %s clear part %d' % (inst, part))
         ppe2 = redish.pipeline()
         ppe2.hdel("AGPARTS:%s" % inst, part)
+        ppe2.hdel("AGPARTCKPT:%s" % inst, part)
         ppe2.smembers("AGPARTKEYS:%s:%d" % (inst, part))
         pperes2 = ppe2.execute()
         ppe3 = redish.pipeline()
@@ -1239,6 +1072,15 @@ class Controller(object):
         if not redish:
             self._logger.error("No redis handle")
             raise SystemExit(1)
+        if self._agg_uve_script is not False:
+            try:
+                self.send_agg_uve_script(redish, inst, part, acq_time, rows)
+            except redis.exceptions.ResponseError as e:
+                self._logger.error("Agg UVE script failed, using "
+                    "pipelines instead: %s" % str(e))
+                self._agg_uve_script = False
+            else:
+                return
         old_acq_time = redish.hget("AGPARTS:%s" % inst, part)
         if old_acq_time is None:
             self._logger.error("Agg %s part %d new" % (inst, part))
@@ -1301,6 +1143,119 @@ class Controller(object):
         if retry:
             self._logger.error("Agg unexpected rows %s" % str(rows))
 
+    def send_agg_uve_script(self, redish, inst, part, acq_time, rows):
+        """
+        Same as send_agg_uve, using _AGG_UVE_SCRIPT to apply the rows,
+        clear stale contents of the partition and publish the changes
+        atomically in a single round-trip
+        """
+        if self._agg_uve_script is None:
+            self._agg_uve_script = redish.register_script(_AGG_UVE_SCRIPT)
+        pub_list = []
+        args = [inst, part, acq_time, None]
+        for row in rows:
+            pub_list.append({"key":row.key,"type":row.typ})
+            if row.typ is None:
+                args.extend(['D', row.key, '', ''])
+            elif row.val is None:
+                args.extend(['R', row.key, row.typ, ''])
+            else:
+                args.extend(['U', row.key, row.typ, json.dumps(row.val)])
+        args[3] = json.dumps(pub_list)
+        state, old_acq_time, empty_keys = self._agg_uve_script(args=args,
+            client=redish)
+        if state == 'new':
+            self._logger.error("Agg %s part %d new" % (inst, part))
+        elif state == 'stale':
+            self.partition_log("Agg %s stale info part %d, acqs %d,%d" % \
+                (inst, part, int(old_acq_time), acq_time))
+        for key in empty_keys:
+            self._logger.error("Agg unexpected key %s from inst:part %s:%d" % \
+                (key, inst, part))
+
+    def checkpoint_agg_uve(self, redish, part):
+        """
+        This function records the kafka offset up to which the
+        aggregated UVEs of this partition have been written, along with
+        the acq_time and collectors they were synced with.
+        A restarted alarmgen resumes the partition from this checkpoint
+        instead of reloading it (See restore_agg_uve)
+        """
+        if part not in self._workers:
+            return
+        worker = self._workers[part]
+        curr = time.time()
+        if curr - self._ckpt_time.get(part, 0) < self._ckpt_interval:
+            return
+        offsets = self._uveq_offsets.get(part)
+        if offsets:
+            # UVEs still in the queue need their notifications replayed
+            offset = min(offsets.itervalues())
+        else:
+            offset = worker.offset() + 1
+        ckpt = {"acq_time": worker.acq_time(),
+                "offset": offset,
+                "collectors": worker.contents().keys()}
+        redish.hset("AGPARTCKPT:%s" % self._instance_id, part,
+            json.dumps(ckpt))
+        self._ckpt_time[part] = curr
+
+    def restore_agg_uve(self, redish, inst, part):
+        """
+        This function loads the aggregated UVEs of a partition from
+        redis, if they have a valid checkpoint, and evaluates their alarms
+
+        It returns the PartCheckpoint to resume the partition from,
+        or None if the partition has to be reloaded
+        """
+        try:
+            ckpt = redish.hget("AGPARTCKPT:%s" % inst, part)
+            if ckpt is None:
+                return None
+            ckpt = json.loads(ckpt)
+            acq_time = redish.hget("AGPARTS:%s" % inst, part)
+            if acq_time is None or int(acq_time) != ckpt["acq_time"]:
+                self.partition_log("Agg %s stale checkpoint part %d" % \
+                    (inst, part))
+                return None
+            keys = list(redish.smembers("AGPARTKEYS:%s:%d" % (inst, part)))
+            ppe = redish.pipeline()
+            for key in keys:
+                ppe.hgetall("AGPARTVALUES:%s:%d:%s" % (inst, part, key))
+            values = ppe.execute()
+        except Exception as ex:
+            template = "Exception {0} in restore. Arguments:\n{1!r}"
+            messag = template.format(type(ex).__name__, ex.args)
+            self._logger.error("Agg %s cannot restore part %d: %s" % \
+                (inst, part, messag))
+            return None
+
+        self.ptab_info[part] = {}
+        uves = set()
+        for key, value in zip(keys, values):
+            if not value:
+                continue
+            uves.add(key)
+            tab, uve_name = key.split(':', 1)
+            if tab not in self.tab_perf:
+                self.tab_perf[tab] = AGTabStats()
+            if tab not in self.ptab_info[part]:
+                self.ptab_info[part][tab] = {}
+            local_uve = {}
+            for typ, vjson in value.iteritems():
+                local_uve[typ] = json.loads(vjson)
+            self.ptab_info[part][tab][uve_name] = AGKeyInfo(part)
+            self.ptab_info[part][tab][uve_name].update(local_uve)
+            if len(local_uve.keys()) == 1 and "UVEAlarms" in local_uve:
+                continue
+            self.examine_uve_for_alarms(part, key, local_uve)
+        self.partition_log("Agg %s restored part %d, %d UVEs at offset %d" % \
+            (inst, part, len(uves), ckpt["offset"]))
+        return PartCheckpoint(acq_time=ckpt["acq_time"],
+                              offset=ckpt["offset"],
+                              collectors=ckpt["collectors"],
+                              uves=uves)
+
     def send_alarm_update(self, tab, uk):
         ustruct = None
         alm_copy = []
@@ -1336,12 +1291,15 @@ class Controller(object):
         # Write the aggregate UVE for all UVE updates for the
         # given partition
         rows = []
+        max_rows = self._max_out_rows
+        if self._agg_uve_script is not False:
+            max_rows = self._max_script_rows
         for ku,vu in outp.iteritems():
             if vu is None:
                 # This message has no type!
                 # Its used to indicate a delete of the entire UVE
                 rows.append(OutputRow(key=ku, typ=None, val=None))
-                if len(rows) >= self._max_out_rows:
+                if len(rows) >= max_rows:
                     self.send_agg_uve(lredis,
                         self._instance_id,
                         part,
@@ -1351,7 +1309,7 @@ class Controller(object):
                 continue
             for kt,vt in vu.iteritems():
                 rows.append(OutputRow(key=ku, typ=kt, val=vt))
-                if len(rows) >= self._max_out_rows:
+                if len(rows) >= max_rows:
                     self.send_agg_uve(lredis,
                         self._instance_id,
                         part,
@@ -1440,6 +1398,8 @@ class Controller(object):
                     self._logger.info("Stopping part %d uveQ : %s" % \
                             (part,str(self._uveq[part].keys())))
                     del self._uveq[part]
+                self._uveq_offsets.pop(part, None)
+                self._ckpt_time.pop(part, None)
             prev = time.time()
             try:
                 # Get the collector list from zookeeper, it is assumed that redis is
@@ -1476,6 +1436,7 @@ class Controller(object):
                         self.reconnect_agg_uve(lredis)
                 gevs = {}
                 pendingset = {}
+                pendingoffs = {}
                 kafka_topic_down = False
                 for part in self._uveq.keys():
                     if not len(self._uveq[part]):
@@ -1489,10 +1450,14 @@ class Controller(object):
                     # interfering with the work of processing the current UVEs
                     # Process no more than 200 keys at a time
                     pendingset[part] = {}
+                    pendingoffs[part] = {}
+                    offsets = self._uveq_offsets.get(part, {})
                     icount = 0
                     while (len(self._uveq[part]) > 0) and icount < 200:
                         kp,vp = self._uveq[part].popitem()
                         pendingset[part][kp] = vp
+                        if kp in offsets:
+                            pendingoffs[part][kp] = offsets.pop(kp)
                         icount += 1
                     self._logger.info("UVE Process for %d : %d, %d remain" % \
                             (part, len(pendingset[part]), len(self._uveq[part])))
@@ -1535,6 +1500,8 @@ class Controller(object):
                         if outp[part] is None:
                             self._logger.error("UVE Process failed for %d" % part)
                             self.handle_uve_notifq(part, pendingset[part])
+                            # Keep the offsets of the original notifications
+                            self._uveq_offsets[part].update(pendingoffs[part])
                         elif not part in self._workers:
                             outp[part] = None
                             self._logger.error(
@@ -1551,6 +1518,7 @@ class Controller(object):
                         # Check for exceptions during processing
                         for part in gevs_out.keys():
                             gevs_out[part].get()
+                            self.checkpoint_agg_uve(lredis, part)
 
                 # If there are alarm config changes, then start a gevent per
                 # partition to process the alarm config changes
@@ -1837,6 +1805,22 @@ class Controller(object):
                 sandesh=self._sandesh)
 
         erruves = []
+        # Read all the UVEs of this batch together, with one set of
+        # pipelined round-trips per collector redis
+        cfilts = {}
+        for uv,types in uves.iteritems():
+            if types:
+                cfilts[uv] = {}
+                for typ in types.keys():
+                    cfilts[uv][typ] = set()
+        prevt = UTCTimestampUsec()
+        failures, uve_datas = self._us.get_uves(uves.keys(), True,
+                                                cfilts=cfilts)
+        if failures:
+            erruves = uves.keys()
+            success = False
+        get_time = (UTCTimestampUsec() - prevt) / max(len(uves), 1)
+
         for uv,types in uves.iteritems():
             tab = uv.split(':',1)[0]
             if tab not in self.tab_perf:
@@ -1844,18 +1828,8 @@ class Controller(object):
 
 
             uve_name = uv.split(':',1)[1]
-            prevt = UTCTimestampUsec()
-            filters = {}
-            if types:
-                filters["cfilt"] = {}
-                for typ in types.keys():
-                    filters["cfilt"][typ] = set()
-
-            failures, uve_data = self._us.get_uve(uv, True, filters)
-            if failures:
-                erruves.append(uv)
-                success = False
-            self.tab_perf[tab].record_get(UTCTimestampUsec() - prevt)
+            uve_data = uve_datas.get(uv, {})
+            self.tab_perf[tab].record_get(get_time)
             # Handling Agg UVEs
             if not part in self.ptab_info:
                 self._logger.error("Creating UVE table for part %s" % str(part))
@@ -2088,6 +2062,26 @@ class Controller(object):
             resp.response(req.context(), mr)
             np = np + 1
 
+    def handle_AlarmTimerStatsReq(self, req):
+        timers = AlarmStateMachine.timers
+        states = {UVEAlarmState.Soak_Active: 0, UVEAlarmState.Soak_Idle: 0,
+                  UVEAlarmState.Idle: 0}
+        for tab, uv, nm in timers.keys():
+            try:
+                state = self.tab_alarms[tab][uv][nm].get_uas().state
+            except KeyError:
+                continue
+            if state in states:
+                states[state] += 1
+        resp = AlarmTimerStatsResp(timers=len(timers),
+            soak_active=states[UVEAlarmState.Soak_Active],
+            soak_idle=states[UVEAlarmState.Soak_Idle],
+            idle=states[UVEAlarmState.Idle], fired=timers.fired,
+            lag=timers.lag, max_lag=timers.max_lag,
+            last_run=timers.last_run or 0)
+        resp.response(req.context())
+    # end handle_AlarmTimerStatsReq
+
     def handle_AlarmConfigRequest(self, req):
         config_db = self._config_handler.config_db()
         alarm_config_db = config_db.get('alarm', {})
@@ -2123,7 +2117,10 @@ class Controller(object):
             else:
                 lredis = self.get_redis_instance()
                 for partno in parts:
-                    self.clear_agg_uve(lredis, self._instance_id, partno)
+                    ckpt = self.restore_agg_uve(lredis, self._instance_id,
+                                                partno)
+                    if ckpt is None:
+                        self.clear_agg_uve(lredis, self._instance_id, partno)
                     ph = UveStreamProc(','.join(self._conf.kafka_broker_list()),
                             partno, self._conf.kafka_prefix()+"-uve-" + str(partno),
                             self._logger,
@@ -2133,7 +2130,9 @@ class Controller(object):
                             self._conf.redis_server_port(),
                             self._conf.kafka_use_ssl(),
                             self._conf.kafka_ssl_params(),
-                            self._conf.kafka_prefix()+"-workers")
+                            self._conf.kafka_prefix()+"-workers",
+                            ckpt,
+                            self._conf.kafka_poll_max_wait())
                     ph.start()
                     self._workers[partno] = ph
                     self._uvestats[partno] = {}
@@ -2393,6 +2392,30 @@ class Controller(object):
             resp.response(req.context(), mr)
             np = np + 1
 
+    def handle_PartitionConsumeStatsReq(self, req):
+        if req.partition == -1:
+            parts = sorted(self._workers.keys())
+        else:
+            parts = [req.partition]
+        resp = PartitionConsumeStatsResp(partitions=[])
+        for pt in parts:
+            if pt not in self._workers:
+                continue
+            stats = self._workers[pt].consume_stats()
+            pcs = PartitionConsumeStats(partition=pt,
+                lag=stats["lag"], max_lag=stats["max_lag"],
+                polls=stats["polls"], empty_polls=stats["empty_polls"],
+                resource_checks=stats["resource_checks"])
+            for hist in ["lag_histogram", "poll_latency_histogram"]:
+                buckets = []
+                for le, count in stats[hist]:
+                    if le is None:
+                        le = ""
+                    buckets.append(HistogramBucket(le=str(le), count=count))
+                setattr(pcs, hist, buckets)
+            resp.partitions.append(pcs)
+        resp.response(req.context())
+
     def alarm_ack_callback(self, alarm_req):
         '''
         Callback function for sandesh alarm acknowledge request.
@@ -98,6 +98,7 @@ class CfgParser(object):
         kafka_opts = {
             'kafka_broker_list': ['127.0.0.1:9092'],
             'kafka_ssl_enable': False,
+            'kafka_poll_max_wait': 500,
             'kafka_keyfile'   : '/etc/contrail/ssl/private/server-privkey.pem',
             'kafka_certfile'  : '/etc/contrail/ssl/certs/server.pem',
             'kafka_ca_cert'   : '/etc/contrail/ssl/certs/ca-cert.pem'
@@ -221,6 +222,8 @@ class CfgParser(object):
             help="Location of kafka ssl host certificate")
         parser.add_argument("--kafka_ca_cert", type=str,
             help="Location of kafka ssl CA certificate")
+        parser.add_argument("--kafka_poll_max_wait", type=int,
+            help="Maximum time in msec a kafka poll waits for messages")
         SandeshConfig.add_parser_arguments(parser)
         self._args = parser.parse_args(remaining_argv)
         if type(self._args.collectors) is str:
@@ -318,6 +321,9 @@ class CfgParser(object):
     def kafka_use_ssl(self):
         return self._args.kafka_ssl_enable
 
+    def kafka_poll_max_wait(self):
+        return self._args.kafka_poll_max_wait
+
     def kafka_ssl_params(self):
         return {'ssl_keyfile': self._args.kafka_keyfile,
                 'ssl_certfile': self._args.kafka_certfile,
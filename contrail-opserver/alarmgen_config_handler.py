@@ -15,6 +15,7 @@ from config_handler import ConfigHandler
 from alarmgen_config_db import DBBaseAG, GlobalSystemConfigAG, AlarmAG
 from opserver_util import camel_case_to_hyphen, inverse_dict
 from plugins.alarm_base import AlarmBase 
+from alarmgen_rules import AlarmRuleSet
 from sandesh.viz.constants import UVE_MAP
 
 
@@ -63,9 +64,30 @@ class AlarmGenConfigHandler(ConfigHandler):
         self._handle_config_update(config_type, fq_name, 'DELETE')
     # end config_delete
 
+    def _compile_alarm_rules(self, alarm_fqname, alarm_obj):
+        if isinstance(alarm_obj, AlarmBase):
+            # __call__ method overrides the generic alarm processing code.
+            if hasattr(alarm_obj, '__call__'):
+                return None
+            alarm_cfg = alarm_obj.config()
+        else:
+            alarm_cfg = alarm_obj
+        try:
+            return AlarmRuleSet(alarm_cfg)
+        except Exception as e:
+            # process_alarms reports the error when the alarm is evaluated
+            self._logger.error('Failed to compile the rules of alarm %s: %s' \
+                % (alarm_fqname, str(e)))
+            return None
+    # end _compile_alarm_rules
+
     def _update_alarm_config_table(self, alarm_fqname, alarm_obj, uve_keys,
                                    operation):
         alarm_config_change_map = {}
+        rule_set = None
+        if operation == 'CREATE' or operation == 'UPDATE':
+            # Compile the rules once for all the uve_keys
+            rule_set = self._compile_alarm_rules(alarm_fqname, alarm_obj)
         for key in uve_keys:
             uve_type_name = key.split(':', 1)
             try:
@@ -94,6 +116,7 @@ class AlarmGenConfigHandler(ConfigHandler):
                                 alarm_table[alarm_fqname] = alarm_base_obj
                         else:
                             alarm_table[alarm_fqname] = alarm_obj
+                        alarm_table[alarm_fqname].set_rule_set(rule_set)
                     elif operation == 'DELETE':
                         if alarm_table.has_key(alarm_fqname):
                             del alarm_table[alarm_fqname]
@@ -0,0 +1,316 @@
+#
+# Copyright (c) 2017 Juniper Networks, Inc. All rights reserved.
+#
+
+#
+# Alarm rule engine
+#
+# Compiles the alarm_rules of an alarm config object into a form that
+# can be evaluated against UVEs without re-parsing the config each time
+#
+
+import os
+import json
+import sandesh.viz.constants as viz_constants
+from sandesh.alarmgen_ctrl.sandesh_alarm_base.ttypes import AlarmOperand2, \
+    AlarmCondition, AlarmMatch, AlarmConditionMatch, AlarmAndList
+
+
+def _decode(val):
+    try:
+        return json.loads(val)
+    except (TypeError, ValueError):
+        return val
+# end _decode
+
+
+def _op_in(val1, val2):
+    if not isinstance(val2, list):
+        return False
+    return val1 in val2
+
+
+def _op_not_in(val1, val2):
+    if not isinstance(val2, list):
+        return True
+    return val1 not in val2
+
+
+def _op_size_eq(val1, val2):
+    if not isinstance(val1, list):
+        return False
+    return len(val1) == val2
+
+
+def _op_size_ne(val1, val2):
+    if not isinstance(val1, list):
+        return True
+    return len(val1) != val2
+
+
+_OPERATIONS = {
+    '==': lambda val1, val2: val1 == val2,
+    '!=': lambda val1, val2: val1 != val2,
+    '<': lambda val1, val2: val1 < val2,
+    '<=': lambda val1, val2: val1 <= val2,
+    '>': lambda val1, val2: val1 > val2,
+    '>=': lambda val1, val2: val1 >= val2,
+    'in': _op_in,
+    'not in': _op_not_in,
+    'range': lambda val1, val2: val2[0] <= val1 <= val2[1],
+    'size==': _op_size_eq,
+    'size!=': _op_size_ne,
+}
+
+
+def get_uve_attribute(tuve, attr_list, uve_path=None):
+    if uve_path is None:
+        uve_path = []
+    if tuve is None or not attr_list:
+        return {'value': tuve, 'uve_path': uve_path,
+                'status': False if len(attr_list) else True}
+    if isinstance(tuve, dict):
+        if attr_list[0] in ('*', '__value'):
+            return [get_uve_attribute(val, attr_list[1:],
+                    uve_path+[{key: val}]) \
+                    for key, val in tuve.iteritems()]
+        elif attr_list[0] == '__key':
+            return [get_uve_attribute(key, attr_list[1:],
+                    uve_path+[{key: val}]) \
+                    for key, val in tuve.iteritems()]
+        else:
+            tuve = tuve.get(attr_list[0])
+            uve_path.append({attr_list[0]: tuve})
+            return get_uve_attribute(tuve, attr_list[1:], uve_path)
+    elif isinstance(tuve, list):
+        return [get_uve_attribute(elem, attr_list,
+                uve_path+[{'__list_element__': elem}]) \
+                for elem in tuve]
+    elif isinstance(tuve, str):
+        try:
+            json_elem = json.loads(tuve)
+        except ValueError:
+            return {'value': None, 'uve_path': uve_path, 'status': False}
+        else:
+            return get_uve_attribute(json_elem, attr_list, uve_path)
+# end get_uve_attribute
+
+
+def get_json_value(val):
+    try:
+        tval = json.loads(val)
+    except (ValueError, TypeError):
+        return json.dumps(val)
+    else:
+        return val
+# end get_json_value
+
+
+def get_attribute_from_uve_path(attr_list, uve_path):
+    ai = ui = 0
+    pnode = uve_path[ui]
+    while (ai < len(attr_list) and ui < len(uve_path)):
+        if attr_list[ai] == '__key':
+            return uve_path[ui].iterkeys().next()
+        elif attr_list[ai] == '__value':
+            return uve_path[ui].itervalues().next()
+        if attr_list[ai] != '*' and attr_list[ai] not in uve_path[ui]:
+            break
+        pnode = uve_path[ui]
+        ui += 1
+        ai += 1
+        if len(uve_path) > ui and '__list_element__' in uve_path[ui]:
+            pnode = uve_path[ui]
+            ui += 1
+    if not ui:
+        return None
+    val = pnode.itervalues().next()
+    for a in attr_list[ai:]:
+        if val is None or not isinstance(val, dict):
+            return None
+        val = val.get(a)
+    return val
+# end get_attribute_from_uve_path
+
+
+def get_uve_parent_fqname(table, uve_name, uve):
+    try:
+        # virtual-machine UVE key doesn't have project name in the prefix.
+        # Hence extract the project name from the interface_list.
+        if table == viz_constants.VM_TABLE:
+            return uve['UveVirtualMachineAgent']['interface_list'][0].\
+                rsplit(':', 1)[0]
+        else:
+            return uve_name.rsplit(':', 1)[0]
+    except (KeyError, IndexError):
+        return None
+# end get_uve_parent_fqname
+
+
+class AlarmExpressionRule(object):
+    """ A single alarm expression with its operands split, the json
+        operand2 decoded and the operation resolved ahead of evaluation
+    """
+    def __init__(self, exp):
+        self.exp = exp
+        self.operand1 = exp.operand1.split('.')
+        self.compare = _OPERATIONS.get(exp.operation)
+        if exp.operand2.json_value is not None:
+            self.is_json_val = True
+            self.operand2 = None
+            self.json_val = json.loads(exp.operand2.json_value)
+            # operand values are decoded once more before comparison
+            self.json_cmp_val = _decode(self.json_val)
+        else:
+            self.is_json_val = False
+            self.operand2 = exp.operand2.uve_attribute.split('.')
+        # For every variable, decide upfront which operand's uve_path
+        # it should be looked up in
+        self.variables = []
+        for var in exp.variables:
+            var_list = var.split('.')
+            use_operand1 = True
+            if not self.is_json_val:
+                p1 = os.path.commonprefix([self.operand1, var_list])
+                p2 = os.path.commonprefix([self.operand2, var_list])
+                use_operand1 = p1 > p2
+            self.variables.append((var, var_list, use_operand1))
+        self.condition = AlarmCondition(operation=exp.operation,
+            operand1=exp.operand1, operand2=AlarmOperand2(
+                uve_attribute=exp.operand2.uve_attribute,
+                json_value=exp.operand2.json_value),
+            variables=exp.variables)
+    # end __init__
+
+    def is_match(self, val1, val2):
+        if self.compare is None:
+            return None
+        val1 = _decode(val1)
+        if self.is_json_val:
+            val2 = self.json_cmp_val
+        else:
+            val2 = _decode(val2)
+        return self.compare(val1, val2)
+    # end is_match
+
+    def alarm_match(self, operand1_val, operand2_val):
+        json_vars = {}
+        for var, var_list, use_operand1 in self.variables:
+            if use_operand1:
+                var_val = get_attribute_from_uve_path(var_list,
+                    operand1_val['uve_path'])
+            else:
+                var_val = get_attribute_from_uve_path(var_list,
+                    operand2_val['uve_path'])
+            json_vars[var] = get_json_value(var_val)
+        json_operand1_val = get_json_value(operand1_val['value'])
+        if not self.is_json_val:
+            json_operand2_val = get_json_value(operand2_val['value'])
+        else:
+            json_operand2_val = None
+        return AlarmMatch(json_operand1_value=json_operand1_val,
+            json_operand2_value=json_operand2_val, json_variables=json_vars)
+    # end alarm_match
+
+    def evaluate(self, uve):
+        """ Returns the AlarmConditionMatch for this expression or
+            None if the expression is not satisfied by the UVE
+        """
+        operand1_val = get_uve_attribute(uve, self.operand1)
+        if isinstance(operand1_val, dict) and \
+            operand1_val['status'] is False:
+            return None
+        if self.is_json_val:
+            operand2_val = self.json_val
+        else:
+            operand2_val = get_uve_attribute(uve, self.operand2)
+            if isinstance(operand2_val, dict) and \
+                operand2_val['status'] is False:
+                return None
+        operand1_is_list = isinstance(operand1_val, list)
+        operand2_is_list = not self.is_json_val and \
+            isinstance(operand2_val, list)
+        if operand1_is_list or operand2_is_list:
+            match_list = []
+            # both operand1_val and operand2_val are list
+            if operand1_is_list and operand2_is_list:
+                if len(operand1_val) != len(operand2_val):
+                    return None
+                for val1, val2 in zip(operand1_val, operand2_val):
+                    if self.is_match(val1['value'], val2['value']):
+                        match_list.append(self.alarm_match(val1, val2))
+            # operand1_val is list and operand2_val is not list
+            elif operand1_is_list:
+                val2 = operand2_val
+                if not self.is_json_val:
+                    val2 = operand2_val['value']
+                for val1 in operand1_val:
+                    if self.is_match(val1['value'], val2):
+                        match_list.append(self.alarm_match(val1,
+                            operand2_val))
+            # operand1_val is not list and operand2_val is list
+            else:
+                for val2 in operand2_val:
+                    if self.is_match(operand1_val['value'], val2['value']):
+                        match_list.append(self.alarm_match(operand1_val,
+                            val2))
+            if not match_list:
+                return None
+        # Neither operand1_val nor operand2_val is a list
+        else:
+            val2 = operand2_val
+            if not self.is_json_val:
+                val2 = operand2_val['value']
+            if not self.is_match(operand1_val['value'], val2):
+                return None
+            match_list = [self.alarm_match(operand1_val, operand2_val)]
+        return AlarmConditionMatch(condition=self.condition,
+                                   match=match_list)
+    # end evaluate
+
+# end class AlarmExpressionRule
+
+
+class AlarmRuleSet(object):
+    """ The compiled alarm_rules of an alarm config object.
+        The config is compiled once when the AlarmRuleSet is created;
+        evaluate() can then be called for any number of UVEs
+    """
+    def __init__(self, alarm_cfg):
+        self.alarm_cfg = alarm_cfg
+        self.check_parent = alarm_cfg.parent_type == 'project'
+        if self.check_parent:
+            self.parent_fq_name = alarm_cfg.get_parent_fq_name_str()
+        self.or_list = []
+        for cfg_and_list in alarm_cfg.alarm_rules.or_list:
+            self.or_list.append([AlarmExpressionRule(exp) \
+                for exp in cfg_and_list.and_list])
+    # end __init__
+
+    def evaluate(self, uve_key, uve):
+        """ Evaluate the rules against the UVE
+            :returns: list of AlarmAndList or None
+        """
+        if self.check_parent:
+            # For alarms configured under project, the parent fq_name of
+            # the uve should match with that of the alarm config
+            table, uve_name = uve_key.split(':', 1)
+            if get_uve_parent_fqname(table, uve_name, uve) != \
+                    self.parent_fq_name:
+                return None
+        or_list = []
+        for rules in self.or_list:
+            and_list = []
+            for rule in rules:
+                cond_match = rule.evaluate(uve)
+                if cond_match is None:
+                    break
+                and_list.append(cond_match)
+            else:
+                or_list.append(AlarmAndList(and_list))
+        if or_list:
+            return or_list
+        return None
+    # end evaluate
+
+# end class AlarmRuleSet
@@ -38,7 +38,9 @@ import copy
 import datetime
 import platform
 from analytics_db import AnalyticsDb
+import gevent
 from gevent.server import StreamServer
+from gevent.event import Event
 from pysandesh.util import UTCTimestampUsec
 from pysandesh.sandesh_base import *
 from pysandesh.sandesh_session import SandeshWriter
@@ -72,17 +74,24 @@ from overlay_to_underlay_mapper import OverlayToUnderlayMapper, \
      OverlayToUnderlayMapperError
 from generator_introspect_util import GeneratorIntrospectUtil
 from stevedore import hook, extension
-from partition_handler import PartInfo, UveStreamer, UveCacheProcessor
+from partition_handler import PartInfo, UveStreamHub, UveCacheProcessor
 from functools import wraps
 from vnc_cfg_api_client import VncCfgApiClient
 from opserver_local import LocalApp
 from opserver_util import AnalyticsDiscovery
-from strict_redis_wrapper import StrictRedisWrapper
+from strict_redis_wrapper import StrictRedisWrapper, redis_pools
 from sandesh.analytics_api_info.ttypes import AnalyticsApiInfoUVE, \
     AnalyticsApiInfo, UVEDbCacheTablesRequest, UVEDbCacheTable, \
     UVEDbCacheTablesResponse, UVEDbCacheTableKeysRequest, \
     UVEDbCacheTableKey, UVEDbCacheTableKeysResponse, \
-    UVEDbCacheUveRequest, UVEDbCacheUveResponse
+    UVEDbCacheUveRequest, UVEDbCacheUveResponse, \
+    UVEDbCacheMemoryRequest, UVEDbCacheMemoryResponse, \
+    UVEDbCacheTableMemory, \
+    UVEAttrCacheStatsRequest, UVEAttrCacheStatsResponse, \
+    UVEStreamStatsRequest, UVEStreamStatsResponse, RedisPoolStatsRequest, \
+    RedisPoolStatsResponse, RedisPoolStats, QueryCacheStatsRequest, \
+    QueryCacheStatsResponse, RbacCacheStatsRequest, RbacCacheStatsResponse, \
+    RbacCacheStats, RbacCacheInvalidateRequest, RbacCacheInvalidateResponse
 from cfgm_common.exceptions import BadRequest, HttpError, PermissionDenied, AuthFailed
 
 
@@ -166,9 +175,8 @@ def obj_to_dict(obj):
 
 
 def redis_query_start(host, port, redis_password, redis_ssl_params, qid, inp, columns):
-    redish = StrictRedisWrapper(db=0, host=host, port=port,
-                               password=redis_password,
-                               **redis_ssl_params)
+    redish = redis_pools.client(host, port, db=0, password=redis_password,
+                                ssl_params=redis_ssl_params)
     for key, value in inp.items():
         redish.hset("QUERY:" + qid, key, json.dumps(value))
     col_list = []
@@ -196,9 +204,8 @@ def redis_query_start(host, port, redis_password, redis_ssl_params, qid, inp, co
 
 
 def redis_query_status(host, port, redis_password, redis_ssl_params, qid):
-    redish = StrictRedisWrapper(db=0, host=host, port=port,
-                               password=redis_password,
-                               **redis_ssl_params)
+    redish = redis_pools.client(host, port, db=0, password=redis_password,
+                                ssl_params=redis_ssl_params)
     resp = {"progress": 0}
     chunks = []
     # For now, the number of chunks will be always 1
@@ -221,26 +228,165 @@ def redis_query_status(host, port, redis_password, redis_ssl_params, qid):
 # end redis_query_status
 
 
-def redis_query_chunk_iter(host, port, redis_password, redis_ssl_params, qid, chunk_id):
-    redish = StrictRedisWrapper(db=0, host=host, port=port,
-                               password=redis_password,
-                               **redis_ssl_params)
+class QueryReplyListener(object):
+    """
+    Listens for the status updates that the query engine publishes on
+    the REPLY:<qid> channels of a redis, and wakes up the callers that
+    wait for the status of these queries to change.
+    All the waiters share one PSUBSCRIBE, made on a connection of its
+    own so that it does not hold a connection of the redis pool
+    """
+
+    _listeners = {}
+
+    def __init__(self, host, port, redis_password, redis_ssl_params,
+                 retry_interval=1):
+        self._host = host
+        self._port = port
+        self._redis_password = redis_password
+        self._redis_ssl_params = redis_ssl_params
+        self._retry_interval = retry_interval
+        self._waiters = {}
+        self._greenlet = None
+
+    @classmethod
+    def get(cls, host, port, redis_password, redis_ssl_params):
+        """
+        Returns the listener of the redis, started on first use
+        """
+        use_ssl = bool(redis_ssl_params and redis_ssl_params.get('ssl'))
+        key = (host, int(port), use_ssl, redis_password)
+        listener = cls._listeners.get(key)
+        if listener is None:
+            listener = cls(host, port, redis_password, redis_ssl_params)
+            cls._listeners[key] = listener
+        if listener._greenlet is None or listener._greenlet.dead:
+            listener._greenlet = gevent.spawn(listener._run)
+        return listener
+
+    def watch(self, qid):
+        """
+        Returns an Event that is set when a status update of the query
+        is published
+        """
+        event = Event()
+        self._waiters.setdefault(qid, set()).add(event)
+        return event
+
+    def unwatch(self, qid, event):
+        events = self._waiters.get(qid)
+        if events is None:
+            return
+        events.discard(event)
+        if not events:
+            del self._waiters[qid]
+
+    def _redis(self):
+        kwargs = {}
+        if self._redis_ssl_params and self._redis_ssl_params.get('ssl'):
+            kwargs = self._redis_ssl_params
+        return StrictRedisWrapper(host=self._host, port=int(self._port),
+                                  db=0, password=self._redis_password,
+                                  **kwargs)
+
+    def _notify(self, qid=None):
+        # Wake up the waiters of qid, or all of them
+        if qid is None:
+            waiters = self._waiters.values()
+        else:
+            waiters = [self._waiters.get(qid, ())]
+        for events in waiters:
+            for event in list(events):
+                event.set()
+
+    def _run(self):
+        while True:
+            pubsub = None
+            try:
+                pubsub = self._redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe("REPLY:*")
+                # Updates published before the subscription are picked
+                # up by the waiters reading the status again
+                self._notify()
+                for msg in pubsub.listen():
+                    if msg['type'] == 'pmessage':
+                        self._notify(msg['channel'][len("REPLY:"):])
+            except Exception:
+                # The waiters poll the status until we reconnect
+                pass
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
+            gevent.sleep(self._retry_interval)
+# end class QueryReplyListener
+
+
+def redis_query_wait(host, port, redis_password, redis_ssl_params, qid, prg,
+                     timeout, poll_interval=1):
+    """
+    Wait for up to timeout seconds for the progress of the query to
+    move away from prg, and return the status of the query.
+    The query engine publishes every status update on the REPLY:<qid>
+    channel, so this returns as soon as the status changes. The status
+    is also read every poll_interval seconds, in case a notification
+    is missed.
+    """
+    listener = QueryReplyListener.get(host, port, redis_password,
+                                      redis_ssl_params)
+    event = listener.watch(qid)
+    try:
+        deadline = time.time() + timeout
+        while True:
+            # Clear the event before reading the status, so that an
+            # update made after the read is not missed
+            event.clear()
+            resp = redis_query_status(host, port, redis_password,
+                                      redis_ssl_params, qid)
+            if resp is not None and int(resp["progress"]) != prg:
+                return resp
+            wait = deadline - time.time()
+            if wait <= 0:
+                return resp
+            event.wait(timeout=min(wait, poll_interval))
+    finally:
+        listener.unwatch(qid, event)
+# end redis_query_wait
+
+
+def redis_query_chunk_iter(host, port, redis_password, redis_ssl_params, qid,
+                           chunk_id, batch_size=1000):
+    """
+    Yields the rows of the query result in lists of up to batch_size
+    rows, followed by an empty list. The result lines RESULT:<qid>:<n>
+    are read a batch at a time and deleted once they have been read, so
+    that the result is never held in memory as a whole
+    """
+    redish = redis_pools.client(host, port, db=0, password=redis_password,
+                                ssl_params=redis_ssl_params)
 
     iters = 0
     fin = False
 
     while not fin:
-        #import pdb; pdb.set_trace()
+        key = "RESULT:" + qid + ":" + str(iters)
         # Keep the result line valid while it is being read
-        redish.persist("RESULT:" + qid + ":" + str(iters))
-        elems = redish.lrange("RESULT:" + qid + ":" + str(iters), 0, -1)
-        yield elems
-        if elems == []:
+        redish.persist(key)
+        start = 0
+        while True:
+            elems = redish.lrange(key, start, start + batch_size - 1)
+            if not elems:
+                break
+            yield elems
+            if len(elems) < batch_size:
+                break
+            start += batch_size
+        if start == 0 and not elems:
             fin = True
         else:
-            redish.delete("RESULT:" + qid + ":" + str(iters), 0, -1)
+            redish.delete(key)
         iters += 1
 
+    yield []
     return
 # end redis_query_chunk_iter
 
@@ -248,29 +394,16 @@ def redis_query_chunk_iter(host, port, redis_password, redis_ssl_params, qid, ch
 def redis_query_chunk(host, port, redis_password, redis_ssl_params, qid, chunk_id):
     res_iter = redis_query_chunk_iter(host, port, redis_password, redis_ssl_params, qid, chunk_id)
 
-    dli = u''
-    starter = True
-    fin = False
+    dli = u'\n'
     yield u'{"value": ['
     outcount = 0
-    while not fin:
-
-        #import pdb; pdb.set_trace()
-        # Keep the result line valid while it is being read
-        elems = res_iter.next()
-
-        fin = True
-        for elem in elems:
-            fin = False
-            outcount += 1
-            if starter:
-                dli += '\n' + elem
-                starter = False
-            else:
-                dli += ', ' + elem
-        if not fin:
-            yield dli + '\n'
-            dli = u''
+    for elems in res_iter:
+        if not elems:
+            continue
+        # Each batch of rows is sent as soon as it is read
+        yield dli + u', '.join(elems) + u'\n'
+        dli = u', '
+        outcount += len(elems)
 
     if outcount == 0:
         yield '\n' + u']}'
@@ -311,18 +444,15 @@ def redis_query_result_dict(host, port, redis_password, redis_ssl_params, qid):
     prg = int(stat["progress"])
     res = []
 
-    if (prg < 0) or (prg == 100):
-
-        done = False
-        gen = redis_query_result(host, port, redis_password, redis_ssl_params, qid)
-        result = u''
-        while not done:
-            try:
-                result += gen.next()
-                #import pdb; pdb.set_trace()
-            except StopIteration:
-                done = True
-        res = (json.loads(result))['value']
+    if prg == 100:
+        # Decode the rows as they are read, instead of decoding the
+        # whole result document at once
+        for chunk in stat['chunks']:
+            chunk_id = int(chunk['href'].rsplit('/', 1)[1])
+            for elems in redis_query_chunk_iter(host, port, redis_password,
+                                                redis_ssl_params, qid,
+                                                chunk_id):
+                res.extend(json.loads(elem) for elem in elems)
 
     return prg, res
 # end redis_query_result_dict
@@ -361,10 +491,10 @@ class OpStateServer(object):
             % (msg_type, destination, msg_encode)
         # Publish message in the Redis bus
         for redis_server in self._redis_list:
-            redis_inst = StrictRedisWrapper(redis_server[0],
-                                           redis_server[1], db=0,
-                                           password=self._redis_password,
-                                           **self._redis_ssl_params)
+            redis_inst = redis_pools.client(redis_server[0],
+                                            redis_server[1], db=0,
+                                            password=self._redis_password,
+                                            ssl_params=self._redis_ssl_params)
             try:
                 redis_inst.publish('analytics', redis_msg)
             except redis.exceptions.ConnectionError:
@@ -376,6 +506,72 @@ class OpStateServer(object):
 
 # end class OpStateServer
 
+class QueryResultCache(object):
+    '''
+    LRU cache of the results of synchronous queries, keyed by the
+    normalized query. Relative start/end times ("now-10m") are bucketed
+    into ttl long intervals, so the same query re-issued by a dashboard
+    maps to the same entry until the entry expires. The encoded result
+    of every entry is kept, up to max_size bytes over all the entries.
+    '''
+    def __init__(self, ttl, max_size):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._size = 0
+        self._cache = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._bypasses = 0
+
+    def key(self, query):
+        tbucket = None
+        for tkey in ('start_time', 'end_time'):
+            tval = query.get(tkey)
+            if isinstance(tval, basestring) and tval.startswith('now'):
+                tbucket = int(time.time() // self._ttl)
+        return hashlib.md5(json.dumps([query, tbucket],
+                                      sort_keys=True)).hexdigest()
+
+    def get(self, ckey):
+        entry = self._cache.pop(ckey, None)
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                self._size -= entry[2]
+            self._misses += 1
+            return None
+        # move to the most recently used end
+        self._cache[ckey] = entry
+        self._hits += 1
+        return entry[1]
+
+    def put(self, ckey, result, size):
+        if size > self._max_size:
+            return
+        entry = self._cache.pop(ckey, None)
+        if entry is not None:
+            self._size -= entry[2]
+        now = time.time()
+        self._cache[ckey] = (now + self._ttl, result, size)
+        self._size += size
+        # Drop the least recently used entries that are over the
+        # budget or have expired
+        while self._size > self._max_size or \
+                self._cache.itervalues().next()[0] <= now:
+            self._size -= self._cache.popitem(last=False)[1][2]
+
+    def bypass(self):
+        self._bypasses += 1
+
+    def max_size(self):
+        return self._max_size
+
+    def stats(self):
+        return {'entries': len(self._cache), 'size': self._size,
+                'hits': self._hits, 'misses': self._misses,
+                'bypasses': self._bypasses}
+
+# end QueryResultCache
+
 class AnalyticsApiStatistics(object):
     def __init__(self, sandesh, obj_type):
         self.obj_type = obj_type
@@ -383,7 +579,7 @@ class AnalyticsApiStatistics(object):
         self.api_stats = None
         self.sandesh = sandesh
 
-    def collect(self, resp_size, resp_size_bytes):
+    def collect(self, resp_size, resp_size_bytes, cache=None):
         time_finish = UTCTimestampUsec()
 
         useragent = bottle.request.headers.get('X-Contrail-Useragent')
@@ -401,7 +597,8 @@ class AnalyticsApiStatistics(object):
             response_size_bytes=resp_size_bytes,
             resp_code='200',
             useragent=useragent,
-            node=self.sandesh.source_id())
+            node=self.sandesh.source_id(),
+            cache=cache)
 
     def sendwith(self):
         stats_log = AnalyticsApiStats(api_stats=self.api_stats,
@@ -435,6 +632,9 @@ class OpServer(object):
         * ``/analytics/operation/database-purge``:
     """
 
+    # Longest time a request waits for the progress of a query to change
+    _QUERY_WAIT_MAX = 30
+
     def validate_user_token(func=None, only_cloud_admin=True,
             get_token_info=False):
         def _validate_user_token_impl(func):
@@ -769,6 +969,7 @@ class OpServer(object):
                  for k, v in ModuleCategoryMap.iteritems())
 
         self.agp = {}
+        self._uve_stream_hub = None
         ConnectionState.update(conn_type = ConnectionType.UVEPARTITIONS,
             name = 'UVE-Aggregation', status = ConnectionStatus.UP,
             server_addrs = self._args.redis_uve_list,
@@ -796,8 +997,14 @@ class OpServer(object):
                                  self._args.redis_password,
                                  self.redis_ssl_params(),
                                  None, False,
-                                 freq = us_freq)
+                                 freq = us_freq,
+                                 attr_cache_max_size = \
+                                    self._args.uve_attr_cache_max_size)
         self._state_server.update_redis_list(self.redis_uve_list) 
+        self._query_cache = None
+        if self._args.query_cache_ttl > 0:
+            self._query_cache = QueryResultCache(
+                self._args.query_cache_ttl, self._args.query_cache_max_size)
 
         if self._args.zk_list:
             self._ad = AnalyticsDiscovery(self._logger,
@@ -992,6 +1199,20 @@ class OpServer(object):
         UVEDbCacheTableKeysRequest.handle_request = \
             self.handle_UVEDbCacheTableKeysRequest
         UVEDbCacheUveRequest.handle_request = self.handle_UVEDbCacheUveRequest
+        UVEDbCacheMemoryRequest.handle_request = \
+            self.handle_UVEDbCacheMemoryRequest
+        UVEAttrCacheStatsRequest.handle_request = \
+            self.handle_UVEAttrCacheStatsRequest
+        UVEStreamStatsRequest.handle_request = \
+            self.handle_UVEStreamStatsRequest
+        RedisPoolStatsRequest.handle_request = \
+            self.handle_RedisPoolStatsRequest
+        QueryCacheStatsRequest.handle_request = \
+            self.handle_QueryCacheStatsRequest
+        RbacCacheStatsRequest.handle_request = \
+            self.handle_RbacCacheStatsRequest
+        RbacCacheInvalidateRequest.handle_request = \
+            self.handle_RbacCacheInvalidateRequest
 
         bottle.route('/', 'GET', self.homepage_http_get)
         bottle.route('/analytics', 'GET', self.analytics_http_get)
@@ -1084,6 +1305,11 @@ class OpServer(object):
             'logging_conf': '',
             'logger_class': None,
             'partitions'        : 15,
+            'uve_attr_cache_max_size' : 16*1024*1024,
+            'query_cache_ttl'   : 0,
+            'query_cache_max_size' : 64*1024*1024,
+            'rbac_cache_ttl'    : 0,
+            'rbac_cache_size'   : 10000,
             'zk_list'           : None,
             'zk_prefix'         : '',
             'aaa_mode'          : AAA_MODE_CLOUD_ADMIN,
@@ -1204,6 +1430,18 @@ class OpServer(object):
             help=("Optional external logger class, default: None"))
         parser.add_argument("--partitions", type=int,
             help="Number of partitions for hashing UVE keys")
+        parser.add_argument("--uve_attr_cache_max_size", type=int,
+            help="Bytes of parsed UVE attributes to cache, 0 to disable")
+        parser.add_argument("--query_cache_ttl", type=int,
+            help="Seconds to cache the results of synchronous queries for,"
+                 " 0 to disable")
+        parser.add_argument("--query_cache_max_size", type=int,
+            help="Bytes of query results to cache")
+        parser.add_argument("--rbac_cache_ttl", type=int,
+            help="Seconds to cache the token info and permissions given"
+                 " by the API server for, 0 to disable")
+        parser.add_argument("--rbac_cache_size", type=int,
+            help="Number of token infos and permissions to cache")
         parser.add_argument("--zk_list",
             help="List of zookeepers in ip:port format",
             nargs="+")
@@ -1274,6 +1512,8 @@ class OpServer(object):
         auth_conf_info['cloud_admin_role'] = self._args.cloud_admin_role
         auth_conf_info['admin_port'] = self._args.admin_port
         auth_conf_info['api_servers'] = self._args.api_server
+        auth_conf_info['rbac_cache_ttl'] = self._args.rbac_cache_ttl
+        auth_conf_info['rbac_cache_size'] = self._args.rbac_cache_size
         self._args.auth_conf_info = auth_conf_info
         self._args.conf_file = args.conf_file
         self._args.sandesh_config = \
@@ -1387,14 +1627,19 @@ class OpServer(object):
         # This is needed to detect when the client hangs up
         rfile = bottle.request.environ['wsgi.input'].rfile
 
-        body = gevent.queue.Queue()
-        ph = UveStreamer(self._logger, body, rfile, self.get_agp,
-            self._args.redis_password, self.redis_ssl_params(),
-            filters['tablefilt'], filters['cfilt'], patterns, token=token)
+        # All the stream clients share the partition subscriptions
+        # and UVE contents of a single hub
+        if self._uve_stream_hub is None:
+            self._uve_stream_hub = UveStreamHub(self._logger, self.get_agp,
+                self._args.redis_password, self.redis_ssl_params())
+            self.gevs.append(self._uve_stream_hub)
+            self._uve_stream_hub.start()
+        ph = self._uve_stream_hub.client(rfile, filters['tablefilt'],
+            filters['cfilt'], patterns, token=token)
         ph.set_cleanup_callback(self.cleanup_uve_streamer)
         self.gevs.append(ph)
         ph.start()
-        return body
+        return ph.stream()
 
     @validate_user_token(only_cloud_admin=False, get_token_info=True)
     def uve_stream(self):
@@ -1455,12 +1700,27 @@ class OpServer(object):
         if redis_query_ip is None:
             return bottle.HTTPError(_ERRORS[errno.EINVAL],
                     'Invalid query id')
+        # With wait=<seconds> and progress=<last progress seen>, the
+        # status is returned once the progress of the query changes
+        try:
+            wait = min(float(request.query.get('wait', 0)),
+                       self._QUERY_WAIT_MAX)
+            prg = int(request.query.get('progress', 0))
+        except ValueError as e:
+            return bottle.HTTPError(_ERRORS[errno.EBADMSG], e)
         try:
-            resp = redis_query_status(host=redis_query_ip,
-                                      port=int(self._args.redis_query_port),
-                                      redis_password=self._args.redis_password,
-                                      redis_ssl_params=self.redis_ssl_params(),
-                                      qid=qid)
+            if wait > 0:
+                resp = redis_query_wait(host=redis_query_ip,
+                                        port=int(self._args.redis_query_port),
+                                        redis_password=self._args.redis_password,
+                                        redis_ssl_params=self.redis_ssl_params(),
+                                        qid=qid, prg=prg, timeout=wait)
+            else:
+                resp = redis_query_status(host=redis_query_ip,
+                                          port=int(self._args.redis_query_port),
+                                          redis_password=self._args.redis_password,
+                                          redis_ssl_params=self.redis_ssl_params(),
+                                          qid=qid)
         except redis.exceptions.ConnectionError:
             return bottle.HTTPError(_ERRORS[errno.EIO],
                     'Failure in connection to the query DB')
@@ -1632,6 +1892,41 @@ class OpServer(object):
 
             self.check_perms_and_update_where_clause(request, tabl, tabn)
 
+            accept_async = request.get_header('Expect') == '202-accepted' or\
+                request.get_header('Postman-Expect') == '202-accepted'
+            # Results of synchronous queries may be served from the query
+            # cache, unless the request asks not to with Cache-Control
+            cache_key = None
+            cache_status = None
+            if self._query_cache is not None and not accept_async:
+                cache_control = request.get_header('Cache-Control', '')
+                if 'no-store' in cache_control:
+                    cache_status = 'bypass'
+                    self._query_cache.bypass()
+                else:
+                    # The where clause has been restricted to the
+                    # resources of the user by now, so is the key
+                    cache_key = self._query_cache.key(request.json)
+                    if 'no-cache' in cache_control:
+                        cache_status = 'bypass'
+                        self._query_cache.bypass()
+                    else:
+                        cache_status = 'miss'
+                        result = self._query_cache.get(cache_key)
+                        if result is not None:
+                            self._logger.info(
+                                "Query %s served from the cache" % qid)
+                            stats = AnalyticsApiStatistics(self._sandesh, tabl)
+                            bottle.response.set_header('Content-Type',
+                                                       'application/json')
+                            byt = 0
+                            for gen in result:
+                                byt += len(gen)
+                                yield gen
+                            stats.collect(0, byt, 'hit')
+                            stats.sendwith()
+                            return
+
             prg = redis_query_start('127.0.0.1',
                                     int(self._args.redis_query_port),
                                     self._args.redis_password,
@@ -1669,32 +1964,51 @@ class OpServer(object):
                 # In Async mode, we should return with "202 Accepted" here
                 # and also give back the status URI "/analytic/query/<qid>"
                 # OpServers's client will poll the status URI
-                if request.get_header('Expect') == '202-accepted' or\
-                   request.get_header('Postman-Expect') == '202-accepted':
+                if accept_async:
                     href = '/analytics/query/%s' % (qid)
                     resp_data = json.dumps({'href': href})
                     yield bottle.HTTPResponse(
                         resp_data, 202, {'Content-type': 'application/json'})
                 else:
+                    stats = AnalyticsApiStatistics(self._sandesh, tabl)
+                    result = None
+                    if cache_key is not None:
+                        result = []
+                    byt = 0
                     for gen in self._sync_query(request, qid):
+                        # Only complete results are cached; errors are not
+                        if not isinstance(gen, basestring):
+                            result = None
+                        else:
+                            byt += len(gen)
+                        if result is not None:
+                            if byt > self._query_cache.max_size():
+                                result = None
+                            else:
+                                result.append(gen)
                         yield gen
+                    if result is not None:
+                        self._query_cache.put(cache_key, result, byt)
+                    if cache_status is not None:
+                        stats.collect(0, byt, cache_status)
+                        stats.sendwith()
     # end _query
 
     def _sync_query(self, request, qid):
         # In Sync mode, Keep polling query status until final result is
         # available
         try:
-            self._logger.info("Polling %s for query result" % ("REPLY:" + qid))
+            self._logger.info("Waiting on %s for query result" % ("REPLY:" + qid))
             prg = 0
             done = False
             while not done:
-                gevent.sleep(1)
-                resp = redis_query_status(host='127.0.0.1',
-                                          port=int(
-                                              self._args.redis_query_port),
-                                          redis_password=self._args.redis_password,
-                                          redis_ssl_params=self.default_redis_ssl_params(),
-                                          qid=qid)
+                resp = redis_query_wait(host='127.0.0.1',
+                                        port=int(
+                                            self._args.redis_query_port),
+                                        redis_password=self._args.redis_password,
+                                        redis_ssl_params=self.default_redis_ssl_params(),
+                                        qid=qid, prg=prg,
+                                        timeout=self._QUERY_WAIT_MAX)
 
                 # We want to print progress only if it has changed
                 if int(resp["progress"]) == prg:
@@ -1786,10 +2100,11 @@ class OpServer(object):
             bottle.abort(code, msg)
         queries = {}
         try:
-            redish = StrictRedisWrapper(db=0, host='127.0.0.1',
-                                       port=int(self._args.redis_query_port),
-                                       password=self._args.redis_password,
-                                       **self.default_redis_ssl_params())
+            redish = redis_pools.client('127.0.0.1',
+                                        int(self._args.redis_query_port),
+                                        db=0,
+                                        password=self._args.redis_password,
+                                        ssl_params=self.default_redis_ssl_params())
             pending_queries = redish.lrange('QUERYQ', 0, -1)
             pending_queries_info = []
             for query_id in pending_queries:
@@ -1911,6 +2226,15 @@ class OpServer(object):
         return filters
     # end _uve_http_post_filter_set
 
+    @staticmethod
+    def _uve_json(gen):
+        # UVEs from the UVE cache may already be JSON text
+        if 'json' in gen:
+            return '{"name": %s, "value": %s}' % (json.dumps(gen['name']),
+                                                   gen['json'])
+        return json.dumps(gen)
+    # end _uve_json
+
     @validate_user_token(only_cloud_admin=False)
     def dyn_http_post(self, tables):
         (ok, result) = self._post_common(bottle.request, None)
@@ -1950,11 +2274,12 @@ class OpServer(object):
                         get_resources = False
                     for gen in self._uve_server.multi_uve_get(uve_tbl, True,
                                                               filters,
-                                                              base_url):
+                                                              base_url,
+                                                              True):
                         if user_resources is not None  and 'name' in gen:
                             if not gen['name'] in user_resources:
                                 continue
-                        dp = json.dumps(gen)
+                        dp = OpServer._uve_json(gen)
                         byt += len(dp)
                         if first:
                             yield u'' + dp
@@ -2030,11 +2355,11 @@ class OpServer(object):
             num = 0
             byt = 0
             for gen in self._uve_server.multi_uve_get(uve_tbl, flat,
-                    filters, base_url):
+                    filters, base_url, True):
                 if user_resources is not None and 'name' in gen:
                     if not gen['name'] in user_resources:
                         continue
-                dp = json.dumps(gen)
+                dp = OpServer._uve_json(gen)
                 byt += len(dp)
                 if first:
                     yield u'' + dp
@@ -2437,12 +2762,12 @@ class OpServer(object):
             ulist = self.redis_uve_list
             
             for redis_uve in ulist:
-                redish = StrictRedisWrapper(
+                redish = redis_pools.client(
+                    redis_uve[0],
+                    redis_uve[1],
                     db=1,
-                    host=redis_uve[0],
-                    port=redis_uve[1],
                     password=self._args.redis_password,
-                    **self.redis_ssl_params())
+                    ssl_params=self.redis_ssl_params())
                 try:
                     for key in redish.smembers("NGENERATORS"):
                         source = key.split(':')[0]
@@ -2538,6 +2863,83 @@ class OpServer(object):
         resp.response(req.context())
     # end handle_UVEDbCacheUveRequest
 
+    def handle_UVEDbCacheMemoryRequest(self, req):
+        mem = self._uve_server.get_uvedb_cache_memory()
+        resp = UVEDbCacheMemoryResponse()
+        if mem:
+            resp.uves = mem['uves']
+            resp.types = mem['types']
+            resp.type_entries = mem['type_entries']
+            resp.partition_entries = mem['partition_entries']
+            resp.bytes = mem['bytes']
+            resp.tables = [UVEDbCacheTableMemory(table=table,
+                uves=tmem['uves'], bytes=tmem['bytes']) \
+                for table, tmem in sorted(mem['tables'].iteritems())]
+        resp.response(req.context())
+    # end handle_UVEDbCacheMemoryRequest
+
+    def handle_UVEAttrCacheStatsRequest(self, req):
+        stats = self._uve_server.get_attr_cache_stats()
+        resp = UVEAttrCacheStatsResponse()
+        if stats:
+            resp.entries = stats['entries']
+            resp.size = stats['size']
+            resp.hits = stats['hits']
+            resp.misses = stats['misses']
+        resp.response(req.context())
+    # end handle_UVEAttrCacheStatsRequest
+
+    def handle_QueryCacheStatsRequest(self, req):
+        resp = QueryCacheStatsResponse()
+        if self._query_cache is not None:
+            stats = self._query_cache.stats()
+            resp.entries = stats['entries']
+            resp.size = stats['size']
+            resp.hits = stats['hits']
+            resp.misses = stats['misses']
+            resp.bypasses = stats['bypasses']
+        resp.response(req.context())
+    # end handle_QueryCacheStatsRequest
+
+    def handle_RbacCacheStatsRequest(self, req):
+        resp = RbacCacheStatsResponse(caches=[])
+        if self._vnc_api_client is not None:
+            for name, stats in sorted(
+                    self._vnc_api_client.cache_stats().iteritems()):
+                resp.caches.append(RbacCacheStats(name=name,
+                    size=stats['size'], hits=stats['hits'],
+                    misses=stats['misses']))
+        resp.response(req.context())
+    # end handle_RbacCacheStatsRequest
+
+    def handle_RbacCacheInvalidateRequest(self, req):
+        if self._vnc_api_client is not None:
+            self._vnc_api_client.invalidate_cache(req.token or None)
+        resp = RbacCacheInvalidateResponse()
+        resp.response(req.context())
+    # end handle_RbacCacheInvalidateRequest
+
+    def handle_UVEStreamStatsRequest(self, req):
+        resp = UVEStreamStatsResponse()
+        if self._uve_stream_hub is not None:
+            stats = self._uve_stream_hub.stats()
+            resp.clients = stats['clients']
+            resp.partitions = stats['partitions']
+            resp.uves = stats['uves']
+            resp.wakeups = stats['wakeups']
+            resp.wakeups_per_sec = stats['wakeup_rate']
+        resp.response(req.context())
+    # end handle_UVEStreamStatsRequest
+
+    def handle_RedisPoolStatsRequest(self, req):
+        pools = []
+        for host, port, db, ssl, stats in sorted(redis_pools.stats()):
+            pools.append(RedisPoolStats(endpoint='%s:%d' % (host, port),
+                db=db, ssl=ssl, **stats))
+        resp = RedisPoolStatsResponse(pools=pools)
+        resp.response(req.context())
+    # end handle_RedisPoolStatsRequest
+
     def start_uve_server(self):
         self._uve_server.run()
 
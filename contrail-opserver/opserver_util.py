@@ -346,82 +346,109 @@ class OpServerUtils(object):
                 sname = sattr
         return sname
 
+    _FLATTEN_INT_TYPES = frozenset(['i16', 'i32', 'i64', 'byte',
+                                    'u64', 'u32', 'u16'])
+    _FLATTEN_FLOAT_TYPES = frozenset(['float', 'double'])
+    _FLATTEN_COMPOUND_TYPES = frozenset(['struct', 'list', 'map'])
+
     @staticmethod
-    def uve_attr_flatten(inp):
-        sname = ""
-        if (inp['@type'] == 'struct'):
-            sname = OpServerUtils._get_list_name(inp)
-            if (sname == ""):
-                raise Exception('Struct Parse Error')
-            ret = {}
-            if inp[sname] is None:
-                return ret
-            for k, v in inp[sname].items():
-                ret[k] = OpServerUtils.uve_attr_flatten(v)
-            return ret
-        elif (inp['@type'] == 'list'):
-            sname = OpServerUtils._get_list_name(inp['list'])
-            ret = []
-            if (sname == ""):
-                return ret
-            items = inp['list'][sname]
-            if not isinstance(items, list):
-                items = [items]
-            lst = []
-            for elem in items:
-                if not isinstance(elem, dict):
-                    lst.append(elem)
-                else:
-                    lst_elem = {}
-                    for k, v in elem.items():
-                        lst_elem[k] = OpServerUtils.uve_attr_flatten(v)
-                    lst.append(lst_elem)
-            #ret[sname] = lst
-            ret = lst
-            return ret
-        elif (inp['@type'] == 'map'):
-            fmap = {}
-
-            sname = None
-            for ss in inp['map'].keys():
-                if ss[0] != '@':
-                    if ss != 'element':
-                        sname = ss
-            if sname is None:
-                for idx in range(0,int(inp['map']['@size'])):
-                    m_attr = inp['map']['element'][idx*2]
-                    m_val = str(inp['map']['element'][(idx*2)+1])
-                    fmap[m_attr] = m_val
+    def _uve_basic_attr_flatten(inp):
+        if '#text' not in inp:
+            return None
+        typ = inp['@type']
+        if typ in OpServerUtils._FLATTEN_INT_TYPES:
+            return int(inp['#text'])
+        elif typ in OpServerUtils._FLATTEN_FLOAT_TYPES:
+            return float(inp['#text'])
+        elif typ == 'bool':
+            if inp['#text'] == "false":
+                return False
+            elif inp['#text'] == "true":
+                return True
             else:
-                if not isinstance(inp['map']['element'], list):
-                    inp['map']['element'] = [inp['map']['element']]
-                if not isinstance(inp['map'][sname], list):
-                    inp['map'][sname] = [inp['map'][sname]]
-                for idx in range(0,int(inp['map']['@size'])):
-                    m_attr = inp['map']['element'][idx]
-                    subst = {}
-                    if inp['map'][sname][idx]:
-                        for sk,sv in inp['map'][sname][idx].iteritems():
-                            subst[sk] = OpServerUtils.uve_attr_flatten(sv)
-                    fmap[m_attr] = subst
-            return fmap
+                return inp['#text']
         else:
-            if '#text' not in inp:
-                return None
-            if inp['@type'] in ['i16', 'i32', 'i64', 'byte',
-                                'u64', 'u32', 'u16']:
-                return int(inp['#text'])
-            elif inp['@type'] in ['float', 'double']:
-                return float(inp['#text'])
-            elif inp['@type'] in ['bool']:
-                if inp['#text'] in ["false"]:
-                    return False
-                elif inp['#text'] in ["true"]:
-                    return True
+            return inp['#text']
+
+    @staticmethod
+    def uve_attr_flatten(inp):
+        '''
+        Converts a sandesh attribute, as parsed from its XML, to its
+        value. The attribute is walked with a stack instead of recursion,
+        so that deeply nested attributes do not hit the recursion limit.
+        Each entry of the stack is an attribute still to be converted,
+        with the container and the key to store its value in
+        '''
+        if inp['@type'] not in OpServerUtils._FLATTEN_COMPOUND_TYPES:
+            return OpServerUtils._uve_basic_attr_flatten(inp)
+        compound = OpServerUtils._FLATTEN_COMPOUND_TYPES
+        int_types = OpServerUtils._FLATTEN_INT_TYPES
+        basic_flatten = OpServerUtils._uve_basic_attr_flatten
+        result = [None]
+        stack = [(inp, result, 0)]
+        while stack:
+            attr, parent, pkey = stack.pop()
+            typ = attr['@type']
+            # The members of structs, list elements and map values
+            # to convert, with the dict to store their values in
+            members = []
+            if typ == 'struct':
+                sname = OpServerUtils._get_list_name(attr)
+                if (sname == ""):
+                    raise Exception('Struct Parse Error')
+                ret = {}
+                if attr[sname] is not None:
+                    members.append((attr[sname], ret))
+            elif typ == 'list':
+                sname = OpServerUtils._get_list_name(attr['list'])
+                ret = []
+                if (sname != ""):
+                    items = attr['list'][sname]
+                    if not isinstance(items, list):
+                        items = [items]
+                    for elem in items:
+                        if not isinstance(elem, dict):
+                            ret.append(elem)
+                        else:
+                            lst_elem = {}
+                            ret.append(lst_elem)
+                            members.append((elem, lst_elem))
+            elif typ == 'map':
+                ret = {}
+                amap = attr['map']
+                sname = None
+                for ss in amap.keys():
+                    if ss[0] != '@':
+                        if ss != 'element':
+                            sname = ss
+                if sname is None:
+                    element = amap['element']
+                    for idx in range(0,int(amap['@size'])):
+                        ret[element[idx*2]] = str(element[(idx*2)+1])
                 else:
-                    return inp['#text']
+                    if not isinstance(amap['element'], list):
+                        amap['element'] = [amap['element']]
+                    if not isinstance(amap[sname], list):
+                        amap[sname] = [amap[sname]]
+                    for idx in range(0,int(amap['@size'])):
+                        subst = {}
+                        ret[amap['element'][idx]] = subst
+                        if amap[sname][idx]:
+                            members.append((amap[sname][idx], subst))
             else:
-                return inp['#text']
+                ret = basic_flatten(attr)
+            parent[pkey] = ret
+            for mattrs, mret in members:
+                for k, v in mattrs.iteritems():
+                    vtyp = v['@type']
+                    if vtyp in compound:
+                        stack.append((v, mret, k))
+                    elif vtyp in int_types and '#text' in v:
+                        # Most of the members are counters
+                        mret[k] = int(v['#text'])
+                    else:
+                        mret[k] = basic_flatten(v)
+        return result[0]
 
     @staticmethod
     def utc_timestamp_usec():
@@ -569,11 +596,20 @@ class OpServerUtils(object):
     @staticmethod
     def get_query_result(opserver_ip, opserver_port, qid, user, password,
                          time_out=None, headers=None):
+        # The status request returns as soon as the progress of the
+        # query changes, or after wait_interval seconds
+        wait_interval = 10
         sleep_interval = 0.5
         time_left = time_out
+        prg = 0
         while True:
+            wait = wait_interval
+            if time_out is not None:
+                wait = max(min(wait, time_left), 0)
             url = OpServerUtils.opserver_query_url(
-                opserver_ip, opserver_port) + '/' + qid
+                opserver_ip, opserver_port) + '/' + qid + \
+                '?wait=%s&progress=%d' % (wait, prg)
+            start = time.time()
             resp = OpServerUtils.get_url_http(url, user, password, headers)
             if resp.status_code != 200:
                 yield {}
@@ -583,15 +619,19 @@ class OpServerUtils(object):
                 print 'Error in query processing'
                 return
             elif status['progress'] != 100:
+                elapsed = time.time() - start
+                if status['progress'] == prg and elapsed < sleep_interval:
+                    # The server did not wait for the query to progress
+                    gevent.sleep(sleep_interval - elapsed)
+                    elapsed = sleep_interval
                 if time_out is not None:
                     if time_left > 0:
-                        time_left -= sleep_interval
+                        time_left -= elapsed
                     else:
                         print 'query timed out'
                         yield {}
                         return
-
-                gevent.sleep(sleep_interval)
+                prg = status['progress']
                 continue
             else:
                 for chunk in status['chunks']:
@@ -4,6 +4,7 @@ from gevent import monkey
 monkey.patch_all()
 import logging
 import gevent
+import gevent.queue
 from gevent.lock import BoundedSemaphore
 from kafka import KeyedProducer, KafkaConsumer, common
 from uveserver import UVEServer
@@ -16,15 +17,36 @@ import cfgm_common
 import uuid
 import struct
 import socket
+import sys
 from pysandesh.util import UTCTimestampUsec
 import select
 import redis
 import errno
 import time
-from collections import namedtuple
+import bisect
+import functools
+from collections import namedtuple, OrderedDict
 from strict_redis_wrapper import StrictRedisWrapper
 
 PartInfo = namedtuple("PartInfo",["ip_address","instance_id","redis_agg_db","acq_time","port"])
+PartCheckpoint = namedtuple("PartCheckpoint",["acq_time","offset","collectors","uves"])
+
+class Histogram(object):
+    ''' Counts of recorded values, in buckets with the given upper bounds
+        Values above the last bound are counted in an overflow bucket
+    '''
+    def __init__(self, bounds):
+        self._bounds = list(bounds)
+        self._counts = [0] * (len(self._bounds) + 1)
+
+    def record(self, val):
+        self._counts[bisect.bisect_left(self._bounds, val)] += 1
+
+    def buckets(self):
+        ''' Returns a list of (upper bound, count)
+            The upper bound of the overflow bucket is None
+        '''
+        return zip(self._bounds + [None], self._counts)
 
 def sse_pack(d):
     """Pack data in SSE format"""
@@ -34,16 +56,198 @@ def sse_pack(d):
             buffer += '%s: %s\n' % (k, d[k])
     return buffer + '\n'
 
+UvePerms = namedtuple("UvePerms",["owner","perms","share"])
+
+def parse_uve_perms(cc):
+    """
+    Parse the perms2 field of the decoded ContrailConfig structure cc
+    of a UVE into a UvePerms, for is_uve_perms_read_permitted.
+    Returns None if there is no valid perms2 field
+    """
+    try:
+        perms2 = ast.literal_eval(cc['elements']['perms2'])
+        owner = perms2['owner'].replace('-','')
+        perms = perms2['owner_access'] << 6
+        perms |= perms2['global_access']
+        share = []
+        for item in perms2['share']:
+            (share_type, share_uuid) = cfgm_common.utils.\
+                    shareinfo_from_perms2_tenant(item['tenant'])
+            share.append((share_type, share_uuid.replace('-',''),
+                          item['tenant_access']))
+    except Exception:
+        return None
+    return UvePerms(owner, perms, share)
+# end parse_uve_perms
+
+def is_uve_read_permitted(logger, token, cc):
+    """
+    Check for permissions in the decoded ContrailConfig structure cc
+    of a UVE for the user of the given token
+    """
+    if not token or token['is_global_read_only_role']:
+        return True
+    if cc is None:
+        logger.error("no ContrailConfig structure")
+        return False
+    return is_uve_perms_read_permitted(logger, token, parse_uve_perms(cc))
+# end is_uve_read_permitted
+
+def is_uve_perms_read_permitted(logger, token, uve_perms):
+    """
+    Check for permissions in the UvePerms of a UVE for the user of the
+    given token
+    """
+    if not token or token['is_global_read_only_role']:
+        return True
+    if uve_perms is None:
+        logger.error("no perms2 in ContrailConfig structure")
+        return False
+    token_info = token.get('token_info')
+    perms = uve_perms.perms
+    mask = 07
+    mode = 4
+    if token_info and 'token' in token_info:
+        token = token_info['token']
+        if 'project' in  token.keys():
+            tenant = token['project']['id']
+            tenant = tenant.replace('-','')
+            tenant_name = token['project']['name']
+            domain = token['project']['domain']['id']
+            if tenant == uve_perms.owner:
+                mask |= 0700
+            # grant access if shared with tenant or domain
+            for share_type, share_uuid, tenant_access in uve_perms.share:
+                if ((share_type == 'tenant' and tenant == share_uuid)\
+                         or (share_type == 'domain' and domain == \
+                             share_uuid)):
+                    perms |= tenant_access << 3
+                    mask |= 0070
+                    break
+            mode_mask = mode | mode << 3 | mode << 6
+            ok = (mask & perms & mode_mask)
+            if not ok:
+                logger.error("no permissins for %s" %tenant_name)
+                return False
+            else:
+                return True
+        else:
+            logger.error("no project in token %s" %token)
+    else:
+        logger.error("no token specified %s" %token_info)
+    return False
+# end is_uve_perms_read_permitted
+
+class UveCacheEntry(object):
+    '''
+    The UVE cache only needs to know which partition a UVE came from
+    and which struct types it has; the contents are read from the
+    aggregated UVE redis. The struct type names are interned, so the
+    names are shared by all the entries
+    '''
+    __slots__ = ('partno', 'types')
+
+    def __init__(self, partno):
+        self.partno = partno
+        self.types = ()
+
+    def __contains__(self, typ):
+        return typ in self.types
+
+    def __iter__(self):
+        return iter(self.types)
+
+    def add_type(self, typ):
+        if typ not in self.types:
+            self.types += (typ,)
+
+    def del_type(self, typ):
+        self.types = tuple(t for t in self.types if t != typ)
+
+# end class UveCacheEntry
+
+
+class UveValueCache(object):
+    '''
+    Bounded LRU cache of the aggregated values of UVEs, keyed by
+    (table, barekey). An entry has the decoded struct types of the UVE
+    and the JSON text of the whole UVE, made from the values read from
+    redis. The entry of a UVE is dropped when it is updated; values
+    read from redis while the UVE was being updated are not cached.
+    '''
+    def __init__(self, size):
+        self._size = size
+        self._cache = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        # UVEs invalidated while reads were in progress, with the
+        # epoch of their invalidation
+        self._epoch = 0
+        self._readers = 0
+        self._dirty = {}
+
+    def get(self, ckey):
+        entry = self._cache.pop(ckey, None)
+        if entry is None:
+            self._misses += 1
+            return None
+        # move to the most recently used end
+        self._cache[ckey] = entry
+        self._hits += 1
+        return entry
+
+    def start_read(self):
+        self._readers += 1
+        return self._epoch
+
+    def end_read(self):
+        self._readers -= 1
+        if not self._readers:
+            self._dirty.clear()
+
+    def put(self, ckey, epoch, values, encoded):
+        if self._dirty.get(ckey, 0) > epoch:
+            return
+        self._cache.pop(ckey, None)
+        self._cache[ckey] = (values, encoded)
+        while len(self._cache) > self._size:
+            self._cache.popitem(last=False)
+
+    def invalidate(self, ckey):
+        self._cache.pop(ckey, None)
+        if self._readers:
+            self._epoch += 1
+            self._dirty[ckey] = self._epoch
+
+    def stats(self):
+        return {'size': len(self._cache), 'hits': self._hits,
+                'misses': self._misses}
+
+# end class UveValueCache
+
+
 class UveCacheProcessor(object):
-    def __init__(self, logger, rpass, redis_ssl_params):
+    def __init__(self, logger, rpass, redis_ssl_params,
+                 value_cache_size=10000):
         self._logger = logger
         self._rpass = rpass
         self._redis_ssl_params = redis_ssl_params;
+        # partition -> set of keys
         self._partkeys = {}
+        # struct type -> table -> set of barekeys
         self._typekeys = {}
+        # table -> barekey -> UveCacheEntry. The types of a UVE
+        # are also used to find its entries in _typekeys
         self._uvedb = {} 
+        # partition -> PartInfo the UVEs of the partition came from
+        self._sources = {}
+        # table -> sorted list of barekeys, for kfilt lookups
+        self._sortedkeys = {}
         self._agp = {}
         self._agg_redis_map = {}
+        self._valcache = None
+        if value_cache_size:
+            self._valcache = UveValueCache(value_cache_size)
 
     def _get_agg_redis_instance(self, ip, port, redis_agg_db):
         agg_redis = self._agg_redis_map.get((ip, port, redis_agg_db))
@@ -57,34 +261,106 @@ class UveCacheProcessor(object):
     def update_agp(self, agp):
         self._agp = agp
 
-    def get_cache_list(self, tables, filters, patterns, keysonly):
-        if not tables:
-            tables = self._uvedb.keys()
+    def _add_uve(self, table, barekey, partno):
+        self._uvedb.setdefault(table, {})[barekey] = UveCacheEntry(partno)
+        bisect.insort(self._sortedkeys.setdefault(table, []), barekey)
+
+    def _del_uve(self, table, barekey):
+        if self._valcache:
+            self._valcache.invalidate((table, barekey))
+        # Only the type index entries of the types of this UVE are removed
+        for typ in self._uvedb[table].pop(barekey):
+            ttab = self._typekeys.get(typ, {})
+            tkeys = ttab.get(table)
+            if tkeys is None:
+                continue
+            tkeys.discard(barekey)
+            if not tkeys:
+                del ttab[table]
+                if not ttab:
+                    del self._typekeys[typ]
+        sortedkeys = self._sortedkeys[table]
+        del sortedkeys[bisect.bisect_left(sortedkeys, barekey)]
+
+    @staticmethod
+    def _kfilt_prefix(filt):
+        # kfilt globs are turned into regexes without escaping; the part
+        # of the glob before the first special character is a literal
+        # prefix of all the keys it matches, unless the regex has an
+        # alternation or the special character makes the character
+        # before it optional
+        if '|' in filt:
+            return ''
+        for idx, ch in enumerate(filt):
+            if ch in '?{':
+                return filt[:max(idx - 1, 0)]
+            if ch in '*.^$+}[]\\()':
+                return filt[:idx]
+        return filt
+
+    def _kfilt_candidates(self, table, kfilt):
+        '''
+        Returns the set of barekeys of the table that may match any of
+        the kfilt globs, or None if a glob does not have a literal
+        prefix and every key needs to be matched
+        '''
+        sortedkeys = self._sortedkeys.get(table, [])
+        candidates = set()
+        for filt in kfilt:
+            prefix = self._kfilt_prefix(filt)
+            if not prefix:
+                return None
+            if prefix == filt:
+                if filt in self._uvedb[table]:
+                    candidates.add(filt)
+                continue
+            idx = bisect.bisect_left(sortedkeys, prefix)
+            while idx < len(sortedkeys) and \
+                    sortedkeys[idx].startswith(prefix):
+                candidates.add(sortedkeys[idx])
+                idx += 1
+        return candidates
+
+    def get_cache_list(self, tables, filters, patterns, keysonly,
+                       encoded=False):
         filters = filters or {}
         tfilter = filters.get('cfilt')
         ackfilter = filters.get('ackfilt')
         uve_list = {}
         try:
-            tqual = {}
             tfilter = tfilter or {}
-
-            # Build a per-table set of all keys matching tfilter
-            for typ in tfilter:
-                for table in tables:
-                    if not table in tqual:
-                        tqual[table] = set()
-                    if typ in self._typekeys:
-                        if table in self._typekeys[typ]:
-                            tqual[table].update(self._typekeys[typ][table])
+            kfilt = filters.get('kfilt')
+            if not tables:
+                if len(tfilter) != 0:
+                    # Only the tables with UVEs of the types in tfilter,
+                    # e.g. the tables with alarms
+                    tables = set()
+                    for typ in tfilter:
+                        tables.update(self._typekeys.get(typ, {}))
+                else:
+                    tables = self._uvedb.keys()
 
             for table in tables:
                 if not table in self._uvedb:
                     continue  
+                # Narrow the keys down with the type and key indexes
+                # before matching them
+                candidates = None
+                if kfilt and patterns:
+                    candidates = self._kfilt_candidates(table, kfilt)
+                if len(tfilter) != 0:
+                    tqual = set()
+                    for typ in tfilter:
+                        tqual.update(self._typekeys.get(typ, {}).get(table,
+                                                                     ()))
+                    if candidates is None:
+                        candidates = tqual
+                    else:
+                        candidates &= tqual
+                if candidates is None:
+                    candidates = self._uvedb[table].keys()
                 barekeys = set()
-                for bk in self._uvedb[table].keys():
-                    if len(tfilter) != 0:
-                        if not bk in tqual[table]:
-                            continue
+                for bk in candidates:
                     if patterns:
                         kfilter_match = False
                         for pattern in patterns:
@@ -96,7 +372,7 @@ class UveCacheProcessor(object):
                     barekeys.add(bk)
                     
                 brsp = self._get_uve_content(table, barekeys,\
-                        tfilter, ackfilter, keysonly)
+                        tfilter, ackfilter, keysonly, encoded)
                 if len(brsp) != 0:
                     if keysonly:
                         uve_list[table] = set(brsp.keys())
@@ -109,75 +385,128 @@ class UveCacheProcessor(object):
                               (messag, traceback.format_exc()))
         return uve_list
 
-    def _get_uve_content(self, table, barekeys, tfilter, ackfilter, keysonly):
-        brsp = {}
+    def _read_uve_values(self, table, barekeys, tfilter):
+        '''
+        Returns barekey -> (struct type -> decoded value, JSON text of
+        the UVE or None) for the given UVEs. The values of all the
+        struct types are read and cached, unless the cache is disabled
+        and only the types in tfilter are needed
+        '''
+        uvevals = {}
         uveparts = {}
         for barekey in barekeys:
-            part = self._uvedb[table][barekey]["__SOURCE__"]["partition"]
+            if self._valcache:
+                cached = self._valcache.get((table, barekey))
+                if cached is not None:
+                    uvevals[barekey] = cached
+                    continue
+            part = self._uvedb[table][barekey].partno
             if not part in uveparts:
                 uveparts[part] = set()
             uveparts[part].add(barekey)
-        
-        for pkey,pvalue in uveparts.iteritems():
-            pi = self._agp[pkey]
-            lredis = self._get_agg_redis_instance(pi.ip_address, pi.port, pi.redis_agg_db)
-            ppe = lredis.pipeline()
-            luves = list(uveparts[pkey])
-            for elem in luves:
-                if len(tfilter) != 0:
-                    ltypes = tfilter.keys()
-                    ppe.hmget("AGPARTVALUES:%s:%d:%s:%s" % \
-                        (pi.instance_id, pkey, table, elem),
-                        *ltypes)
-                else:
-                    ppe.hgetall("AGPARTVALUES:%s:%d:%s:%s" % \
-                        (pi.instance_id, pkey, table, elem))
-            pperes = ppe.execute()
-            for uidx in range(0,len(luves)):
-                uvestruct = {}
-                if len(tfilter) != 0:
-                    for tidx in range(0,len(ltypes)):
-                        if not pperes[uidx][tidx]:
-                            continue
-                        afilter_list = tfilter[ltypes[tidx]]
-                        ppeval = json.loads(pperes[uidx][tidx])
-                        if len(afilter_list) == 0:
-                            uvestruct[ltypes[tidx]] = ppeval
-                        else:      
-                            for akey, aval in ppeval.iteritems():
-                                if akey not in afilter_list:
-                                    continue
-                                else:
-                                    if not ltypes[tidx] in uvestruct:
-                                        uvestruct[ltypes[tidx]] = {}
-                                    uvestruct[ltypes[tidx]][akey] = aval
-                else:
+        if not uveparts:
+            return uvevals
+
+        ltypes = None
+        if len(tfilter) != 0 and not self._valcache:
+            ltypes = tfilter.keys()
+        epoch = None
+        if self._valcache:
+            epoch = self._valcache.start_read()
+        try:
+            for pkey,pvalue in uveparts.iteritems():
+                pi = self._agp[pkey]
+                lredis = self._get_agg_redis_instance(pi.ip_address, pi.port, pi.redis_agg_db)
+                ppe = lredis.pipeline()
+                luves = list(pvalue)
+                for elem in luves:
+                    if ltypes is not None:
+                        ppe.hmget("AGPARTVALUES:%s:%d:%s:%s" % \
+                            (pi.instance_id, pkey, table, elem),
+                            *ltypes)
+                    else:
+                        ppe.hgetall("AGPARTVALUES:%s:%d:%s:%s" % \
+                            (pi.instance_id, pkey, table, elem))
+                pperes = ppe.execute()
+                for uidx in range(0,len(luves)):
+                    if ltypes is not None:
+                        uvevals[luves[uidx]] = (dict((ltypes[tidx],
+                            json.loads(pperes[uidx][tidx])) \
+                            for tidx in range(0,len(ltypes)) \
+                            if pperes[uidx][tidx]), None)
+                        continue
+                    values = {}
                     for tk,tv in pperes[uidx].iteritems():
-                        uvestruct[tk] = json.loads(tv)
-
-                if ackfilter is not None:
-                    if "UVEAlarms" in uvestruct and \
-                            "alarms" in uvestruct["UVEAlarms"]:
-                        alarms = []
-                        for alarm in uvestruct["UVEAlarms"]["alarms"]:
-                            ack = "false"
-                            if "ack" in alarm:
-                                if alarm["ack"]:
-                                    ack = "true"
-                                else:
-                                    ack = "false"
-                            if ack == ackfilter:
-                                alarms.append(alarm)
-                        if not len(alarms):
-                            del uvestruct["UVEAlarms"]
-                        else:
-                            uvestruct["UVEAlarms"]["alarms"] = alarms
-
-                if len(uvestruct) != 0: 
-                    if keysonly:
-                        brsp[luves[uidx]] = None
+                        values[tk] = json.loads(tv)
+                    # The values are json already, so the JSON text of
+                    # the UVE does not need them to be encoded again
+                    encoded = '{' + ', '.join(json.dumps(tk) + ': ' + tv \
+                        for tk,tv in pperes[uidx].iteritems()) + '}'
+                    uvevals[luves[uidx]] = (values, encoded)
+                    if self._valcache:
+                        self._valcache.put((table, luves[uidx]), epoch,
+                                           values, encoded)
+        finally:
+            if self._valcache:
+                self._valcache.end_read()
+        return uvevals
+
+    def _get_uve_content(self, table, barekeys, tfilter, ackfilter, keysonly,
+                         encoded=False):
+        '''
+        Returns barekey -> UVE, filtered by tfilter and ackfilter. The
+        values may be shared with the value cache and must not be
+        modified. If encoded is set and there are no filters, the UVEs
+        are returned as JSON text
+        '''
+        brsp = {}
+        uvevals = self._read_uve_values(table, barekeys, tfilter)
+        for barekey, (values, uvejson) in uvevals.iteritems():
+            if len(tfilter) != 0:
+                uvestruct = {}
+                for typ, afilter_list in tfilter.iteritems():
+                    if typ not in values:
+                        continue
+                    if len(afilter_list) == 0:
+                        uvestruct[typ] = values[typ]
+                    else:
+                        for akey, aval in values[typ].iteritems():
+                            if akey not in afilter_list:
+                                continue
+                            else:
+                                if not typ in uvestruct:
+                                    uvestruct[typ] = {}
+                                uvestruct[typ][akey] = aval
+            else:
+                uvestruct = dict(values)
+
+            if ackfilter is not None:
+                if "UVEAlarms" in uvestruct and \
+                        "alarms" in uvestruct["UVEAlarms"]:
+                    alarms = []
+                    for alarm in uvestruct["UVEAlarms"]["alarms"]:
+                        ack = "false"
+                        if "ack" in alarm:
+                            if alarm["ack"]:
+                                ack = "true"
+                            else:
+                                ack = "false"
+                        if ack == ackfilter:
+                            alarms.append(alarm)
+                    if not len(alarms):
+                        del uvestruct["UVEAlarms"]
                     else:
-                        brsp[luves[uidx]] = uvestruct
+                        uvestruct["UVEAlarms"] = \
+                            dict(uvestruct["UVEAlarms"], alarms=alarms)
+
+            if len(uvestruct) != 0: 
+                if keysonly:
+                    brsp[barekey] = None
+                elif encoded and uvejson is not None and \
+                        len(tfilter) == 0 and ackfilter is None:
+                    brsp[barekey] = uvejson
+                else:
+                    brsp[barekey] = uvestruct
         return brsp
       
     def get_cache_uve(self, key, filters):
@@ -208,52 +537,63 @@ class UveCacheProcessor(object):
                               (messag, traceback.format_exc()))
         return rsp
 
+    @staticmethod
+    def _compact_key(key):
+        # Keys decoded from json are unicode, which takes up to 4 bytes
+        # per character
+        if isinstance(key, unicode):
+            try:
+                return key.encode('ascii')
+            except UnicodeEncodeError:
+                pass
+        return key
+
     def store_uve(self, partno, pi, key, typ, value):
-        barekey = key.split(":",1)[1]
-        table = key.split(":",1)[0]
+        key = self._compact_key(key)
+        table, barekey = key.split(":",1)
+        table = intern(str(table))
 
         if partno not in self._partkeys:
             self._partkeys[partno] = set()
 
         self._partkeys[partno].add(key)
+        self._sources[partno] = pi
 
-        if table not in self._uvedb:
-            self._uvedb[table] = {}
-        if barekey not in self._uvedb[table]:
-            self._uvedb[table][barekey] = {}
+        entry = self._uvedb.get(table, {}).get(barekey)
+        if entry is None:
+            self._add_uve(table, barekey, partno)
+            entry = self._uvedb[table][barekey]
+        else:
+            # Use the barekey object already in the cache, so that all
+            # the indexes share one copy of it
+            sortedkeys = self._sortedkeys[table]
+            barekey = sortedkeys[bisect.bisect_left(sortedkeys, barekey)]
+            if self._valcache:
+                self._valcache.invalidate((table, barekey))
+        entry.partno = partno
 
         if typ is None:
             # delete the entire UVE
             self._partkeys[partno].remove("%s:%s" % \
                 (table, barekey))
-            for typ1 in self._typekeys.keys():
-                if table in self._typekeys[typ1]:
-                    if barekey in self._typekeys[typ1][table]:
-                        self._typekeys[typ1][table].remove(barekey)
-                    if len(self._typekeys[typ1][table]) == 0:
-                        del self._typekeys[typ1][table]
-            del self._uvedb[table][barekey]
+            self._del_uve(table, barekey)
         else:
+            typ = intern(str(typ))
             if not typ in self._typekeys:
                 self._typekeys[typ] = {}
-            if not typ in self._uvedb[table][barekey]:
-                self._uvedb[table][barekey][typ] = None
             if value is None:
                 # remove one type of this UVE
-                del self._uvedb[table][barekey][typ]
+                entry.del_type(typ)
                 if table in self._typekeys[typ]:
                     if barekey in self._typekeys[typ][table]:
                         self._typekeys[typ][table].remove(barekey)
                     if len(self._typekeys[typ][table]) == 0:
                         del self._typekeys[typ][table]
             else:
-                self._uvedb[table][barekey][typ] = value
+                entry.add_type(typ)
                 if not table in self._typekeys[typ]:
                     self._typekeys[typ][table] = set()
                 self._typekeys[typ][table].add(barekey)
-            self._uvedb[table][barekey]["__SOURCE__"] = \
-                    {'instance_id':pi.instance_id, 'ip_address':pi.ip_address, \
-                     'partition':partno}
 
     def clear_partition(self, partno, clear_cb):
 
@@ -265,19 +605,10 @@ class UveCacheProcessor(object):
             barekey = key.split(":",1)[1]
             table = key.split(":",1)[0]
 
-            del self._uvedb[table][barekey]
-            
-            # Look in the "types" index and remove this UVE
-            for tkey in self._typekeys.keys():
-                if table in self._typekeys[tkey]:
-                    if barekey in self._typekeys[tkey][table]:
-                        self._typekeys[tkey][table].remove(barekey)
-                        if len(self._typekeys[tkey][table]) == 0:
-                            del self._typekeys[tkey][table]
-                        if len(self._typekeys[tkey]) == 0:
-                            del self._typekeys[tkey]
+            self._del_uve(table, barekey)
             clear_cb(key) 
         self._partkeys[partno] = set()
+        self._sources.pop(partno, None)
 
     def get_uvedb_cache_tables(self):
         return self._uvedb.keys()
@@ -292,21 +623,70 @@ class UveCacheProcessor(object):
 
     def get_uvedb_cache_uve(self, table, uve_key):
         try:
-            return self._uvedb[table][uve_key]
+            entry = self._uvedb[table][uve_key]
         except KeyError:
             return None
+        uve = dict.fromkeys(entry.types)
+        pi = self._sources.get(entry.partno)
+        uve['__SOURCE__'] = {'instance_id': getattr(pi, 'instance_id', None),
+                             'ip_address': getattr(pi, 'ip_address', None),
+                             'partition': entry.partno}
+        return uve
     # end get_uvedb_cache_uve
 
+    def get_uvedb_cache_memory(self):
+        '''
+        Returns the number of UVEs, struct types and index entries in
+        the cache, and an estimate of the memory used by them, in bytes.
+        Walks all the UVEs, so it should only be used for introspect
+        '''
+        tables = {}
+        uves = 0
+        for table, tuves in self._uvedb.iteritems():
+            tbytes = sys.getsizeof(tuves) + \
+                sys.getsizeof(self._sortedkeys.get(table, []))
+            for barekey, entry in tuves.iteritems():
+                tbytes += sys.getsizeof(barekey) + sys.getsizeof(entry) + \
+                    sys.getsizeof(entry.types)
+            tables[table] = {'uves': len(tuves), 'bytes': tbytes}
+            uves += len(tuves)
+        type_entries = 0
+        type_bytes = sys.getsizeof(self._typekeys)
+        for ttab in self._typekeys.itervalues():
+            type_bytes += sys.getsizeof(ttab)
+            for tkeys in ttab.itervalues():
+                type_entries += len(tkeys)
+                type_bytes += sys.getsizeof(tkeys)
+        part_entries = 0
+        part_bytes = sys.getsizeof(self._partkeys)
+        for pkeys in self._partkeys.itervalues():
+            part_entries += len(pkeys)
+            part_bytes += sys.getsizeof(pkeys)
+            for key in pkeys:
+                part_bytes += sys.getsizeof(key)
+        return {'uves': uves,
+                'types': len(self._typekeys),
+                'type_entries': type_entries,
+                'partition_entries': part_entries,
+                'bytes': sum(t['bytes'] for t in tables.itervalues()) + \
+                    type_bytes + part_bytes,
+                'tables': tables}
+    # end get_uvedb_cache_memory
+
 
 # end class UveCacheProcessor
 
 
 class UveStreamPart(gevent.Greenlet):
     def __init__(self, partno, logger, cb, pi, rpass, redis_ssl_params, content = True, 
-                tablefilt = None, cfilter = None, patterns = None, token = None):
+                tablefilt = None, cfilter = None, patterns = None, token = None,
+                listen_timeout = 5, sync_cb = None):
         gevent.Greenlet.__init__(self)
         self._logger = logger
         self._cb = cb
+        # Called with (partno, True) before and (partno, False) after
+        # the UVEs of the partition are reported by syncpart
+        self._sync_cb = sync_cb
         self._pi = pi
         self._partno = partno
         # We need to keep track of UVE contents only for streaming case
@@ -325,56 +705,32 @@ class UveStreamPart(gevent.Greenlet):
         if token and 'token_info' in token:
             self._token_info = token['token_info']
         self._uvecache = {}
+        # The decision of is_uve_read_permitted for every UVE key, with
+        # the ContrailConfig it was made for
+        self._permcache = {}
+        self._listen_timeout = listen_timeout
+        self._wakeups = 0
+
+    def wakeups(self):
+        return self._wakeups
 
-    def is_uve_read_permitted(self, uves):
+    def is_uve_read_permitted(self, key, uves):
         """
         Check for permissions in ContrailConfig structure for given user
         """
         if not self._token or self._token['is_global_read_only_role']:
             return True
-        if "ContrailConfig" in uves.keys():
-            cc = json.loads(uves["ContrailConfig"])
-            perms2 = ast.literal_eval(cc['elements']['perms2'])
-            owner = perms2['owner'].replace('-','')
-            perms = perms2['owner_access'] << 6
-            perms |= perms2['global_access']
-            mask = 07
-            mode = 4
-            share = perms2['share']
-            if 'token' in self._token_info:
-                token = self._token_info['token']
-                if 'project' in  token.keys():
-                    tenant = token['project']['id']
-                    tenant = tenant.replace('-','')
-                    tenant_name = token['project']['name']
-                    domain = token['project']['domain']['id']
-                    if tenant == owner:
-                        mask |= 0700
-                    # grant access if shared with tenant or domain
-                    for item in share:
-                        (share_type, share_uuid) = cfgm_common.utils.\
-                                shareinfo_from_perms2_tenant(item['tenant'])
-                        share_uuid = share_uuid.replace('-','')
-                        if ((share_type == 'tenant' and tenant == share_uuid)\
-                                 or (share_type == 'domain' and domain == \
-                                     share_uuid)):
-                            perms |= item['tenant_access'] << 3
-                            mask |= 0070
-                            break
-                    mode_mask = mode | mode << 3 | mode << 6
-                    ok = (mask & perms & mode_mask)
-                    if not ok:
-                        self._logger.error("no permissins for %s" %tenant_name)
-                        return False
-                    else:
-                        return True
-                else:
-                    self._logger.error("no project in token %s" %token)
-            else:
-                self._logger.error("no token specified %s" %self._token_info)
-        else:
+        ccjson = uves.get("ContrailConfig")
+        if ccjson is None:
             self._logger.error("no ContrailConfig structure %s" %uves.keys())
-        return False
+            return False
+        cached = self._permcache.get(key)
+        if cached is not None and cached[0] == ccjson:
+            return cached[1]
+        permitted = is_uve_read_permitted(self._logger, self._token,
+                                          json.loads(ccjson))
+        self._permcache[key] = (ccjson, permitted)
+        return permitted
     # end is_uve_read_permitted
 
     def syncpart(self, redish):
@@ -410,7 +766,7 @@ class UveStreamPart(gevent.Greenlet):
         for res in pperes:
             if self._content:
                 if self._token is not None:
-                    if not self.is_uve_read_permitted(res):
+                    if not self.is_uve_read_permitted(lkeys[idx], res):
                         idx += 1
                         continue
                 for tk,tv in res.iteritems():
@@ -449,11 +805,19 @@ class UveStreamPart(gevent.Greenlet):
                 inst = self._pi.instance_id
                 part = self._partno
                 pb.subscribe('AGPARTPUB:%s:%d' % (inst, part))
-                self.syncpart(lredis)
+                if self._sync_cb:
+                    self._sync_cb(self._partno, True)
+                try:
+                    self.syncpart(lredis)
+                finally:
+                    if self._sync_cb:
+                        self._sync_cb(self._partno, False)
                 while True:
-                    message = pb.get_message()
+                    # Wait on the socket for the next message; an idle
+                    # partition only wakes up once per listen_timeout
+                    message = pb.get_message(timeout=self._listen_timeout)
+                    self._wakeups += 1
                     if not message:
-                        gevent.sleep(0.001)
                         continue
                     if message["type"] != "message":
                         gevent.sleep(0)
@@ -525,11 +889,14 @@ class UveStreamPart(gevent.Greenlet):
                                     self._uvecache[key][typ] = vjson
                                 if self._token is not None:
                                     if not self.is_uve_read_permitted(\
-                                            self._uvecache[key]):
+                                            key, self._uvecache[key]):
+                                        idx += 1
                                         gevent.sleep(0)
                                         continue
                             else:
                                 vdata = {}
+                        else:
+                            self._permcache.pop(key, None)
                         self._cb(self._partno, self._pi, key, typ, vdata)
                         idx += 1
                     gevent.sleep(0)
@@ -566,7 +933,7 @@ class UveStreamPart(gevent.Greenlet):
 class UveStreamer(gevent.Greenlet):
     def __init__(self, logger, q, rfile, agp_cb, rpass, redis_ssl_params, \
             tablefilt = None, cfilter = None, patterns = None,
-            USP_class = UveStreamPart, token=None):
+            USP_class = UveStreamPart, token=None, value_cache_size=10000):
         gevent.Greenlet.__init__(self)
         self._logger = logger
         self._q = q
@@ -577,7 +944,12 @@ class UveStreamer(gevent.Greenlet):
         self._rpass = rpass
         self._redis_ssl_params = redis_ssl_params
         self._ccb = None
-        self._uvedbcache = UveCacheProcessor(self._logger, rpass, redis_ssl_params)
+        # The updates of the struct types not in cfilter are not
+        # streamed, so their values cannot be cached
+        if cfilter:
+            value_cache_size = 0
+        self._uvedbcache = UveCacheProcessor(self._logger, rpass,
+            redis_ssl_params, value_cache_size)
         self._USP_class = USP_class
         self._tablefilt = tablefilt
         self._cfilter = cfilter
@@ -587,8 +959,10 @@ class UveStreamer(gevent.Greenlet):
     def get_uve(self, key, filters=None):
         return False, self._uvedbcache.get_cache_uve(key, filters)
 
-    def get_uve_list(self, utab, filters, patterns, keysonly = True):
-        return self._uvedbcache.get_cache_list(utab, filters, patterns, keysonly)
+    def get_uve_list(self, utab, filters, patterns, keysonly = True,
+                     encoded = False):
+        return self._uvedbcache.get_cache_list(utab, filters, patterns,
+                                               keysonly, encoded)
 
     def get_uvedb_cache_tables(self):
         return self._uvedbcache.get_uvedb_cache_tables()
@@ -602,6 +976,10 @@ class UveStreamer(gevent.Greenlet):
         return self._uvedbcache.get_uvedb_cache_uve(table, uve_key)
     # end get_uvedb_cache_uve
 
+    def get_uvedb_cache_memory(self):
+        return self._uvedbcache.get_uvedb_cache_memory()
+    # end get_uvedb_cache_memory
+
     def clear_callback(self, key):
         if self._q:
             dt = {'key':key, 'type':None}
@@ -691,9 +1069,370 @@ class UveStreamer(gevent.Greenlet):
         self._parts[partno].kill()
         del self._parts[partno]
 
+class UveStreamClient(gevent.Greenlet):
+    '''
+    One client of the UveStreamHub, i.e. one SSE request on
+    /analytics/uve-stream or /analytics/alarm-stream.
+    The hub puts the updates that pass this client's filters into a
+    bounded queue. A client that falls behind by more than qsize
+    updates is disconnected, and can reconnect to get a fresh snapshot.
+    The UVEs of a partition that is synced or cleared are queued as a
+    single callable, which generates their messages when it is read.
+    '''
+    def __init__(self, logger, hub, rfile, tablefilt = None, cfilter = None,
+            patterns = None, token = None, qsize = 10000):
+        gevent.Greenlet.__init__(self)
+        self._logger = logger
+        self._hub = hub
+        self._rfile = rfile
+        self._tablefilt = None
+        if tablefilt:
+            self._tablefilt = set(tablefilt)
+        self._cfilter = None
+        if cfilter:
+            self._cfilter = set(cfilter.keys())
+        self._patterns = patterns
+        self._token = token
+        # The decision of is_uve_read_permitted for every UVE key, with
+        # the UvePerms it was made for
+        self._permcache = {}
+        # The queue is bounded by put, so that close can always
+        # append the stop event
+        self._q = gevent.queue.Queue()
+        self._qsize = qsize
+        self._ccb = None
+        self._closed = False
+
+    def is_key_wanted(self, key):
+        table, barekey = key.split(":",1)
+        if self._tablefilt:
+            if not table in self._tablefilt:
+                return False
+        if self._patterns:
+            kfilter_match = False
+            for pattern in self._patterns:
+                if pattern.match(barekey):
+                    kfilter_match = True
+                    break
+            if not kfilter_match:
+                return False
+        return True
+
+    def is_type_wanted(self, typ):
+        if self._cfilter:
+            if typ not in self._cfilter:
+                return False
+        return True
+
+    def is_uve_read_permitted(self, key, uve_perms):
+        if not self._token or self._token['is_global_read_only_role']:
+            return True
+        cached = self._permcache.get(key)
+        if cached is not None and cached[0] is uve_perms:
+            return cached[1]
+        permitted = is_uve_perms_read_permitted(self._logger, self._token,
+                                                uve_perms)
+        self._permcache[key] = (uve_perms, permitted)
+        return permitted
+
+    def put(self, msg):
+        if self._closed:
+            return
+        if self._q.qsize() >= self._qsize:
+            self._logger.error("UVE stream client queue full, disconnecting")
+            self.close()
+            return
+        self._q.put(msg)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._hub.unsubscribe(self)
+        # Drop whatever is pending; the client will resync on reconnect
+        while not self._q.empty():
+            self._q.get_nowait()
+        msg = {'event': 'stop', 'data':json.dumps(None)}
+        self._q.put(sse_pack(msg))
+        self._q.put(StopIteration)
+
+    def stream(self):
+        '''
+        Generator for the SSE response body: the init event, the
+        current contents of the hub, and then the live updates.
+        '''
+        self._hub.subscribe(self)
+        try:
+            msg = {'event': 'init', 'data':json.dumps(None)}
+            yield sse_pack(msg)
+            for msg in self._hub.snapshot(self):
+                if self._closed:
+                    break
+                yield msg
+            for msg in self._q:
+                if isinstance(msg, basestring):
+                    yield msg
+                    continue
+                for pmsg in msg():
+                    if self._closed:
+                        break
+                    yield pmsg
+        finally:
+            self.close()
+
+    def set_cleanup_callback(self, cb):
+        self._ccb = cb
+
+    def _run(self):
+        inputs = [ self._rfile ]
+        outputs = [ ]
+        while not self._closed:
+            try:
+                if self._rfile is not None:
+                    readable, writable, exceptional = \
+                        select.select(inputs, outputs, inputs, 1)
+                    if (readable or writable or exceptional):
+                        break
+                else:
+                    gevent.sleep(1)
+            except gevent.GreenletExit:
+                break
+        self.close()
+        if callable(self._ccb):
+            self._ccb(self) #remove myself
+
+# end class UveStreamClient
+
+
+class UveStreamHub(gevent.Greenlet):
+    '''
+    Process-wide fan-out of aggregated UVE updates to stream clients.
+    Each partition is subscribed to once, and one snapshot of the
+    UVE contents is shared by all the clients. Partitions are only
+    subscribed to while there are clients.
+    '''
+    def __init__(self, logger, agp_cb, rpass, redis_ssl_params,
+            USP_class = UveStreamPart, qsize = 10000):
+        gevent.Greenlet.__init__(self)
+        self._logger = logger
+        self._agp_cb = agp_cb
+        self._agp = {}
+        self._parts = {}
+        self._rpass = rpass
+        self._redis_ssl_params = redis_ssl_params
+        self._USP_class = USP_class
+        self._qsize = qsize
+        self._clients = set()
+        self._uves = {}
+        # The parsed permissions of the UVEs with ContrailConfig
+        self._perms = {}
+        self._partkeys = {}
+        # Partitions that are reporting all their UVEs
+        self._syncing = set()
+        # wakeups of partitions that have been stopped
+        self._wakeups = 0
+        self._stats_time = None
+        self._stats_wakeups = 0
+
+    def client(self, rfile, tablefilt = None, cfilter = None,
+            patterns = None, token = None):
+        return UveStreamClient(self._logger, self, rfile, tablefilt, cfilter,
+            patterns, token, self._qsize)
+
+    def subscribe(self, client):
+        self._clients.add(client)
+        # Start the partitions right away for the first client
+        if len(self._clients) == 1:
+            self._update_partitions()
+
+    def unsubscribe(self, client):
+        self._clients.discard(client)
+
+    def stats(self):
+        # The wakeup rate is measured since the previous call
+        wakeups = self._wakeups
+        for part in self._parts.values():
+            wakeups += part.wakeups()
+        now = time.time()
+        rate = 0.0
+        if self._stats_time is not None and now > self._stats_time:
+            rate = (wakeups - self._stats_wakeups) / \
+                (now - self._stats_time)
+        self._stats_time = now
+        self._stats_wakeups = wakeups
+        return {'clients': len(self._clients), 'partitions': len(self._parts),
+                'uves': len(self._uves), 'wakeups': wakeups,
+                'wakeup_rate': max(rate, 0.0)}
+
+    def snapshot(self, client, partno=None):
+        '''
+        Generator of update messages for the current UVE contents, or
+        the UVEs of the given partition, that pass the filters of the
+        given client
+        '''
+        # The contents may change while the messages are being sent;
+        # such changes are also queued for the client, so the client
+        # always ends up with the latest values.
+        if partno is None:
+            keys = self._uves.keys()
+        else:
+            keys = list(self._partkeys.get(partno, ()))
+        for key in keys:
+            if not client.is_key_wanted(key):
+                continue
+            uve = self._uves.get(key)
+            if not uve:
+                continue
+            if not client.is_uve_read_permitted(key, self._perms.get(key)):
+                continue
+            for typ, value in uve.items():
+                if not client.is_type_wanted(typ):
+                    continue
+                dt = {'key':key, 'type':typ, 'value':value}
+                msg = {'event': 'update', 'data':json.dumps(dt)}
+                yield sse_pack(msg)
+
+    def _deletes(self, client, keys):
+        '''
+        Generator of delete messages for the given UVE keys that pass
+        the key filters of the given client
+        '''
+        for key in keys:
+            if not client.is_key_wanted(key):
+                continue
+            dt = {'key':key, 'type':None}
+            yield sse_pack({'event': 'update', 'data':json.dumps(dt)})
+
+    def _fanout(self, key, typ, value):
+        msg = None
+        uve_perms = self._perms.get(key)
+        for client in list(self._clients):
+            if not client.is_key_wanted(key):
+                continue
+            if not client.is_type_wanted(typ):
+                continue
+            if typ is not None and \
+                    not client.is_uve_read_permitted(key, uve_perms):
+                continue
+            # Encode the update only once for all the clients
+            if msg is None:
+                dt = {'key':key, 'type':typ}
+                if not typ is None:
+                    dt['value'] = value
+                msg = sse_pack({'event': 'update', 'data':json.dumps(dt)})
+            client.put(msg)
+
+    def partition_callback(self, partition, pi, key, typ, value):
+        # gevent is non-premptive; we don't need locks
+        if typ is None:
+            # delete the entire UVE
+            self._uves.pop(key, None)
+            self._perms.pop(key, None)
+            self._partkeys.get(partition, set()).discard(key)
+        elif value is None:
+            # remove one type of this UVE
+            uve = self._uves.get(key)
+            if uve is not None:
+                uve.pop(typ, None)
+                if not uve:
+                    del self._uves[key]
+                    self._partkeys.get(partition, set()).discard(key)
+            if typ == 'ContrailConfig':
+                self._perms.pop(key, None)
+        else:
+            self._uves.setdefault(key, {})[typ] = value
+            self._partkeys.setdefault(partition, set()).add(key)
+            # Parse the permissions once, for all the clients
+            if typ == 'ContrailConfig':
+                self._perms[key] = parse_uve_perms(value)
+        if partition not in self._syncing:
+            self._fanout(key, typ, value)
+
+    def partition_sync(self, partition, syncing):
+        '''
+        A partition reports all its UVEs when it (re)starts. These are
+        not fanned out one by one, which would overflow the queues of
+        the clients; the clients read the UVEs of the partition from
+        the hub once the sync is done
+        '''
+        if syncing:
+            self._syncing.add(partition)
+            return
+        self._syncing.discard(partition)
+        for client in list(self._clients):
+            client.put(functools.partial(self.snapshot, client, partition))
+
+    def clear_partition(self, partno):
+        keys = self._partkeys.pop(partno, set())
+        for key in keys:
+            self._uves.pop(key, None)
+            self._perms.pop(key, None)
+        if not keys:
+            return
+        # The deletes are queued as one entry per client, like a sync
+        for client in list(self._clients):
+            client.put(functools.partial(self._deletes, client, keys))
+
+    def _update_partitions(self):
+        if self._clients:
+            newagp = self._agp_cb()
+        else:
+            newagp = {}
+        set_new, set_old = set(newagp.keys()), set(self._agp.keys())
+        intersect = set_new.intersection(set_old)
+        # deleted parts
+        for elem in set_old - intersect:
+            self.partition_stop(elem)
+            self.clear_partition(elem)
+        # new parts
+        for elem in set_new - intersect:
+            self.clear_partition(elem)
+            self.partition_start(elem, newagp[elem])
+        # changed parts
+        for elem in intersect:
+            if self._agp[elem] != newagp[elem]:
+                self.partition_stop(elem)
+                self.clear_partition(elem)
+                self.partition_start(elem, newagp[elem])
+        self._agp = copy.deepcopy(newagp)
+
+    def _run(self):
+        self._logger.error("Starting UveStreamHub")
+        while True:
+            try:
+                gevent.sleep(1)
+                self._update_partitions()
+            except gevent.GreenletExit:
+                break
+        self._logger.error("Stopping UveStreamHub")
+        for client in list(self._clients):
+            client.close()
+        for part in self._agp.keys():
+            self.partition_stop(part)
+            self.clear_partition(part)
+        self._agp = {}
+
+    def partition_start(self, partno, pi):
+        self._logger.error("Starting shared agguve part %d using %s" % \
+            (partno, pi))
+        self._parts[partno] = self._USP_class(partno, self._logger,
+            self.partition_callback, pi, self._rpass, self._redis_ssl_params,
+            True, None, None, None, None, sync_cb=self.partition_sync)
+        self._parts[partno].start()
+
+    def partition_stop(self, partno):
+        self._logger.error("Stopping shared agguve part %d" % partno)
+        self._wakeups += self._parts[partno].wakeups()
+        self._parts[partno].kill()
+        del self._parts[partno]
+        self._syncing.discard(partno)
+
+# end class UveStreamHub
+
+
 class PartitionHandler(gevent.Greenlet):
     def __init__(self, brokers, group, topic, logger, limit, kafka_use_ssl,
-                 kafka_ssl_params):
+                 kafka_ssl_params, poll_max_wait=500):
         gevent.Greenlet.__init__(self)
         self._brokers = brokers
         self._group = group
@@ -706,10 +1445,46 @@ class PartitionHandler(gevent.Greenlet):
         self._failed = False
         self._kafka_use_ssl = kafka_use_ssl
         self._kafka_ssl_params = kafka_ssl_params
+        # msec a poll waits for messages
+        self._poll_max_wait = poll_max_wait
+        # Seconds between resource checks
+        self._rsc_interval = 1
+        self._polls = 0
+        self._empty_polls = 0
+        self._resource_checks = 0
+        self._lag = 0
+        self._max_lag = 0
+        # Messages between the last consumed one and the end of partition
+        self._lag_hist = Histogram([0, 10, 100, 1000, 10000, 100000])
+        # msec taken by the polls that returned messages
+        self._poll_hist = Histogram([1, 5, 10, 50, 100, 500, 1000])
 
     def failed(self):
         return self._failed
 
+    def offset(self):
+        return self._partoffset
+
+    def consume_stats(self):
+        return {"polls": self._polls,
+                "empty_polls": self._empty_polls,
+                "resource_checks": self._resource_checks,
+                "lag": self._lag,
+                "max_lag": self._max_lag,
+                "lag_histogram": self._lag_hist.buckets(),
+                "poll_latency_histogram": self._poll_hist.buckets()}
+
+    def record_lag(self, consumer, tp):
+        highwater = consumer.highwater(tp)
+        if highwater is None:
+            return
+        self._lag = max(int(highwater) - self._partoffset - 1, 0)
+        self._max_lag = max(self._lag, self._max_lag)
+        self._lag_hist.record(self._lag)
+
+    def seek_position(self, consumer, tp):
+        pass
+
     def resource_check(self):
         self._logger.info("%s Resource check" % self._topic)
 
@@ -740,7 +1515,8 @@ class PartitionHandler(gevent.Greenlet):
                              security_protocol='SSL',
                              ssl_check_hostname=False,
                              **self._kafka_ssl_params)
-                    consumer.assign([common.TopicPartition(self._topic,0)])
+                    tp = common.TopicPartition(self._topic,0)
+                    consumer.assign([tp])
                 except Exception as ex:
                     self.part_cur_time = time.time()
                     if self.part_prev_time == 0 or self.part_cur_time - self.part_prev_time > 60:
@@ -756,17 +1532,27 @@ class PartitionHandler(gevent.Greenlet):
                     self._failed = True
                     raise RuntimeError(messag)
 
+                self.seek_position(consumer, tp)
+                self._partoffset = int(consumer.position(tp)) - 1
                 self._logger.error("Starting %s at position %d" % \
-                        (self._topic, consumer.position(common.TopicPartition(self._topic,0))))
+                        (self._topic, self._partoffset + 1))
 
                 if self._limit:
                     raise gevent.GreenletExit
 
+                last_rsc = 0
                 while True:
                     try:
-                        mdict = consumer.poll()
-                        self.resource_check()
+                        prev = time.time()
+                        mdict = consumer.poll(timeout_ms=self._poll_max_wait)
+                        curr = time.time()
+                        self._polls += 1
+                        if curr - last_rsc >= self._rsc_interval:
+                            self.resource_check()
+                            self._resource_checks += 1
+                            last_rsc = curr
                         if len(mdict):
+                            self._poll_hist.record((curr - prev) * 1000)
                             counts = {}
                             for tp,tv in mdict.iteritems():
                                 if tp not in counts:
@@ -775,9 +1561,10 @@ class PartitionHandler(gevent.Greenlet):
                                 if not self.msg_handler(tv):
                                     raise gevent.GreenletExit
                                 pcount += len(tv)
+                            self.record_lag(consumer, tp)
                             self._logger.debug("poll for topic %s : %s" % (self._topic, str(counts)))
                         else:
-                            gevent.sleep(0.5)
+                            self._empty_polls += 1
 
                     except TypeError as ex:
                         self._logger.error("Type Error: %s trace %s" % \
@@ -828,11 +1615,14 @@ class UveStreamProc(PartitionHandler):
     #              and get sync contents for new collectors
     #  aginst    : instance_id of alarmgen
     #  rport     : redis server port
+    #  checkpoint: PartCheckpoint to resume from, if any
+    #  poll_max_wait : msec a kafka poll waits for messages
     def __init__(self, brokers, partition, uve_topic, logger, callback,
             host_ip, rsc, aginst, rport, kafka_use_ssl, kafka_ssl_params,
-            group="-workers"):
+            group="-workers", checkpoint=None, poll_max_wait=500):
         super(UveStreamProc, self).__init__(brokers, group,
-            uve_topic, logger, False, kafka_use_ssl, kafka_ssl_params)
+            uve_topic, logger, False, kafka_use_ssl, kafka_ssl_params,
+            poll_max_wait)
         self._uvedb = {}
         self._uvein = {}
         self._callback = callback
@@ -846,6 +1636,10 @@ class UveStreamProc(PartitionHandler):
         self._acq_time = UTCTimestampUsec()
         self._up = True
         self._rport = rport
+        self._checkpoint = checkpoint
+        self._resumed = False
+        if checkpoint:
+            self._acq_time = checkpoint.acq_time
 
     def reset_acq_time(self):
         self._acq_time = UTCTimestampUsec()
@@ -853,6 +1647,28 @@ class UveStreamProc(PartitionHandler):
     def acq_time(self):
         return self._acq_time
 
+    def seek_position(self, consumer, tp):
+        '''
+        When resuming from a checkpoint, start consuming from the
+        checkpointed offset if the topic still has it
+        '''
+        if self._checkpoint is None:
+            return
+        self._resumed = False
+        offset = self._checkpoint.offset
+        consumer.seek_to_beginning(tp)
+        first = consumer.position(tp)
+        consumer.seek_to_end(tp)
+        last = consumer.position(tp)
+        if first <= offset <= last:
+            consumer.seek(tp, offset)
+            self._resumed = True
+            self._logger.error("Part %d resuming at offset %d" % \
+                    (self._partno, offset))
+        else:
+            self._logger.error("Part %d cannot resume at offset %d, "
+                    "topic has %d-%d" % (self._partno, offset, first, last))
+
     def resource_check(self):
         '''
         This function compares the known collectors with the
@@ -903,7 +1719,12 @@ class UveStreamProc(PartitionHandler):
     def start_partition(self, cbdb):
         ''' This function loads the initial UVE database.
             for the partition
+            When resuming from a checkpoint, only the UVEs that were
+            added or removed since the checkpoint are reported; changes
+            to the other UVEs are replayed from kafka.
         '''
+        ckpt = self._checkpoint
+        self._checkpoint = None
         self._up = True
         self._logger.error("Starting part %d collectors %s" % \
                 (self._partno, str(cbdb.keys())))
@@ -932,6 +1753,15 @@ class UveStreamProc(PartitionHandler):
                     
         self._logger.error("Starting part %d UVEs %d" % \
                            (self._partno, len(uves)))
+        if ckpt is not None:
+            if self._resumed and set(cbdb.keys()) == set(ckpt.collectors):
+                uves = dict.fromkeys(set(uves.keys()) ^ ckpt.uves)
+                self._logger.error("Resumed part %d, UVEs changed %d" % \
+                                   (self._partno, len(uves)))
+            else:
+                # Refresh all UVEs, including the ones that are gone
+                for kk in ckpt.uves:
+                    uves[kk] = None
         self._callback(self._partno, uves)
 
     def contents(self):
@@ -948,54 +1778,68 @@ class UveStreamProc(PartitionHandler):
         return ret_in
 
     def msg_handler(self, mlist):
+        ''' Decode a batch of messages, coalescing the notifications
+            for the same UVE, and report the UVEs that may have changed
+            with a single callback for the whole batch, along with the
+            offset of the first notification of every UVE
+        '''
+        chg = {}
+        offsets = {}
+        ret = True
         for mm in mlist:
-            if not self.msg_handler_single(mm):
+            if not self.msg_handler_single(mm, chg, offsets):
                 self._logger.info("%s could not handle %s" % \
                     (self._topic, str(mm)))
-                return False
-        return True
-
-    def msg_handler_single(self, om):
+                ret = False
+                break
+        if len(chg):
+            self._callback(self._partno, chg, offsets)
+        return ret
+
+    def msg_handler_single(self, om, chg=None, offsets=None):
+        ''' Decode a single message
+            If chg is given, the UVE that may have changed is added to it,
+            and the offset of its first notification to offsets, instead
+            of being reported through the callback
+        '''
         self._partoffset = om.offset
-        chg = {}
+        batch = chg is not None
+        if not batch:
+            chg = {}
+            offsets = {}
         try:
             params = om.key.split("|")
+            key = params[0]
+            typ = params[1]
             gen = params[2]
             coll = params[3]
-            uv = {}
-            uv["type"] = params[1]
-            uv["key"] = params[0]
             if om.value is None or len(om.value) == 0:
-                uv["value"] = None
+                value = None
+            elif om.value == '{}':
+                # Most notifications for raw UVEs
+                value = {}
             else:
-                uv["value"] = json.loads(om.value)
+                value = json.loads(om.value)
 
             if not self._uvedb.has_key(coll):
                 # This partition is not synced yet.
                 # Ignore this message
+                # We cannot rely on the replay from the checkpoint
+                # after dropping messages
+                self._resumed = False
                 self._logger.debug("%s Ignoring UVE %s" % (self._topic, str(om)))
                 return True
 
-            if not self._uvedb[coll].has_key(gen):
-                self._uvedb[coll][gen] = {}
-
-            tabl = uv["key"].split(":",1)
-            tab = tabl[0]
-            rkey = tabl[1]
-            
-            if tab not in self._uvedb[coll][gen]:
-                self._uvedb[coll][gen][tab] = {}
-
-            if not rkey in self._uvedb[coll][gen][tab]:
-                self._uvedb[coll][gen][tab][rkey] = {}
-     
-            removed = False
+            tab, rkey = key.split(":",1)
+            gendb = self._uvedb[coll].setdefault(gen, {})
+            tabdb = gendb.setdefault(tab, {})
+            rkeydb = tabdb.setdefault(rkey, {})
 
-            # uv["type"] and uv["value"] can be decoded as follows:
+            # typ and value can be decoded as follows:
 
-            # uv["type"] refers to a struct name
+            # typ refers to a struct name
 
-            # uv["value"] can be one of the following:
+            # value can be one of the following:
             # - None      # This Type has been deleted.
             # - {}        # The Type has a value, which is 
             #               not available in this message.
@@ -1003,34 +1847,27 @@ class UveStreamProc(PartitionHandler):
             # - {<Value>} # The Value of the Type
             #               (this option is only for agg UVE updates)
 
-            if uv["value"] is None:
-                if uv["type"] in self._uvedb[coll][gen][tab][rkey]:
-                    del self._uvedb[coll][gen][tab][rkey][uv["type"]]
-                if not len(self._uvedb[coll][gen][tab][rkey]):
-                    del self._uvedb[coll][gen][tab][rkey]
-                removed = True
+            if value is None:
+                if typ in rkeydb:
+                    del rkeydb[typ]
+                if not len(rkeydb):
+                    del tabdb[rkey]
+            elif typ in rkeydb:
+                rkeydb[typ]["c"] += 1
+            else:
+                rkeydb[typ] = {"c": 1, "u": uuid.uuid1(self._ip_code)}
 
-            if not removed: 
-                if uv["type"] in self._uvedb[coll][gen][tab][rkey]:
-                    self._uvedb[coll][gen][tab][rkey][uv["type"]]["c"] +=1
-                else:
-                    self._uvedb[coll][gen][tab][rkey][uv["type"]] = {}
-                    self._uvedb[coll][gen][tab][rkey][uv["type"]]["c"] = 1
-                    self._uvedb[coll][gen][tab][rkey][uv["type"]]["u"] = \
-                        uuid.uuid1(self._ip_code)
-            chg[uv["key"]] = { uv["type"] : uv["value"] }
+            if key in chg and chg[key] is not None:
+                chg[key][typ] = value
+            else:
+                chg[key] = { typ : value }
+            if offsets is not None:
+                offsets.setdefault(key, om.offset)
 
             # Record stats on the input UVE Notifications
-            if not self._uvein.has_key(tab):
-                self._uvein[tab] = {}
-            if not self._uvein[tab].has_key(coll):
-                self._uvein[tab][coll] = {}
-            if not self._uvein[tab][coll].has_key(gen):
-                self._uvein[tab][coll][gen] = {}
-            if not self._uvein[tab][coll][gen].has_key(uv["type"]):
-                self._uvein[tab][coll][gen][uv["type"]] = 1
-            else:
-                self._uvein[tab][coll][gen][uv["type"]] += 1
+            typdb = self._uvein.setdefault(tab, {}).setdefault(coll, {}).\
+                    setdefault(gen, {})
+            typdb[typ] = typdb.get(typ, 0) + 1
 
         except Exception as ex:
             template = "An exception of type {0} in uve proc . Arguments:\n{1!r}"
@@ -1038,7 +1875,8 @@ class UveStreamProc(PartitionHandler):
             self._logger.info("%s" % messag)
             return False
         else:
-            self._callback(self._partno, chg)
+            if not batch:
+                self._callback(self._partno, chg, offsets)
         return True
 
 if __name__ == '__main__':
@@ -18,6 +18,7 @@ class AlarmBase(object):
         self._FreqCheck_Times = fct
         self._FreqCheck_Seconds = fcs
         self._config = config
+        self._rule_set = None
 
     def rules(self):
         """Return the rules for this alarm
@@ -75,6 +76,17 @@ class AlarmBase(object):
         """Set the alarm config object for this alarm
         """
         self._config = alarm_cfg_obj
+        self._rule_set = None
+
+    def rule_set(self):
+        """Return the compiled rules of the alarm config, if any
+        """
+        return self._rule_set
+
+    def set_rule_set(self, rule_set):
+        """Set the compiled rules of the alarm config
+        """
+        self._rule_set = rule_set
 
     def is_enabled(self):
         if self._config:
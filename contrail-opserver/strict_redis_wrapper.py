@@ -11,12 +11,149 @@
 import socket
 import redis
 
+def _keepalive_options():
+    return {socket.TCP_KEEPIDLE:3,socket.TCP_KEEPINTVL:1,
+            socket.TCP_KEEPCNT:3}
+
 class StrictRedisWrapper(redis.StrictRedis):
 
     def __init__(self, *args, **kwargs):
-        tcp_keepalive_opts = {socket.TCP_KEEPIDLE:3,socket.TCP_KEEPINTVL:1,
-                      socket.TCP_KEEPCNT:3}
+        tcp_keepalive_opts = _keepalive_options()
         super(StrictRedisWrapper, self).__init__(*args,
                           socket_keepalive=True,
                           socket_keepalive_options=tcp_keepalive_opts,
                           **kwargs)
+
+
+class _PooledConnectionMixin(object):
+    # Reports the outcome of connecting to redis to the owning pool
+
+    def connect(self):
+        if self._sock:
+            return
+        try:
+            super(_PooledConnectionMixin, self).connect()
+        except redis.exceptions.ConnectionError as e:
+            self.owner.connect_failed(e)
+            raise
+        self.owner.connected()
+
+class PooledConnection(_PooledConnectionMixin, redis.Connection):
+    pass
+
+class PooledSSLConnection(_PooledConnectionMixin, redis.SSLConnection):
+    pass
+
+class RedisConnectionPool(redis.BlockingConnectionPool):
+    """
+    A bounded pool of connections to a redis endpoint
+    Callers wait for up to timeout seconds when all the connections
+    are in use. The pool counts the connections created, in use and
+    waited for, and tracks the health of the endpoint
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.created = 0
+        self.in_use = 0
+        self.waits = 0
+        self.wait_timeouts = 0
+        self.connect_failures = 0
+        self.healthy = True
+        self.last_error = None
+        super(RedisConnectionPool, self).__init__(*args, **kwargs)
+
+    def make_connection(self):
+        connection = super(RedisConnectionPool, self).make_connection()
+        connection.owner = self
+        self.created += 1
+        return connection
+
+    def get_connection(self, command_name, *keys, **options):
+        waited = self.pool.empty()
+        if waited:
+            self.waits += 1
+        connect_failures = self.connect_failures
+        try:
+            connection = super(RedisConnectionPool, self).get_connection(
+                command_name, *keys, **options)
+        except redis.exceptions.ConnectionError:
+            # Newer versions of redis-py connect here, and release the
+            # connection themselves when that fails
+            if waited and self.connect_failures == connect_failures:
+                self.wait_timeouts += 1
+            raise
+        connection.checked_out = True
+        self.in_use += 1
+        return connection
+
+    def release(self, connection):
+        if connection.pid == self.pid and \
+                getattr(connection, 'checked_out', False):
+            connection.checked_out = False
+            self.in_use -= 1
+        super(RedisConnectionPool, self).release(connection)
+
+    def connected(self):
+        self.healthy = True
+
+    def connect_failed(self, err):
+        self.connect_failures += 1
+        self.healthy = False
+        self.last_error = str(err)
+
+    def stats(self):
+        return {'max_connections': self.max_connections,
+                'connections': len(self._connections),
+                'in_use': self.in_use,
+                'created': self.created,
+                'waits': self.waits,
+                'wait_timeouts': self.wait_timeouts,
+                'connect_failures': self.connect_failures,
+                'healthy': self.healthy,
+                'last_error': self.last_error}
+
+class RedisPoolManager(object):
+    """
+    Hands out StrictRedisWrapper clients that share one
+    RedisConnectionPool per redis endpoint, db, SSL setting and password
+    """
+
+    def __init__(self, max_connections=64, timeout=20):
+        self._max_connections = max_connections
+        self._timeout = timeout
+        self._pools = {}
+
+    def client(self, host, port, db=0, password=None, ssl_params=None):
+        kwargs = {}
+        connection_class = PooledConnection
+        use_ssl = bool(ssl_params and ssl_params.get('ssl'))
+        if use_ssl:
+            connection_class = PooledSSLConnection
+            kwargs = dict((k, v) for k, v in ssl_params.iteritems() \
+                          if k != 'ssl')
+        # Callers with different SSL settings or passwords must not
+        # share a pool
+        key = (host, int(port), db, use_ssl, tuple(sorted(kwargs.items())),
+               password)
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = RedisConnectionPool(
+                max_connections=self._max_connections,
+                timeout=self._timeout,
+                connection_class=connection_class,
+                host=host, port=int(port), db=db, password=password,
+                socket_keepalive=True,
+                socket_keepalive_options=_keepalive_options(),
+                **kwargs)
+            self._pools[key] = pool
+        return StrictRedisWrapper(connection_pool=pool)
+
+    def stats(self):
+        """
+        Returns a list of (host, port, db, ssl, stats) for every pool
+        """
+        return [key[:4] + (pool.stats(),) for key, pool in \
+                self._pools.iteritems()]
+
+# Pools shared by all the users of redis in this process
+redis_pools = RedisPoolManager()
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2017 Juniper Networks, Inc. All rights reserved.
+#
+
+#
+# Alarm Rule Benchmarks
+#
+# Micro-benchmark of the evaluation of the alarm_rules of an alarm
+# config against UVEs. The compiled AlarmRuleSet is compared with the
+# interpreter that AlarmProcessor used before the rules were compiled,
+# which is kept below as BaselineAlarmRules. It is not run as part of
+# the unit tests:
+#
+#   python benchmark_alarm_rules.py [--uves N] [--processes N]
+#                                   [--repeat N] [--number N]
+#
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+from vnc_api.gen.resource_client import Alarm
+from vnc_api.gen.resource_xsd import AlarmExpression, \
+    AlarmOperand2 as CfgAlarmOperand2, AlarmAndList as CfgAlarmAndList, \
+    AlarmOrList, UveKeysType, IdPermsType
+import opserver.sandesh.viz.constants as viz_constants
+from opserver.sandesh.alarmgen_ctrl.sandesh_alarm_base.ttypes import \
+    AlarmOperand2, AlarmCondition, AlarmMatch, AlarmConditionMatch, \
+    AlarmAndList
+from opserver.alarmgen_rules import AlarmRuleSet
+
+
+class BaselineAlarmRules(object):
+    """ The alarm rule interpreter of AlarmProcessor, as it was before
+        the rules were compiled. Every evaluation walks the alarm config.
+    """
+
+    def _get_uve_attribute(self, tuve, attr_list, uve_path=None):
+        if uve_path is None:
+            uve_path = []
+        if tuve is None or not attr_list:
+            return {'value': tuve, 'uve_path': uve_path,
+                    'status': False if len(attr_list) else True}
+        if isinstance(tuve, dict):
+            if attr_list[0] in ('*', '__value'):
+                return [self._get_uve_attribute(val, attr_list[1:],
+                        uve_path+[{key: val}]) \
+                        for key, val in tuve.iteritems()]
+            elif attr_list[0] == '__key':
+                return [self._get_uve_attribute(key, attr_list[1:],
+                        uve_path+[{key: val}]) \
+                        for key, val in tuve.iteritems()]
+            else:
+                tuve = tuve.get(attr_list[0])
+                uve_path.append({attr_list[0]: tuve})
+                return self._get_uve_attribute(tuve, attr_list[1:], uve_path)
+        elif isinstance(tuve, list):
+            return [self._get_uve_attribute(elem, attr_list,
+                    uve_path+[{'__list_element__': elem}]) \
+                    for elem in tuve]
+        elif isinstance(tuve, str):
+            try:
+                json_elem = json.loads(tuve)
+            except ValueError:
+                return {'value': None, 'uve_path': uve_path, 'status': False}
+            else:
+                return self._get_uve_attribute(json_elem, attr_list, uve_path)
+    # end _get_uve_attribute
+
+    def _get_operand_value(self, uve, operand):
+        attr_list = operand.split('.')
+        return self._get_uve_attribute(uve, attr_list)
+    # end _get_operand_value
+
+    def _get_json_value(self, val):
+        try:
+            tval = json.loads(val)
+        except (ValueError, TypeError):
+            return json.dumps(val)
+        else:
+            return val
+    # end _get_json_value
+
+    def _get_attribute_from_uve_path(self, attr, uve_path):
+        attr_list = attr.split('.')
+        ai = ui = 0
+        pnode = uve_path[ui]
+        while (ai < len(attr_list) and ui < len(uve_path)):
+            if attr_list[ai] == '__key':
+                return uve_path[ui].iterkeys().next()
+            elif attr_list[ai] == '__value':
+                return uve_path[ui].itervalues().next()
+            if attr_list[ai] != '*' and attr_list[ai] not in uve_path[ui]:
+                break
+            pnode = uve_path[ui]
+            ui += 1
+            ai += 1
+            if len(uve_path) > ui and '__list_element__' in uve_path[ui]:
+                pnode = uve_path[ui]
+                ui += 1
+        if not ui:
+            return None
+        val = pnode.itervalues().next()
+        for a in attr_list[ai:]:
+            if val is None or not isinstance(val, dict):
+                return None
+            val = val.get(a)
+        return val
+    # end _get_attribute_from_uve_path
+
+    def _get_json_variables(self, uve, exp, operand1_val,
+                            operand2_val, is_operand2_json_val):
+        json_vars = {}
+        for var in exp.variables:
+            p1 = os.path.commonprefix([exp.operand1.split('.'),
+                var.split('.')])
+            if not is_operand2_json_val:
+                p2 = os.path.commonprefix(
+                    [exp.operand2.uve_attribute.split('.'), var.split('.')])
+                if p1 > p2:
+                    var_val = self._get_attribute_from_uve_path(var,
+                        operand1_val['uve_path'])
+                else:
+                    var_val = self._get_attribute_from_uve_path(var,
+                        operand2_val['uve_path'])
+            else:
+                var_val = self._get_attribute_from_uve_path(var,
+                    operand1_val['uve_path'])
+            json_vars[var] = self._get_json_value(var_val)
+        return json_vars
+    # end _get_json_variables
+
+    def _compare_operand_vals(self, val1, val2, operation):
+        try:
+            val1 = json.loads(val1)
+        except (TypeError, ValueError):
+            pass
+        try:
+            val2 = json.loads(val2)
+        except (TypeError, ValueError):
+            pass
+        if operation == '==':
+            return val1 == val2
+        elif operation == '!=':
+            return val1 != val2
+        elif operation == '<':
+            return val1 < val2
+        elif operation == '<=':
+            return val1 <= val2
+        elif operation == '>':
+            return val1 > val2
+        elif operation == '>=':
+            return val1 >= val2
+        elif operation == 'in':
+            if not isinstance(val2, list):
+                return False
+            return val1 in val2
+        elif operation == 'not in':
+            if not isinstance(val2, list):
+                return True
+            return val1 not in val2
+        elif operation == 'range':
+            return val2[0] <= val1 <= val2[1]
+        elif operation == 'size==':
+            if not isinstance(val1, list):
+                return False
+            return len(val1) == val2
+        elif operation == 'size!=':
+            if not isinstance(val1, list):
+                return True
+            return len(val1) != val2
+    # end _compare_operand_vals
+
+    def _get_alarm_match(self, uve, exp, operand1_val, operand2_val,
+                         is_operand2_json_val):
+        json_vars = self._get_json_variables(uve, exp, operand1_val,
+            operand2_val, is_operand2_json_val)
+        json_operand1_val = self._get_json_value(operand1_val['value'])
+        if not is_operand2_json_val:
+            json_operand2_val = self._get_json_value(operand2_val['value'])
+        else:
+            json_operand2_val = None
+        return AlarmMatch(json_operand1_value=json_operand1_val,
+            json_operand2_value=json_operand2_val, json_variables=json_vars)
+    # end _get_alarm_match
+
+    def _get_alarm_condition_match(self, uve, exp, operand1_val, operand2_val,
+                                   is_operand2_json_val, match_list=None):
+        if not match_list:
+            match_list = [self._get_alarm_match(uve, exp, operand1_val,
+                operand2_val, is_operand2_json_val)]
+        return AlarmConditionMatch(
+            condition=AlarmCondition(operation=exp.operation,
+                operand1=exp.operand1, operand2=AlarmOperand2(
+                    uve_attribute=exp.operand2.uve_attribute,
+                    json_value=exp.operand2.json_value),
+                variables=exp.variables),
+            match=match_list)
+    # end _get_alarm_condition_match
+
+    def _get_uve_parent_fqname(self, table, uve_name, uve):
+        try:
+            # virtual-machine UVE key doesn't have project name in the prefix.
+            # Hence extract the project name from the interface_list.
+            if table == viz_constants.VM_TABLE:
+                return uve['UveVirtualMachineAgent']['interface_list'][0].\
+                    rsplit(':', 1)[0]
+            else:
+                return uve_name.rsplit(':', 1)[0]
+        except (KeyError, IndexError):
+            return None
+    # end _get_uve_parent_fqname
+
+    def _evaluate_uve_for_alarms(self, alarm_cfg, uve_key, uve):
+        table, uve_name = uve_key.split(':', 1)
+        # For alarms configured under project, the parent fq_name of the uve
+        # should match with that of the alarm config
+        if alarm_cfg.parent_type == 'project':
+            uve_parent_fqname = self._get_uve_parent_fqname(table,
+                uve_name, uve)
+            if uve_parent_fqname != alarm_cfg.get_parent_fq_name_str():
+                return None
+        or_list = []
+        for cfg_and_list in alarm_cfg.alarm_rules.or_list:
+            and_list = []
+            and_list_fail = False
+            for exp in cfg_and_list.and_list:
+                operand1_val = self._get_operand_value(uve, exp.operand1)
+                if isinstance(operand1_val, dict) and \
+                    operand1_val['status'] is False:
+                    and_list_fail = True
+                    break
+                if exp.operand2.json_value is not None:
+                    operand2_val = json.loads(exp.operand2.json_value)
+                    is_operand2_json_val = True
+                else:
+                    operand2_val = self._get_operand_value(uve,
+                        exp.operand2.uve_attribute)
+                    if isinstance(operand2_val, dict) and \
+                        operand2_val['status'] is False:
+                        and_list_fail = True
+                        break
+                    is_operand2_json_val = False
+                if isinstance(operand1_val, list) or \
+                    (is_operand2_json_val is False and \
+                        isinstance(operand2_val, list)):
+                    match_list = []
+                    # both operand1_val and operand2_val are list
+                    if isinstance(operand1_val, list) and \
+                        (is_operand2_json_val is False and \
+                            isinstance(operand2_val, list)):
+                            if len(operand1_val) != len(operand2_val):
+                                and_list_fail = True
+                                break
+                            for i in range(0, len(operand1_val)):
+                                if self._compare_operand_vals(
+                                    operand1_val[i]['value'],
+                                    operand2_val[i]['value'],
+                                    exp.operation):
+                                    match_list.append(
+                                        self._get_alarm_match(
+                                        uve, exp, operand1_val[i],
+                                        operand2_val[i],
+                                        is_operand2_json_val))
+                    # operand1_val is list and operand2_val is not list
+                    elif isinstance(operand1_val, list):
+                        val2 = operand2_val
+                        if not is_operand2_json_val:
+                            val2 = operand2_val['value']
+                        for val1 in operand1_val:
+                            if self._compare_operand_vals(val1['value'],
+                                val2, exp.operation):
+                                match_list.append(self._get_alarm_match(
+                                    uve, exp, val1, operand2_val,
+                                    is_operand2_json_val))
+                    # operand1_val is not list and operand2_val is list
+                    elif is_operand2_json_val is False and \
+                        isinstance(operand2_val, list):
+                        for val2 in operand2_val:
+                            if self._compare_operand_vals(
+                                operand1_val['value'], val2['value'],
+                                exp.operation):
+                                match_list.append(self._get_alarm_match(
+                                    uve, exp, operand1_val, val2,
+                                    is_operand2_json_val))
+                    if match_list:
+                        and_list.append(self._get_alarm_condition_match(
+                            uve, exp, operand1_val, operand2_val,
+                            is_operand2_json_val, match_list))
+                    else:
+                        and_list_fail = True
+                        break
+                # Neither operand1_val nor operand2_val is a list
+                else:
+                    val1 = operand1_val['value']
+                    val2 = operand2_val
+                    if not is_operand2_json_val:
+                        val2 = operand2_val['value']
+                    if self._compare_operand_vals(val1, val2, exp.operation):
+                        and_list.append(self._get_alarm_condition_match(
+                            uve, exp, operand1_val, operand2_val,
+                            is_operand2_json_val))
+                    else:
+                        and_list_fail = True
+                        break
+            if not and_list_fail:
+                or_list.append(AlarmAndList(and_list))
+        if or_list:
+            return or_list
+        return None
+    # end _evaluate_uve_for_alarms
+
+
+# end class BaselineAlarmRules
+
+
+def vrouter_alarm_config():
+    return Alarm(name='vrouter-alarm',
+        uve_keys=UveKeysType(['vrouter']),
+        alarm_severity=1,
+        alarm_rules=AlarmOrList([
+            CfgAlarmAndList([
+                AlarmExpression(operation='!=',
+                    operand1='NodeStatus.process_info',
+                    operand2=CfgAlarmOperand2(json_value='null')),
+                AlarmExpression(operation='!=',
+                    operand1='NodeStatus.process_info.process_state',
+                    operand2=CfgAlarmOperand2(
+                        json_value='"PROCESS_STATE_RUNNING"'),
+                    variables=['NodeStatus.process_info.process_name'])]),
+            CfgAlarmAndList([
+                AlarmExpression(operation='>=',
+                    operand1='VrouterAgent.down_interface_count',
+                    operand2=CfgAlarmOperand2(json_value='1')),
+                AlarmExpression(operation='not in',
+                    operand1='VrouterAgent.down_interface_count',
+                    operand2=CfgAlarmOperand2(
+                        uve_attribute='VrouterAgent.ignored_counts'))])]),
+        id_perms=IdPermsType(enable=True, description='vrouter alarm'),
+        parent_type='global-system-config',
+        fq_name=['default-global-system-config', 'vrouter-alarm'])
+
+
+def vrouter_uves(uves, processes):
+    return [('ObjectVRouter:host%d' % idx, {
+        'NodeStatus': {
+            'process_info': [
+                {'process_name': 'proc%d' % pidx,
+                 'process_state': 'PROCESS_STATE_RUNNING' \
+                    if (idx + pidx) % 3 else 'PROCESS_STATE_STOPPED'}
+                for pidx in range(processes)]
+        },
+        'VrouterAgent': {
+            'down_interface_count': idx % 4,
+            'ignored_counts': [2]
+        }
+    }) for idx in range(uves)]
+
+
+def run_rules(uves, processes, repeat, number):
+    alarm_cfg = vrouter_alarm_config()
+    uve_list = vrouter_uves(uves, processes)
+    baseline = BaselineAlarmRules()
+    rule_set = AlarmRuleSet(alarm_cfg)
+    assert [baseline._evaluate_uve_for_alarms(alarm_cfg, key, uve) \
+            for key, uve in uve_list] == \
+           [rule_set.evaluate(key, uve) for key, uve in uve_list]
+    print '%-20s %8s %12s %12s' % ('alarm rules', 'uves', 'msec',
+                                   'uves/sec')
+    for name, evaluate in [
+            ('baseline', lambda key, uve: \
+                baseline._evaluate_uve_for_alarms(alarm_cfg, key, uve)),
+            ('compiled', rule_set.evaluate)]:
+        timer = timeit.Timer(lambda: [evaluate(key, uve) \
+                                      for key, uve in uve_list])
+        msec = min(timer.repeat(repeat, number)) * 1000 / number
+        print '%-20s %8d %12.3f %12d' % (name, uves, msec,
+                                         uves * 1000 / max(msec, 1e-6))
+
+
+def main(args_str=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uves', type=int, default=1000,
+                        help='Number of vrouter UVEs to evaluate')
+    parser.add_argument('--processes', type=int, default=8,
+                        help='Number of processes of every vrouter UVE')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--number', type=int, default=5)
+    args = parser.parse_args(args_str)
+    run_rules(args.uves, args.processes, args.repeat, args.number)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2017 Juniper Networks, Inc. All rights reserved.
+#
+
+#
+# UVE Benchmarks
+#
+# Micro-benchmarks for the aggregation and flattening of UVEs, with
+# large synthetic UVE attributes. They are not run as part of the unit
+# tests:
+#
+#   python benchmark_uve.py [--sources N] [--elements N] [--repeat N]
+#                           [--interfaces N]
+#
+# With --redis-port, the listing of alarms is benchmarked against a
+# redis that is filled with --uves UVEs and --alarms alarms. The
+# --redis-db database is flushed before and after the benchmark.
+#
+
+import argparse
+import logging
+import sys
+import timeit
+
+from opserver.uveserver import ParallelAggregator, UVEServer, RedisInst, \
+    RedisInstKey
+from opserver.opserver_util import OpServerUtils
+
+KEY = 'ObjectVNTable:bench'
+TYPE = 'UVEBench'
+
+
+def MakeBasic(typ, val, aggtype=None):
+    item = {'@type': typ, '#text': str(val)}
+    if aggtype is not None:
+        item['@aggtype'] = aggtype
+    return item
+
+
+def MakeList(typ, valname, vals, aggtype=None):
+    item = {'@type': 'list',
+            'list': {'@type': typ, '@size': str(len(vals)), valname: vals}}
+    if aggtype is not None:
+        item['@aggtype'] = aggtype
+    return item
+
+
+def MakeStruct(sname, members):
+    return {'@type': 'struct', sname: members}
+
+
+def default_attr(sources, elements):
+    # Attributes without an aggtype are reported by many sources, so
+    # there are elements sources here; every value is reported by two
+    return dict(('src%d' % eidx, MakeBasic('string', eidx / 2)) \
+                for eidx in range(elements))
+
+
+def elem_sum_attr(sources, elements):
+    return dict(('src%d' % sidx, MakeBasic('u64', sidx, 'sum')) \
+                for sidx in range(sources))
+
+
+def struct_sum_attr(sources, elements):
+    attr = {}
+    for sidx in range(sources):
+        stats = dict(('ctr%d' % eidx, MakeBasic('u64', eidx)) \
+                     for eidx in range(elements))
+        attr['src%d' % sidx] = {'@type': 'struct', '@aggtype': 'sum',
+                                'IfStats': stats}
+    return attr
+
+
+def list_union_attr(sources, elements):
+    # Half of the elements of a source are also reported by the next one
+    attr = {}
+    for sidx in range(sources):
+        vals = ['vn-%d' % (sidx * elements / 2 + eidx) \
+                for eidx in range(elements)]
+        attr['src%d' % sidx] = MakeList('string', 'element', vals, 'union')
+    return attr
+
+
+def struct_list_union_attr(sources, elements):
+    attr = {}
+    for sidx in range(sources):
+        vals = [{'name': MakeBasic('string',
+                                   'vn-%d' % (sidx * elements / 2 + eidx))} \
+                for eidx in range(elements)]
+        attr['src%d' % sidx] = MakeList('struct', 'VnInfo', vals, 'union')
+    return attr
+
+
+def map_union_attr(sources, elements):
+    attr = {}
+    for sidx in range(sources):
+        element = []
+        for eidx in range(elements):
+            element.extend(['key%d' % eidx, 'val%d' % eidx])
+        attr['src%d' % sidx] = {'@type': 'map', '@aggtype': 'union',
+            'map': {'@key': 'string', '@value': 'string',
+                    '@size': str(elements), 'element': element}}
+    return attr
+
+
+def append_attr(sources, elements):
+    # All the sources report stats for the same listkeys, so every
+    # element is consolidated with the elements of the other sources
+    attr = {}
+    for sidx in range(sources):
+        vals = [{'other_vn': MakeBasic('string', 'vn-%d' % eidx, 'listkey'),
+                 'bytes': MakeBasic('u64', eidx),
+                 'pkts': MakeBasic('u64', sidx)} \
+                for eidx in range(elements)]
+        attr['src%d' % sidx] = MakeList('struct', 'VnStats', vals, 'append')
+    return attr
+
+
+BENCHMARKS = [
+    ('default', default_attr),
+    ('elem_sum', elem_sum_attr),
+    ('struct_sum', struct_sum_attr),
+    ('list_union', list_union_attr),
+    ('struct_list_union', struct_list_union_attr),
+    ('map_union', map_union_attr),
+    ('append', append_attr),
+]
+
+
+def vrouter_uve(interfaces):
+    '''
+    Returns the attributes of the VrouterAgent and VrouterStatsAgent
+    structs of a vrouter UVE with the given number of interfaces, in
+    the form they are parsed from the sandesh XML
+    '''
+    names = ['tap%08x-%02d' % (idx, idx % 100) for idx in range(interfaces)]
+    uve = {}
+    uve['interface_list'] = MakeList('string', 'element', names)
+    uve['vn_list'] = MakeList('string', 'element',
+        ['default-domain:project%d:vn%d' % (idx % 10, idx) \
+         for idx in range(interfaces / 4)])
+    uve['xmpp_peer_list'] = MakeList('struct', 'AgentXmppPeer',
+        [{'ip': MakeBasic('string', '10.0.0.%d' % idx),
+          'status': MakeBasic('bool', 'true'),
+          'setup_time': MakeBasic('u64', 1500000000000000 + idx),
+          'primary': MakeBasic('bool', 'true' if idx == 0 else 'false')} \
+         for idx in range(2)])
+    uve['phy_if_stats_list'] = MakeList('struct', 'AgentIfStats',
+        [dict([('name', MakeBasic('string', 'eth%d' % idx))] + \
+              [(ctr, MakeBasic('u64', idx * 1000)) for ctr in \
+               ['in_pkts', 'in_bytes', 'out_pkts', 'out_bytes', 'speed',
+                'duplexity']]) \
+         for idx in range(4)])
+    uve['drop_stats'] = MakeStruct('AgentDropStats',
+        dict(('ds_drop%d' % idx, MakeBasic('u64', idx)) \
+             for idx in range(60)))
+    uve['flow_rate'] = MakeStruct('FlowRateInfo',
+        dict((ctr, MakeBasic('u64', 10)) for ctr in \
+             ['added_flows', 'deleted_flows', 'max_flow_adds_per_second',
+              'min_flow_adds_per_second', 'max_flow_deletes_per_second',
+              'min_flow_deletes_per_second']))
+    uve['cpu_info'] = MakeStruct('CpuLoadInfo', {
+        'num_cpu': MakeBasic('u32', 8),
+        'cpu_share': MakeBasic('double', '1.25'),
+        'cpuload': MakeStruct('CpuLoadAvg', dict((avg, MakeBasic('double',
+            '0.5')) for avg in ['one_min_avg', 'five_min_avg',
+                                'fifteen_min_avg'])),
+        'meminfo': MakeStruct('MemInfo', dict((mem, MakeBasic('u32', 1024)) \
+            for mem in ['virt', 'peakvirt', 'res']))})
+    element = []
+    for name in names:
+        element.extend([name, '1000'])
+    uve['phy_band_in_bps'] = {'@type': 'map', 'map': {'@key': 'string',
+        '@value': 'u64', '@size': str(len(names)), 'element': element}}
+    uve['if_stats'] = {'@type': 'map', 'map': {'@key': 'string',
+        '@value': 'struct', '@size': str(len(names)), 'element': names,
+        'VrouterIfStats': [dict((ctr, MakeBasic('u64', 100)) for ctr in \
+            ['in_pkts', 'in_bytes', 'out_pkts', 'out_bytes', 'drop_pkts']) \
+            for name in names]}}
+    return uve
+
+
+def deep_attr(depth):
+    attr = MakeBasic('u64', 1)
+    for idx in range(depth):
+        attr = MakeStruct('Nested', {'child': attr, 'level': MakeBasic(
+            'u32', idx)})
+    return attr
+
+
+def run_flatten(interfaces, repeat, number):
+    print '%-20s %8s %12s' % ('flatten', 'size', 'msec')
+    uve = vrouter_uve(interfaces)
+    def flatten_uve():
+        for attr in uve.itervalues():
+            OpServerUtils.uve_attr_flatten(attr)
+    timer = timeit.Timer(flatten_uve)
+    print '%-20s %8d %12.3f' % ('vrouter', interfaces,
+        min(timer.repeat(repeat, number)) * 1000 / number)
+    depth = min(sys.getrecursionlimit() - 100, 500)
+    attr = deep_attr(depth)
+    timer = timeit.Timer(lambda: OpServerUtils.uve_attr_flatten(attr))
+    print '%-20s %8d %12.3f' % ('deep struct', depth,
+        min(timer.repeat(repeat, number)) * 1000 / number)
+
+
+def fill_alarms_redis(redish, uves, alarms):
+    tables = ['ObjectVNTable', 'ObjectVMTable', 'ObjectVRouter',
+              'ObjectBgpPeer']
+    origin = '10.0.0.1:Compute:contrail-vrouter-agent:0:UVEBench'
+    alarm_origin = '10.0.0.1:Analytics:contrail-alarm-gen:0:UVEAlarms'
+    ppe = redish.pipeline(transaction=False)
+    for uidx in range(uves):
+        table = tables[uidx % len(tables)]
+        key = table + ':uve-%d' % uidx
+        ppe.sadd('TABLES', table)
+        ppe.sadd('TABLE:' + table, key + ':' + origin)
+        ppe.sadd('ORIGINS:' + key, origin)
+        ppe.hset('VALUES:' + key + ':' + origin, 'counter',
+                 '<counter type="u64">%d</counter>' % uidx)
+        if uidx % (uves / alarms) == 0:
+            ppe.sadd('ALARM_TABLES', table)
+            ppe.sadd('ALARM_TABLE:' + table, key + ':' + alarm_origin)
+            ppe.sadd('ALARM_ORIGINS:' + key, alarm_origin)
+            ppe.hset('VALUES:' + key + ':' + alarm_origin, 'alarms',
+                     '<alarms type="string">alarm-%d</alarms>' % uidx)
+        if uidx % 1000 == 999:
+            ppe.execute()
+    ppe.execute()
+
+
+def run_alarms(port, db, uves, alarms, repeat, number):
+    import redis
+    redish = redis.StrictRedis(port=port, db=db)
+    redish.flushdb()
+    try:
+        fill_alarms_redis(redish, uves, alarms)
+        uveserver = UVEServer([], logging.getLogger(__name__))
+        r_inst = RedisInst()
+        r_inst.redis_handle = redish
+        r_inst.collector_pid = 'bench'
+        uveserver._redis_uve_map[RedisInstKey(ip='127.0.0.1',
+                                              port=port)] = r_inst
+        filters = {'cfilt': {'UVEAlarms': set()}}
+        nalarms = sum(len(talarms) for talarms in \
+                      uveserver.get_alarms(filters).itervalues())
+        print '%-20s %8s %8s %12s' % ('alarms', 'uves', 'alarms', 'msec')
+        timer = timeit.Timer(lambda: uveserver.get_alarms(filters))
+        print '%-20s %8d %8d %12.3f' % ('get_alarms', uves, nalarms,
+            min(timer.repeat(repeat, number)) * 1000 / number)
+    finally:
+        redish.flushdb()
+
+
+def run_aggregation(sources, elements, repeat, number):
+    print '%-20s %8s %8s %12s %12s' % ('aggregation', 'sources', 'elements',
+                                       'msec', 'msec (flat)')
+    for name, make_attr in BENCHMARKS:
+        attr = make_attr(sources, elements)
+        state = {KEY: {TYPE: {'attr': attr}}}
+        pa = ParallelAggregator(state)
+        times = []
+        for flat in [False, True]:
+            timer = timeit.Timer(lambda: pa.aggregate(KEY, flat))
+            times.append(min(timer.repeat(repeat, number)) * 1000 / number)
+        print '%-20s %8d %8d %12.3f %12.3f' % (name, len(attr), elements,
+                                               times[0], times[1])
+
+
+def main(args_str=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sources', type=int, default=16,
+                        help='Number of sources of every UVE attribute')
+    parser.add_argument('--elements', type=int, default=2000,
+                        help='Number of elements of list/map/struct attributes')
+    parser.add_argument('--interfaces', type=int, default=500,
+                        help='Number of interfaces of the vrouter UVE')
+    parser.add_argument('--redis-port', type=int,
+                        help='Port of the redis to benchmark alarms with')
+    parser.add_argument('--redis-db', type=int, default=15,
+                        help='Database to fill, flushed before and after')
+    parser.add_argument('--uves', type=int, default=100000,
+                        help='Number of UVEs of the alarms benchmark')
+    parser.add_argument('--alarms', type=int, default=300,
+                        help='Number of alarms of the alarms benchmark')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--number', type=int, default=5)
+    args = parser.parse_args(args_str)
+    run_aggregation(args.sources, args.elements, args.repeat, args.number)
+    print
+    run_flatten(args.interfaces, args.repeat, args.number)
+    if args.redis_port is not None:
+        print
+        run_alarms(args.redis_port, args.redis_db, args.uves, args.alarms,
+                   args.repeat, args.number)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -8,6 +8,7 @@ import gevent
 import time
 from gevent import monkey; monkey.patch_all()
 import json
+import ast
 import signal
 import socket
 import copy
@@ -15,13 +16,15 @@ import logging
 import mock
 import unittest
 import collections
-from utils.util import retry
+import redis
+from utils.util import retry, get_free_port
+from mockredis import mockredis
 from collections import namedtuple
 from kafka.consumer.fetcher import ConsumerRecord
 
 from vnc_api.gen.resource_client import Alarm
 from vnc_api.gen.resource_xsd import AlarmExpression, AlarmOperand2, \
-    AlarmAndList, AlarmOrList, UveKeysType
+    AlarmAndList, AlarmOrList, UveKeysType, IdPermsType
 from pysandesh.util import UTCTimestampUsec
 from pysandesh.gen_py.sandesh_alarm.ttypes import SandeshAlarmAckRequest, \
     SandeshAlarmAckResponseCode
@@ -33,10 +36,13 @@ from opserver.sandesh.alarmgen_ctrl.ttypes import UVEAlarmOperState, \
     UVEAlarmStateMachineInfo, UVEAlarmState
 from opserver.uveserver import UVEServer, RedisInfo
 from opserver.partition_handler import PartitionHandler, UveStreamProc, \
-    UveStreamer, UveStreamPart, PartInfo
-from opserver.alarmgen import Controller, AlarmStateMachine, AlarmProcessor
+    UveStreamer, UveStreamPart, UveStreamHub, PartInfo
+from opserver.alarmgen import Controller, AlarmStateMachine, AlarmProcessor, \
+    AlarmTimerQueue, OutputRow
 from opserver.alarmgen_cfg import CfgParser
+from opserver.alarmgen_rules import AlarmRuleSet
 from opserver.plugins.alarm_base import AlarmBase
+from benchmark_alarm_rules import BaselineAlarmRules
 
 logging.basicConfig(level=logging.DEBUG,
     format='%(asctime)s %(levelname)s %(message)s')
@@ -121,20 +127,21 @@ class Mock_get_part(Mock_base):
             return {}
         return self.store[key]
         
-class Mock_get_uve(Mock_base):
+class Mock_get_uves(Mock_base):
     def __init__(self, *args, **kwargs):
         Mock_base.__init__(self, *args, **kwargs)
 
-    def __call__(self, key, flat, filters):
-        if key not in self.store:
-            return False, {}
-        return False, self.store[key]
+    def __call__(self, keys, flat, filters=None, base_url=None, cfilts=None):
+        rsp = {}
+        for key in keys:
+            rsp[key] = self.store.get(key, {})
+        return False, rsp
 
 class Mock_poll(Mock_base):
     def __init__(self, *args, **kwargs):
         Mock_base.__init__(self)
 
-    def __call__(self):
+    def __call__(self, timeout_ms=0):
         vals = []
         for key in self.store.keys():
             vals.append(self.store[key])
@@ -142,6 +149,8 @@ class Mock_poll(Mock_base):
         if len(vals):
             return {None:vals}
         else:
+            # Wait like a blocking poll that gets no messages
+            gevent.sleep(timeout_ms / 1000.0)
             return {}
 
 class Mock_agp(Mock_base):
@@ -155,8 +164,9 @@ class Mock_agp(Mock_base):
 
 class Mock_usp(object):
     def __init__(self, partno, logger, cb, pi, rpass, redis_ssl_params, content,\
-            tablefilt, cfilter, patterns, token=None):
+            tablefilt, cfilter, patterns, token=None, sync_cb=None):
         self._cb = cb
+        self._sync_cb = sync_cb
         self._partno = partno
         self._pi = pi
         self._started = False
@@ -168,6 +178,9 @@ class Mock_usp(object):
     def kill(self):
         self._started = False
 
+    def wakeups(self):
+        return 0
+
     def __call__(self, key, type, value):
         if self._started:
             if not self._content:
@@ -175,6 +188,14 @@ class Mock_usp(object):
                     value = {}
             self._cb(self._partno, self._pi, key, type, value) 
 
+    def sync(self, uves):
+        if self._sync_cb:
+            self._sync_cb(self._partno, True)
+        for key, type, value in uves:
+            self(key, type, value)
+        if self._sync_cb:
+            self._sync_cb(self._partno, False)
+
 # Tests for UveStreamer and UveCache
 class TestUveStreamer(unittest.TestCase, TestChecker):
     @classmethod
@@ -256,6 +277,326 @@ class TestUveStreamer(unittest.TestCase, TestChecker):
                 set(),
                 self.ustr._uvedbcache._partkeys[0]))
 
+    def test_01_cache_list(self):
+        self.assertTrue(self.checker_dict([1], self.ustr._parts))
+        for name in ['vr1', 'vr2', 'vr10', 'a.b', 'axb']:
+            self.ustr._parts[0]("ObjectXX:" + name, "type1", {"xx": 0})
+        self.ustr._parts[1]("ObjectXX:vr3", "type2", {"xx": 0})
+        uvedbcache = self.ustr._uvedbcache
+        def cache_list(kfilt=None, cfilt=None):
+            patterns = None
+            if kfilt is not None:
+                patterns = set(UVEServer.get_uve_regex.__func__(None, filt) \
+                               for filt in kfilt)
+            with mock.patch.object(uvedbcache, '_get_uve_content',
+                    side_effect=lambda table, barekeys, *args: \
+                        dict.fromkeys(barekeys)):
+                return uvedbcache.get_cache_list(['ObjectXX'],
+                    {'kfilt': kfilt, 'cfilt': cfilt}, patterns,
+                    True).get('ObjectXX', set())
+        self.assertEqual(set(['vr1', 'vr2', 'vr10', 'a.b', 'axb', 'vr3']),
+                         cache_list())
+        self.assertEqual(set(['vr1', 'vr10']), cache_list(['vr1*']))
+        self.assertEqual(set(['vr1']), cache_list(['vr1']))
+        self.assertEqual(set(['vr1']), cache_list(['*1']))
+        # kfilt globs are matched as regexes
+        self.assertEqual(set(['a.b', 'axb']), cache_list(['a.b']))
+        self.assertEqual(set(['vr3']),
+                         cache_list(['vr*'], {'type2': set()}))
+
+        # Deleted UVEs are removed from all the indexes
+        self.ustr._parts[0]("ObjectXX:vr10", None, None)
+        self.assertEqual(set(['vr1']), cache_list(['vr1*']))
+        del self.mock_agp[1]
+        self.assertTrue(self.checker_dict(["type2"], uvedbcache._typekeys,
+                                          False))
+        self.assertEqual(['a.b', 'axb', 'vr1', 'vr2'],
+                         uvedbcache._sortedkeys['ObjectXX'])
+
+    def test_02_cache_memory(self):
+        self.assertTrue(self.checker_dict([1], self.ustr._parts))
+        self.ustr._parts[0]("ObjectXX:uve1", "type1", {"xx": 0})
+        self.ustr._parts[0]("ObjectXX:uve1", "type2", {"xx": 0})
+        self.ustr._parts[1](u"ObjectYY:uve2", u"type1", {"xx": 0})
+        uvedbcache = self.ustr._uvedbcache
+        # The table and struct type names are shared by all the UVEs
+        self.assertIs(uvedbcache._uvedb['ObjectXX']['uve1'].types[0],
+                      uvedbcache._uvedb['ObjectYY']['uve2'].types[0])
+        self.assertEqual({'type1': None, 'type2': None,
+                          '__SOURCE__': {'instance_id': '0',
+                                         'ip_address': socket.getfqdn(
+                                             "127.0.0.1"),
+                                         'partition': 0}},
+                         uvedbcache.get_uvedb_cache_uve('ObjectXX', 'uve1'))
+        mem = uvedbcache.get_uvedb_cache_memory()
+        self.assertEqual(2, mem['uves'])
+        self.assertEqual(2, mem['types'])
+        self.assertEqual(3, mem['type_entries'])
+        self.assertEqual(2, mem['partition_entries'])
+        self.assertEqual(1, mem['tables']['ObjectYY']['uves'])
+        self.assertTrue(mem['bytes'] > 0)
+
+        self.ustr._parts[0]("ObjectXX:uve1", "type2", None)
+        self.assertEqual(('type1',),
+                         uvedbcache._uvedb['ObjectXX']['uve1'].types)
+        del self.mock_agp[1]
+        self.assertTrue(self.checker_dict(["ObjectYY", "uve2"],
+                                          uvedbcache._uvedb, False))
+        self.assertEqual(1, uvedbcache.get_uvedb_cache_memory()['uves'])
+
+    def test_03_value_cache(self):
+        self.assertTrue(self.checker_dict([0], self.ustr._parts))
+        self.ustr._parts[0]("ObjectXX:uve1", "type1", {"xx": 0})
+        uvedbcache = self.ustr._uvedbcache
+        values = [{'type1': '{"xx": 0}'}]
+        def execute():
+            return values
+        redish = mock.MagicMock()
+        redish.pipeline.return_value.execute.side_effect = execute
+        uvedbcache._get_agg_redis_instance = mock.Mock(return_value=redish)
+        execute_calls = redish.pipeline.return_value.execute
+
+        self.assertEqual({'type1': {'xx': 0}},
+            uvedbcache.get_cache_uve('ObjectXX:uve1', None))
+        self.assertEqual({'type1': {'xx': 0}},
+            uvedbcache.get_cache_uve('ObjectXX:uve1', None))
+        self.assertEqual(1, execute_calls.call_count)
+        # Without filters, the UVEs can be given as JSON text
+        rsp = uvedbcache.get_cache_list(['ObjectXX'], {}, None, False, True)
+        self.assertEqual({'type1': {'xx': 0}},
+                         json.loads(rsp['ObjectXX']['uve1']))
+        rsp = uvedbcache.get_cache_list(['ObjectXX'],
+            {'cfilt': {'type1': set()}}, None, False, True)
+        self.assertEqual({'uve1': {'type1': {'xx': 0}}}, rsp['ObjectXX'])
+        self.assertEqual(1, execute_calls.call_count)
+
+        # An update of the UVE invalidates its values
+        values = [{'type1': '{"xx": 1}'}]
+        self.ustr._parts[0]("ObjectXX:uve1", "type1", {"xx": 1})
+        self.assertEqual({'type1': {'xx': 1}},
+            uvedbcache.get_cache_uve('ObjectXX:uve1', None))
+        self.assertEqual(2, execute_calls.call_count)
+
+        # Values read while the UVE is being updated are not cached
+        def execute_update():
+            self.ustr._parts[0]("ObjectXX:uve1", "type1", {"xx": 2})
+            return [{'type1': '{"xx": 1}'}]
+        execute_calls.side_effect = execute_update
+        self.ustr._parts[0]("ObjectXX:uve1", "type1", {"xx": 1})
+        self.assertEqual({'type1': {'xx': 1}},
+            uvedbcache.get_cache_uve('ObjectXX:uve1', None))
+        execute_calls.side_effect = lambda: [{'type1': '{"xx": 2}'}]
+        self.assertEqual({'type1': {'xx': 2}},
+            uvedbcache.get_cache_uve('ObjectXX:uve1', None))
+        self.assertEqual(4, execute_calls.call_count)
+
+    def test_04_alarms(self):
+        self.assertTrue(self.checker_dict([1], self.ustr._parts))
+        self.ustr._parts[0]("ObjectXX:uve1", "type1", {"xx": 0})
+        self.ustr._parts[0]("ObjectXX:uve2", "UVEAlarms", {"alarms": []})
+        self.ustr._parts[1]("ObjectYY:uve3", "type1", {"xx": 0})
+        uvedbcache = self.ustr._uvedbcache
+        redish = mock.MagicMock()
+        redish.pipeline.return_value.execute.return_value = \
+            [{'UVEAlarms': '{"alarms": [{"type": "alarm1"}]}'}]
+        uvedbcache._get_agg_redis_instance = mock.Mock(return_value=redish)
+        uveserver = UVEServer([], logging, uvedbcache=self.ustr,
+                              usecache=True)
+
+        # The alarms are read from the cache, for the UVEs with alarms
+        filters = {'cfilt': {'UVEAlarms': set()}}
+        self.assertEqual({'ObjectXX': {'uve2': {'UVEAlarms':
+                             {'alarms': [{'type': 'alarm1'}]}}}},
+                         uveserver.get_alarms(filters))
+        redish.pipeline.return_value.hgetall.assert_called_once_with(
+            'AGPARTVALUES:0:0:ObjectXX:uve2')
+        self.assertEqual({}, uveserver.get_alarms(
+            dict(filters, tablefilt=['ObjectYY'])))
+        self.assertEqual({}, uveserver.get_alarms(
+            dict(filters, kfilt=['uve1'])))
+
+
+# Tests for the pubsub loop of UveStreamPart
+class TestUveStreamPart(unittest.TestCase):
+
+    @mock.patch('opserver.partition_handler.StrictRedisWrapper')
+    def test_00_listen(self, MockRedis):
+        msgs = [None, None, {'type': 'subscribe', 'data': 1},
+                {'type': 'message', 'data': json.dumps(
+                    [{'key': 'ObjectXX:uve1', 'type': 'type1'}])}]
+        def get_message(timeout=0):
+            # The loop must block on the socket instead of polling
+            self.assertEqual(5, timeout)
+            if msgs:
+                return msgs.pop(0)
+            gevent.sleep(60)
+        lredis = MockRedis.return_value
+        lredis.smembers.return_value = set()
+        # The first pipeline is the initial sync of the partition
+        lredis.pipeline.return_value.execute.side_effect = \
+            [[], [json.dumps({'xx': 1})]]
+        lredis.pubsub.return_value.get_message.side_effect = get_message
+        cb = mock.Mock()
+        pi = PartInfo(ip_address="127.0.0.1", acq_time=666,
+                      redis_agg_db=0, instance_id="0", port=6379)
+        usp = UveStreamPart(0, logging, cb, pi, None, {})
+        usp.start()
+        gevent.sleep(0.1)
+        usp.kill()
+        cb.assert_called_once_with(0, pi, 'ObjectXX:uve1', 'type1', {'xx': 1})
+        self.assertEqual(4, usp.wakeups())
+
+
+# Tests for UveStreamHub and UveStreamClient
+class TestUveStreamHub(unittest.TestCase, TestChecker):
+
+    def setUp(self):
+        self.mock_agp = Mock_agp()
+        self.mock_agp[0] = PartInfo(ip_address=socket.getfqdn("127.0.0.1"),
+                                    acq_time=666,
+                                    redis_agg_db=0,
+                                    instance_id="0",
+                                    port=6379)
+        self.mock_agp[1] = PartInfo(ip_address=socket.getfqdn("127.0.0.1"),
+                                    acq_time=777,
+                                    redis_agg_db=0,
+                                    instance_id="0",
+                                    port=6379)
+        self.hub = UveStreamHub(logging, self.mock_agp, None, None, Mock_usp,
+                                qsize=4)
+        self.hub.start()
+
+    def tearDown(self):
+        self.hub.kill()
+
+    def _events(self, client, count):
+        events = []
+        for msg in client.stream():
+            lines = msg.strip().split('\n')
+            events.append((lines[0].split(': ', 1)[1],
+                           json.loads(lines[1].split(': ', 1)[1])))
+            if len(events) == count:
+                break
+        return events
+
+    def test_00_fanout(self):
+        client1 = self.hub.client(None)
+        client2 = self.hub.client(None, cfilter={'UVEAlarms':set()})
+        stream1 = client1.stream()
+        stream2 = client2.stream()
+        next(stream1)
+        next(stream2)
+        # Both the clients share a single subscription per partition
+        self.assertEqual(set([0, 1]), set(self.hub._parts.keys()))
+
+        self.hub._parts[0]("ObjectXX:uve1", "type1", {"xx": 0})
+        self.hub._parts[1]("ObjectXX:uve2", "UVEAlarms", {"alarms": []})
+        self.assertEqual(2, client1._q.qsize())
+        self.assertEqual(1, client2._q.qsize())
+        self.assertEqual(
+            {'key': 'ObjectXX:uve2', 'type': 'UVEAlarms',
+             'value': {'alarms': []}},
+            json.loads(next(stream2).split('data: ', 1)[1]))
+
+        # A new client gets the shared snapshot first
+        client3 = self.hub.client(None, tablefilt=['ObjectXX'])
+        events = self._events(client3, 3)
+        self.assertEqual('init', events[0][0])
+        self.assertEqual(
+            sorted(['ObjectXX:uve1', 'ObjectXX:uve2']),
+            sorted([ev[1]['key'] for ev in events[1:]]))
+
+        # Losing a partition deletes its UVEs for the clients
+        del self.mock_agp[0]
+        self.assertTrue(self.checker_dict([0], self.hub._parts, False))
+        self.assertFalse("ObjectXX:uve1" in self.hub._uves)
+
+    def test_01_slow_client(self):
+        client = self.hub.client(None)
+        stream = client.stream()
+        next(stream)
+        for idx in range(5):
+            self.hub._parts[0]("ObjectXX:uve%d" % idx, "type1", {"xx": idx})
+        # The client fell behind by more than qsize and is dropped
+        self.assertFalse(client in self.hub._clients)
+        self.assertEqual(['stop'],
+            [msg.split('\n')[0].split(': ')[1] for msg in stream])
+
+        # Partitions are released when there are no clients left
+        self.assertTrue(self.checker_exact({}, self.hub._parts))
+
+    def test_02_permissions(self):
+        token = {'is_global_read_only_role': False,
+                 'token_info': {'token': {'project': {'id': 'ab-cd',
+                     'name': 'project1', 'domain': {'id': 'default'}}}}}
+        def contrail_config(owner):
+            return {'elements': {'perms2': repr({'owner': owner,
+                'owner_access': 7, 'global_access': 0, 'share': []})}}
+        client = self.hub.client(None, token=token)
+        stream = client.stream()
+        next(stream)
+        with mock.patch('opserver.partition_handler.ast.literal_eval',
+                        wraps=ast.literal_eval) as literal_eval:
+            self.hub._parts[0]("ObjectXX:uve1", "ContrailConfig",
+                               contrail_config('abcd'))
+            self.hub._parts[0]("ObjectXX:uve2", "ContrailConfig",
+                               contrail_config('ef01'))
+            for idx in range(2):
+                self.hub._parts[0]("ObjectXX:uve1", "type1", {"xx": idx})
+                self.hub._parts[0]("ObjectXX:uve2", "type1", {"xx": idx})
+            # perms2 is parsed once per ContrailConfig update
+            self.assertEqual(2, literal_eval.call_count)
+        def queued_keys():
+            keys = []
+            while not client._q.empty():
+                msg = client._q.get_nowait()
+                keys.append(json.loads(msg.split('data: ', 1)[1])['key'])
+            return keys
+        self.assertEqual(['ObjectXX:uve1'] * 3, queued_keys())
+
+        # The decision is made again when the permissions change
+        self.hub._parts[0]("ObjectXX:uve2", "ContrailConfig",
+                           contrail_config('ab-cd'))
+        self.hub._parts[0]("ObjectXX:uve2", "type1", {"xx": 2})
+        self.assertEqual(['ObjectXX:uve2'] * 2, queued_keys())
+
+    def test_03_sync(self):
+        client = self.hub.client(None)
+        stream = client.stream()
+        next(stream)
+        # A partition with more UVEs than qsize is queued as one entry
+        uves = [("ObjectXX:uve%d" % idx, "type1", {"xx": idx}) \
+                for idx in range(10)]
+        self.hub._parts[0].sync(uves)
+        self.assertTrue(client in self.hub._clients)
+        self.assertEqual(1, client._q.qsize())
+        def next_events(count):
+            return [json.loads(next(stream).split('data: ', 1)[1]) \
+                    for idx in range(count)]
+        # The initial snapshot already has the UVEs of the partition,
+        # which are then read again from the queued sync
+        keys = sorted(uve[0] for uve in uves)
+        events = next_events(20)
+        self.assertEqual(keys, sorted(ev['key'] for ev in events[:10]))
+        self.assertEqual(keys, sorted(ev['key'] for ev in events[10:]))
+
+        # The partition changes owner: its UVEs are deleted and synced
+        self.mock_agp[0] = PartInfo(ip_address=socket.getfqdn("127.0.0.1"),
+                                    acq_time=888,
+                                    redis_agg_db=0,
+                                    instance_id="1",
+                                    port=6379)
+        self.hub._update_partitions()
+        self.hub._parts[0].sync(uves[:5])
+        self.assertTrue(client in self.hub._clients)
+        self.assertEqual(2, client._q.qsize())
+        events = next_events(15)
+        self.assertEqual([None] * 10, [ev['type'] for ev in events[:10]])
+        self.assertEqual(keys, sorted(ev['key'] for ev in events[:10]))
+        self.assertEqual(['type1'] * 5, [ev['type'] for ev in events[10:]])
+        self.assertEqual(sorted(uve[0] for uve in uves[:5]),
+                         sorted(ev['key'] for ev in events[10:]))
+
 
 # Tests for all AlarmGenerator code, using mocks for 
 # external interfaces for UVEServer, Kafka, libpartition
@@ -279,6 +620,7 @@ class TestAlarmGen(unittest.TestCase, TestChecker):
                            '--redis_uve_list '+socket.getfqdn("127.0.0.1")+':0 '
                            '--redis_server_port 0')
         config.parse()
+        AlarmStateMachine.timers = AlarmTimerQueue()
         self._ag = Controller(config, logging)
         self._agtask = gevent.spawn(self._ag.run_uve_processing)
 
@@ -373,13 +715,13 @@ class TestAlarmGen(unittest.TestCase, TestChecker):
     @mock.patch('opserver.alarmgen.Controller.send_agg_uve')
     @mock.patch.object(UVEServer, 'redis_instances')
     @mock.patch.object(UVEServer, 'get_part')
-    @mock.patch.object(UVEServer, 'get_uve')
+    @mock.patch.object(UVEServer, 'get_uves')
     @mock.patch('opserver.partition_handler.KafkaConsumer', autospec=True)
     # Test partition Initialization, including boot-straping using UVEServer
     # Test partition shutdown as well
     def test_00_init(self,
             mock_KafkaConsumer,
-            mock_get_uve, mock_get_part, mock_redis_instances,
+            mock_get_uves, mock_get_part, mock_redis_instances,
             mock_send_agg_uve, mock_clear_agg_uve, mock_reconnect_agg_uve):
 
         m_get_part = Mock_get_part() 
@@ -388,9 +730,9 @@ class TestAlarmGen(unittest.TestCase, TestChecker):
                 { "ObjectXX:uve1" : {"type1":{}}  }}
         mock_get_part.side_effect = m_get_part
 
-        m_get_uve = Mock_get_uve()
-        m_get_uve["ObjectXX:uve1"] = {"type1": {"xx": 0}}
-        mock_get_uve.side_effect = m_get_uve
+        m_get_uves = Mock_get_uves()
+        m_get_uves["ObjectXX:uve1"] = {"type1": {"xx": 0}}
+        mock_get_uves.side_effect = m_get_uves
 
         m_redis_instances = Mock_redis_instances()
         m_redis_instances[(socket.getfqdn("127.0.0.1"),0)] = 0
@@ -417,13 +759,13 @@ class TestAlarmGen(unittest.TestCase, TestChecker):
     @mock.patch('opserver.alarmgen.Controller.send_agg_uve')
     @mock.patch.object(UVEServer, 'redis_instances')
     @mock.patch.object(UVEServer, 'get_part')
-    @mock.patch.object(UVEServer, 'get_uve')
+    @mock.patch.object(UVEServer, 'get_uves')
     @mock.patch('opserver.partition_handler.KafkaConsumer', autospec=True)
     # Test initialization followed by read from Kafka
     # Also test for deletetion of a boot-straped UVE
     def test_01_rxmsg(self,
             mock_KafkaConsumer,
-            mock_get_uve, mock_get_part, mock_redis_instances,
+            mock_get_uves, mock_get_part, mock_redis_instances,
             mock_send_agg_uve, mock_clear_agg_uve, mock_reconnect_agg_uve):
 
         m_get_part = Mock_get_part() 
@@ -433,9 +775,9 @@ class TestAlarmGen(unittest.TestCase, TestChecker):
         mock_get_part.side_effect = m_get_part
 
         # Boostraped UVE ObjectXX:uve1 is not present!
-        m_get_uve = Mock_get_uve()
-        m_get_uve["ObjectYY:uve2"] = {"type2": {"yy": 1}}
-        mock_get_uve.side_effect = m_get_uve
+        m_get_uves = Mock_get_uves()
+        m_get_uves["ObjectYY:uve2"] = {"type2": {"yy": 1}}
+        mock_get_uves.side_effect = m_get_uves
 
         m_redis_instances = Mock_redis_instances()
         m_redis_instances[(socket.getfqdn("127.0.0.1"),0)] = 0
@@ -461,13 +803,13 @@ class TestAlarmGen(unittest.TestCase, TestChecker):
     @mock.patch('opserver.alarmgen.Controller.send_agg_uve')
     @mock.patch.object(UVEServer, 'redis_instances')
     @mock.patch.object(UVEServer, 'get_part')
-    @mock.patch.object(UVEServer, 'get_uve')
+    @mock.patch.object(UVEServer, 'get_uves')
     @mock.patch('opserver.partition_handler.KafkaConsumer', autospec=True)
     # Test late bringup of collector
     # Also test collector shutdown
     def test_02_collectorha(self,
             mock_KafkaConsumer,
-            mock_get_uve, mock_get_part, mock_redis_instances,
+            mock_get_uves, mock_get_part, mock_redis_instances,
             mock_send_agg_uve, mock_clear_agg_uve, mock_reconnect_agg_uve):
 
         m_get_part = Mock_get_part() 
@@ -479,11 +821,11 @@ class TestAlarmGen(unittest.TestCase, TestChecker):
                 { "ObjectZZ:uve3" : { "type3":{}}  }}
         mock_get_part.side_effect = m_get_part
 
-        m_get_uve = Mock_get_uve()
-        m_get_uve["ObjectXX:uve1"] = {"type1": {"xx": 0}}
-        m_get_uve["ObjectYY:uve2"] = {"type2": {"yy": 1}}
-        m_get_uve["ObjectZZ:uve3"] = {"type3": {"zz": 2}}
-        mock_get_uve.side_effect = m_get_uve
+        m_get_uves = Mock_get_uves()
+        m_get_uves["ObjectXX:uve1"] = {"type1": {"xx": 0}}
+        m_get_uves["ObjectYY:uve2"] = {"type2": {"yy": 1}}
+        m_get_uves["ObjectZZ:uve3"] = {"type3": {"zz": 2}}
+        mock_get_uves.side_effect = m_get_uves
 
         m_redis_instances = Mock_redis_instances()
         m_redis_instances[(socket.getfqdn("127.0.0.1"),0)] = 0
@@ -516,7 +858,7 @@ class TestAlarmGen(unittest.TestCase, TestChecker):
 
         # Withdraw collector 127.0.0.1
         self.assertTrue(self.checker_dict([1, "ObjectXX", "uve1"], self._ag.ptab_info))
-        del m_get_uve["ObjectXX:uve1"]
+        del m_get_uves["ObjectXX:uve1"]
         del m_redis_instances[(socket.getfqdn("127.0.0.1"),0)]
         self.assertTrue(self.checker_dict([1, "ObjectXX", "uve1"], self._ag.ptab_info, False))
 
@@ -4211,6 +4553,460 @@ class TestAlarmGen(unittest.TestCase, TestChecker):
                 asm.is_new_alarm_same(new_alarm_obj))
     # end test_06_is_new_alarm_same
 
+    def test_07_alarm_rules_benchmark(self):
+        alarm_cfg = self.get_alarm_config_object(
+            {
+                'name': 'alarm1',
+                'uve_keys': ['ObjectVRouter'],
+                'alarm_severity': AlarmBase.ALARM_MAJOR,
+                'alarm_rules': {
+                    'or_list': [
+                        {
+                            'and_list': [
+                                {
+                                    'operand1': 'NodeStatus.process_info',
+                                    'operation': '!=',
+                                    'operand2': {
+                                        'json_value': 'null'
+                                    }
+                                },
+                                {
+                                    'operand1': 'NodeStatus.process_info.'
+                                        'process_state',
+                                    'operation': '!=',
+                                    'operand2': {
+                                        'json_value': '"PROCESS_STATE_RUNNING"'
+                                    },
+                                    'variables': ['NodeStatus.process_info.'
+                                        'process_name']
+                                }
+                            ]
+                        },
+                        {
+                            'and_list': [
+                                {
+                                    'operand1': 'VrouterAgent.'
+                                        'down_interface_count',
+                                    'operation': '>=',
+                                    'operand2': {
+                                        'json_value': '1'
+                                    },
+                                },
+                                {
+                                    'operand1': 'VrouterAgent.'
+                                        'down_interface_count',
+                                    'operation': 'not in',
+                                    'operand2': {
+                                        'uve_attribute':
+                                            'VrouterAgent.ignored_counts'
+                                    },
+                                }
+                            ]
+                        }
+                    ]
+                },
+                'kwargs': {
+                    'parent_type': 'global-system-config',
+                    'fq_name': ['global-syscfg-default', 'alarm1'],
+                    'id_perms': IdPermsType(enable=True,
+                        description='alarm1 description')
+                }
+            }
+        )
+        uves = []
+        for idx in range(200):
+            uves.append(('ObjectVRouter:host%d' % idx, {
+                'NodeStatus': {
+                    'process_info': [
+                        {'process_name': 'proc%d' % pidx,
+                         'process_state': 'PROCESS_STATE_RUNNING' \
+                            if (idx + pidx) % 3 else 'PROCESS_STATE_STOPPED'}
+                        for pidx in range(8)]
+                },
+                'VrouterAgent': {
+                    'down_interface_count': idx % 4,
+                    'ignored_counts': [2]
+                }
+            }))
+        alarm_processor = AlarmProcessor(self._ag._sandesh)
+
+        # Evaluate the rules with the interpreter that was used before
+        # the rules were compiled
+        baseline = BaselineAlarmRules()
+        start = time.time()
+        expected = [baseline._evaluate_uve_for_alarms(
+            alarm_cfg, uve_key, uve) for uve_key, uve in uves]
+        baseline_time = time.time() - start
+
+        # Compile the rules once and evaluate them for all the UVEs
+        rule_set = AlarmRuleSet(alarm_cfg)
+        start = time.time()
+        result = [rule_set.evaluate(uve_key, uve) for uve_key, uve in uves]
+        compiled_time = time.time() - start
+
+        self.assertEqual(expected, result)
+        self.assertTrue(any(result))
+        logging.info('Alarm rules/sec: baseline %d, compiled %d' %
+            (len(uves) / max(baseline_time, 1e-6),
+             len(uves) / max(compiled_time, 1e-6)))
+
+        # process_alarms compiles the rules of alarms that were not
+        # loaded by the config handler, once per alarm config
+        alarm = AlarmBase(config=alarm_cfg)
+        alarm_processor.process_alarms('alarm1', alarm, uves[0][0],
+            uves[0][1])
+        rule_set = alarm.rule_set()
+        self.assertTrue(rule_set is not None)
+        for uve_key, uve in uves[1:]:
+            alarm_processor.process_alarms('alarm1', alarm, uve_key, uve)
+        self.assertTrue(alarm.rule_set() is rule_set)
+        last_or_list = [or_list for or_list in expected if or_list][-1]
+        self.assertEqual(AlarmRules(last_or_list),
+            alarm_processor.uve_alarms['alarm1'].alarm_rules)
+        alarm.set_config(alarm_cfg)
+        self.assertTrue(alarm.rule_set() is None)
+    # end test_07_alarm_rules_benchmark
+
+    def test_08_alarm_timers(self):
+        self._ag.tab_alarms = {}
+        self.add_test_alarm('table1', 'name1', 'type1')
+        self.add_test_alarm('table1', 'name2', 'type1')
+        self.add_test_alarm('table1', 'name3', 'type1')
+        asm1 = self._ag.tab_alarms['table1']['table1:name1']['type1']
+        asm2 = self._ag.tab_alarms['table1']['table1:name2']['type1']
+        asm3 = self._ag.tab_alarms['table1']['table1:name3']['type1']
+        timers = AlarmStateMachine.timers
+        curr_time = int(time.time())
+
+        # Soak_Active timers
+        asm1.get_uac().ActiveTimer = 2
+        asm1.set_alarms()
+        asm2.get_uac().ActiveTimer = 1
+        asm2.set_alarms()
+        self.assertEqual(UVEAlarmState.Soak_Active, asm2.get_uas().state)
+        self.assertEqual(2, len(timers))
+        # Clearing the alarm cancels its timer
+        self.assertTrue(asm2.clear_alarms())
+        self.assertEqual(1, len(timers))
+        self.assertFalse(('table1', 'table1:name2', 'type1') in timers)
+
+        # Soak_Idle timer followed by a delete timer
+        asm3.get_uas().state = UVEAlarmState.Active
+        asm3.get_uac().IdleTimer = 1
+        asm3.get_uac().FreqCheck_Seconds = 5
+        self.assertFalse(asm3.clear_alarms())
+        self.assertEqual(2, len(timers))
+
+        delete_alarms, update_alarms = AlarmStateMachine.run_timers(
+            curr_time, self._ag.tab_alarms)
+        self.assertEqual(([], []), (delete_alarms, update_alarms))
+
+        # All the timers due during a long pause are run at once,
+        # including the delete timer started by the Soak_Idle timer
+        delete_alarms, update_alarms = AlarmStateMachine.run_timers(
+            curr_time + 3600, self._ag.tab_alarms)
+        self.assertEqual([('table1', 'table1:name3', 'type1')],
+            delete_alarms)
+        self.assertEqual(sorted([('table1', 'table1:name1', 'type1'),
+            ('table1', 'table1:name3', 'type1')]), sorted(update_alarms))
+        self.assertEqual(UVEAlarmState.Active, asm1.get_uas().state)
+        self.assertEqual(0, len(timers))
+        self.assertEqual(3, timers.fired)
+        self.assertTrue(timers.lag >= 3600 - 6)
+        self.assertEqual(curr_time + 3600, timers.last_run)
+    # end test_08_alarm_timers
+
+    def _get_agg_uves(self, redish, inst, part):
+        agg_uves = {}
+        for key in redish.smembers('AGPARTKEYS:%s:%d' % (inst, part)):
+            agg_uves[key] = redish.hgetall('AGPARTVALUES:%s:%d:%s' % \
+                (inst, part, key))
+        return agg_uves
+    # end _get_agg_uves
+
+    def test_09_send_agg_uve_benchmark(self):
+        port = get_free_port()
+        self.assertTrue(mockredis.start_redis(port))
+        try:
+            redish = redis.StrictRedis(host='127.0.0.1', port=port, db=0)
+            pubsub = redish.pubsub()
+            pubsub.psubscribe('AGPARTPUB:*')
+            rows = []
+            for idx in range(200):
+                key = 'ObjectVRouter:host%d' % idx
+                for typ in ['NodeStatus', 'VrouterAgent', 'VrouterStatsAgent']:
+                    rows.append(OutputRow(key=key, typ=typ,
+                        val={'idx': idx, 'typ': typ}))
+            # Remove a struct, a struct that leaves the UVE empty and a UVE
+            rows.append(OutputRow(key='ObjectVRouter:host0',
+                typ='NodeStatus', val=None))
+            rows.append(OutputRow(key='ObjectVRouter:host1',
+                typ='NodeStatus', val=None))
+            rows.append(OutputRow(key='ObjectVRouter:host1',
+                typ='VrouterAgent', val=None))
+            rows.append(OutputRow(key='ObjectVRouter:host1',
+                typ='VrouterStatsAgent', val=None))
+            rows.append(OutputRow(key='ObjectVRouter:host2', typ=None,
+                val=None))
+
+            # Pipeline write path, in chunks of _max_out_rows as done by
+            # run_uve_agg
+            self._ag._agg_uve_script = False
+            start = time.time()
+            for idx in range(0, len(rows), self._ag._max_out_rows):
+                self._ag.send_agg_uve(redish, 'pipeline', 0, 100,
+                    rows[idx:idx + self._ag._max_out_rows])
+            pipeline_time = time.time() - start
+
+            # Scripted write path
+            self._ag._agg_uve_script = None
+            start = time.time()
+            self._ag.send_agg_uve(redish, 'script', 0, 100, rows)
+            script_time = time.time() - start
+            self.assertTrue(self._ag._agg_uve_script)
+            logging.info('send_agg_uve of %d rows: pipeline %.3fs, '
+                'script %.3fs' % (len(rows), pipeline_time, script_time))
+
+            agg_uves = self._get_agg_uves(redish, 'script', 0)
+            self.assertEqual(self._get_agg_uves(redish, 'pipeline', 0),
+                agg_uves)
+            self.assertEqual(198, len(agg_uves))
+            self.assertEqual({'VrouterAgent', 'VrouterStatsAgent'},
+                set(agg_uves['ObjectVRouter:host0'].keys()))
+            self.assertEqual('100', redish.hget('AGPARTS:script', 0))
+
+            # The same changes are published by both the paths
+            published = {'pipeline': [], 'script': []}
+            while True:
+                msg = pubsub.get_message(timeout=1)
+                if msg is None:
+                    break
+                if msg['type'] == 'pmessage':
+                    published[msg['channel'].split(':')[1]].extend(
+                        json.loads(msg['data']))
+            self.assertEqual(len(rows), len(published['script']))
+            self.assertEqual(published['pipeline'], published['script'])
+
+            # Contents of a stale acquisition of the partition are removed
+            self._ag.send_agg_uve(redish, 'script', 0, 200,
+                [OutputRow(key='ObjectVRouter:host5', typ='NodeStatus',
+                           val={})])
+            self.assertEqual({'ObjectVRouter:host5': {'NodeStatus': '{}'}},
+                self._get_agg_uves(redish, 'script', 0))
+            self.assertEqual('200', redish.hget('AGPARTS:script', 0))
+        finally:
+            mockredis.stop_redis(port)
+    # end test_09_send_agg_uve_benchmark
+
+    @retry(delay=1, tries=3)
+    def checker_checkpoint(self, redish, part, offset):
+        ckpt = redish.hget('AGPARTCKPT:%s' % self._ag._instance_id, part)
+        logging.info("checkpoint exp %s actual %s" % (str(offset), str(ckpt)))
+        if ckpt is None:
+            return offset is None
+        return offset is not None and json.loads(ckpt)['offset'] == offset
+
+    @mock.patch('opserver.alarmgen.Controller.reconnect_agg_uve')
+    @mock.patch('opserver.alarmgen.Controller.get_redis_instance')
+    @mock.patch.object(UVEServer, 'redis_instances')
+    @mock.patch.object(UVEServer, 'get_part')
+    @mock.patch.object(UVEServer, 'get_uves')
+    @mock.patch('opserver.partition_handler.KafkaConsumer', autospec=True)
+    # Test that a restarted alarmgen resumes the partition from the
+    # checkpointed kafka offset, instead of reloading all the UVEs
+    def test_10_partition_resume(self,
+            mock_KafkaConsumer,
+            mock_get_uves, mock_get_part, mock_redis_instances,
+            mock_get_redis_instance, mock_reconnect_agg_uve):
+        port = get_free_port()
+        self.assertTrue(mockredis.start_redis(port))
+        try:
+            redish = redis.StrictRedis(host='127.0.0.1', port=port, db=0)
+            mock_get_redis_instance.return_value = redish
+            coll = socket.getfqdn("127.0.0.1")
+
+            m_get_part = Mock_get_part()
+            m_get_part[(1,(coll,0,0))] = coll + ":0", \
+                { "gen1" :
+                    { "ObjectXX:uve1" : {"type1":{}}  }}
+            mock_get_part.side_effect = m_get_part
+
+            m_get_uves = Mock_get_uves()
+            m_get_uves["ObjectXX:uve1"] = {"type1": {"xx": 0}}
+            m_get_uves["ObjectYY:uve2"] = {"type2": {"yy": 1}}
+            mock_get_uves.side_effect = m_get_uves
+
+            m_redis_instances = Mock_redis_instances()
+            m_redis_instances[(coll,0)] = 0
+            mock_redis_instances.side_effect = m_redis_instances
+
+            m_poll = Mock_poll()
+            mock_KafkaConsumer.return_value.poll.side_effect = m_poll
+            mock_KafkaConsumer.return_value.position.return_value = 10
+
+            # Load the partition, it gets checkpointed at offset 10
+            self._ag._ckpt_interval = 0
+            self._ag.libpart_cb([1])
+            self.assertTrue(self.checker_dict([1, "ObjectXX", "uve1"],
+                self._ag.ptab_info))
+            self.assertTrue(self.checker_checkpoint(redish, 1, 10))
+            self.assertFalse(mock_KafkaConsumer.return_value.seek.called)
+
+            # Restart alarmgen, without giving up the partition
+            self._ag._workers[1].kill()
+            self._agtask.kill()
+            AlarmStateMachine.timers = AlarmTimerQueue()
+            self._ag = Controller(self._ag._conf, logging)
+            self._ag._ckpt_interval = 0
+            self._agtask = gevent.spawn(self._ag.run_uve_processing)
+            ncalls = mock_get_uves.call_count
+
+            # ObjectYY:uve2 was added while alarmgen was down
+            m_poll["ObjectYY:uve2"] = ConsumerRecord(topic='-uve',
+                        partition=0, offset=10,
+                        key='ObjectYY:uve2|type2|gen1|' + coll + ':0',
+                        value='{}')
+            self._ag.libpart_cb([1])
+            self.assertTrue(self.checker_exact(\
+                {"type1" : {"xx": 0}},
+                self._ag.ptab_info[1]["ObjectXX"]["uve1"].values()))
+            self.assertTrue(self.checker_dict([1, "ObjectYY", "uve2"],
+                self._ag.ptab_info))
+            self.assertTrue(self.checker_checkpoint(redish, 1, 11))
+            mock_KafkaConsumer.return_value.seek.assert_called_once_with(
+                mock.ANY, 10)
+
+            # Only the UVE in the replayed message is read from the
+            # collectors
+            keys = set()
+            for args, kwargs in mock_get_uves.call_args_list[ncalls:]:
+                keys.update(args[0])
+            self.assertEqual(set(["ObjectYY:uve2"]), keys)
+            self.assertEqual({"yy": 1}, json.loads(redish.hget(
+                'AGPARTVALUES:%s:1:ObjectYY:uve2' % self._ag._instance_id,
+                'type2')))
+
+            # The checkpoint is removed when giving up the partition
+            self._ag.libpart_cb([])
+            self.assertTrue(self.checker_checkpoint(redish, 1, None))
+        finally:
+            mockredis.stop_redis(port)
+    # end test_10_partition_resume
+
+    def test_11_uve_stream_batch(self):
+        coll = socket.getfqdn("127.0.0.1") + ':0'
+        notifs = []
+        notif_offsets = []
+        def callback(part, uves, offsets=None):
+            notifs.append((part, uves))
+            notif_offsets.append(offsets)
+        usp = UveStreamProc('', 1, '-uve-1', logging, callback,
+            '127.0.0.1', None, '0', 0, False, None)
+        usp.start_partition({coll: {'gen1': {'ObjectXX:uve1':
+            {'type1': {}}}}})
+        del notifs[:]
+
+        def msg(offset, key, typ, value):
+            return ConsumerRecord(topic='-uve-1', partition=0,
+                offset=offset, key='|'.join([key, typ, 'gen1', coll]),
+                value=value)
+        mlist = [msg(0, 'ObjectXX:uve1', 'type1', '{}'),
+                 msg(1, 'ObjectXX:uve1', 'type2', '{"xx": 1}'),
+                 msg(2, 'ObjectYY:uve2', 'type2', '{}'),
+                 msg(3, 'ObjectXX:uve1', 'type1', '{}'),
+                 msg(4, 'ObjectYY:uve2', 'type2', ''),
+                 msg(5, 'ObjectZZ:uve3', 'type3', '{}')]
+        # Ignored, the collector is not synced
+        mlist.append(ConsumerRecord(topic='-uve-1', partition=0, offset=6,
+            key='ObjectXX:uve1|type3|gen1|127.0.0.5:0', value='{}'))
+        self.assertTrue(usp.msg_handler(mlist))
+
+        # All the changes of the batch are reported together
+        self.assertEqual([(1, {'ObjectXX:uve1': {'type1': {},
+                                                 'type2': {'xx': 1}},
+                               'ObjectYY:uve2': {'type2': None},
+                               'ObjectZZ:uve3': {'type3': {}}})], notifs)
+        # with the offset of the first notification of every UVE
+        self.assertEqual([{'ObjectXX:uve1': 0, 'ObjectYY:uve2': 2,
+                           'ObjectZZ:uve3': 5}], notif_offsets[-1:])
+        self.assertEqual(6, usp.offset())
+        uvedb = usp.contents()[coll]['gen1']
+        self.assertEqual({'type1', 'type2'},
+            set(uvedb['ObjectXX']['uve1'].keys()))
+        self.assertEqual(2, uvedb['ObjectXX']['uve1']['type1']['c'])
+        self.assertEqual({}, uvedb['ObjectYY'])
+        self.assertEqual({'type1': 2, 'type2': 1},
+            usp.stats()['ObjectXX'][coll]['gen1'])
+
+        # A bad message stops the batch, after reporting the ones before it
+        del notifs[:]
+        self.assertFalse(usp.msg_handler([
+            msg(7, 'ObjectZZ:uve3', 'type3', ''),
+            msg(8, 'ObjectZZ:uve3', 'type3', '{bad')]))
+        self.assertEqual([(1, {'ObjectZZ:uve3': {'type3': None}})], notifs)
+    # end test_11_uve_stream_batch
+
+    @mock.patch('opserver.partition_handler.KafkaConsumer', autospec=True)
+    def test_12_partition_poll(self, mock_KafkaConsumer):
+        coll = socket.getfqdn("127.0.0.1") + ':0'
+        m_poll = Mock_poll()
+        mock_KafkaConsumer.return_value.poll.side_effect = m_poll
+        mock_KafkaConsumer.return_value.position.return_value = 10
+        mock_KafkaConsumer.return_value.highwater.return_value = 15
+        rsc = mock.Mock(return_value=(set(), set(), {}))
+        notifs = []
+        usp = UveStreamProc('', 1, '-uve-1', logging,
+            lambda part, uves, offsets=None: notifs.append(uves),
+            '127.0.0.1', rsc, '0', 0, False, None, poll_max_wait=100)
+        usp.start_partition({coll: {}})
+        usp.start()
+        gevent.sleep(0.5)
+        m_poll["ObjectXX:uve1"] = ConsumerRecord(topic='-uve-1',
+            partition=0, offset=12,
+            key='ObjectXX:uve1|type1|gen1|' + coll, value='{}')
+        gevent.sleep(0.3)
+        usp.kill()
+
+        # The message is handled by the blocking poll, without waiting
+        # for the next resource check
+        self.assertEqual({'ObjectXX:uve1': {'type1': {}}}, notifs[-1])
+        mock_KafkaConsumer.return_value.poll.assert_called_with(
+            timeout_ms=100)
+        self.assertEqual(1, rsc.call_count)
+        stats = usp.consume_stats()
+        self.assertEqual(1, stats['resource_checks'])
+        self.assertTrue(stats['empty_polls'] >= 3)
+        self.assertEqual(stats['polls'], stats['empty_polls'] + 1)
+        self.assertEqual(2, stats['lag'])
+        self.assertEqual(2, stats['max_lag'])
+        self.assertEqual([(0, 0), (10, 1), (100, 0), (1000, 0),
+            (10000, 0), (100000, 0), (None, 0)], stats['lag_histogram'])
+        self.assertEqual(1,
+            sum(count for le, count in stats['poll_latency_histogram']))
+    # end test_12_partition_poll
+
+    def test_13_uve_notifq_offsets(self):
+        worker = mock.Mock()
+        worker.offset.return_value = 20
+        self._ag._workers[1] = worker
+        try:
+            # Queued UVEs keep the offset of their first notification,
+            # to be replayed from the checkpoint
+            self._ag.handle_uve_notifq(1,
+                {'ObjectXX:uve1': {'type1': {}}, 'ObjectYY:uve2': None},
+                {'ObjectXX:uve1': 12})
+            self.assertEqual({'ObjectXX:uve1': 12, 'ObjectYY:uve2': 20},
+                             self._ag._uveq_offsets[1])
+            self._ag.handle_uve_notifq(1,
+                {'ObjectXX:uve1': {'type2': {}}}, {'ObjectXX:uve1': 15})
+            self.assertEqual(12,
+                self._ag._uveq_offsets[1]['ObjectXX:uve1'])
+        finally:
+            del self._ag._workers[1]
+            self._ag._uveq.pop(1, None)
+            self._ag._uveq_offsets.pop(1, None)
+    # end test_13_uve_notifq_offsets
+
 
 # end class TestAlarmGen
 
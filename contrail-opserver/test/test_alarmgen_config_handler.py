@@ -12,7 +12,7 @@ from collections import namedtuple
 
 from vnc_api.gen.resource_client import GlobalSystemConfig, Alarm
 from vnc_api.gen.resource_xsd import AlarmExpression, \
-    AlarmAndList, AlarmOrList, UveKeysType
+    AlarmAndList, AlarmOrList, UveKeysType, AlarmOperand2
 from pysandesh.sandesh_logger import SandeshLogger
 from opserver.plugins.alarm_base import AlarmBase
 from opserver.alarmgen_config_handler import AlarmGenConfigHandler
@@ -719,6 +719,63 @@ class TestAlarmGenConfigHandler(unittest.TestCase):
                     assert_not_called()
     # end test_handle_config_update
 
+    def test_compile_alarm_rules(self):
+        alarmgen_config_handler = AlarmGenConfigHandler(
+            sandesh=mock.MagicMock(), module_id='test',
+            instance_id='0', rabbitmq_cfg=None, cassandra_cfg=None,
+            alarm_plugins={},
+            alarm_config_change_callback=mock.MagicMock(),
+            host_ip=None)
+        alarm_config_db = alarmgen_config_handler.alarm_config_db()
+        alarm_dict = {
+            'name': 'alarm1',
+            'uve_keys': ['virtual-network', 'analytics-node'],
+            'alarm_severity': AlarmBase.ALARM_CRITICAL,
+            'alarm_rules': {
+                'or_list': [
+                    {
+                        'and_list': [
+                            {
+                                'operand1': 'UveVirtualNetworkConfig',
+                                'operation': '==',
+                                'operand2': AlarmOperand2(json_value='null')
+                            }
+                        ]
+                    }
+                ]
+            },
+            'kwargs': {
+                'parent_type': 'global-system-config',
+                'fq_name': ['global-syscfg-default', 'alarm1']
+            }
+        }
+        fq_name = 'default-global-system-config:alarm1'
+        alarm_config = self._get_config_object('alarm', alarm_dict)
+        alarmgen_config_handler._handle_config_update('alarm', fq_name,
+            'CREATE', alarm_config)
+        # The rules are compiled once when the config is loaded, for all
+        # the uve_keys of the alarm
+        vn_alarm = alarm_config_db['ObjectVNTable'][fq_name]
+        collector_alarm = alarm_config_db['ObjectCollectorInfo'][fq_name]
+        self.assertTrue(vn_alarm.rule_set() is not None)
+        self.assertTrue(vn_alarm.rule_set().alarm_cfg is alarm_config)
+        self.assertTrue(collector_alarm.rule_set() is vn_alarm.rule_set())
+
+        # The rules are compiled again when the config is updated
+        alarm_config = self._get_config_object('alarm', alarm_dict)
+        alarmgen_config_handler._handle_config_update('alarm', fq_name,
+            'UPDATE', alarm_config)
+        self.assertTrue(alarm_config_db['ObjectVNTable'][fq_name] is vn_alarm)
+        self.assertTrue(vn_alarm.rule_set().alarm_cfg is alarm_config)
+
+        # Rules that fail to compile are left to process_alarms
+        alarm_dict['alarm_rules']['or_list'][0]['and_list'][0]['operand2'] = \
+            None
+        alarmgen_config_handler._handle_config_update('alarm', fq_name,
+            'UPDATE', self._get_config_object('alarm', alarm_dict))
+        self.assertTrue(vn_alarm.rule_set() is None)
+    # end test_compile_alarm_rules
+
 
 # end class TestAlarmGenConfigHandler
 
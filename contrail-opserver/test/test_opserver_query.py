@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2017 Juniper Networks, Inc. All rights reserved.
+#
+
+#
+# OpServerQueryTest
+#
+# Unit Tests for the query handling of the Operational State Server
+#
+
+import gevent
+from gevent import monkey; monkey.patch_all()
+import gevent.queue
+import json
+import logging
+import time
+import unittest
+import mock
+
+import bottle
+from opserver import opserver
+from opserver.opserver import OpServer, QueryResultCache, \
+    QueryReplyListener, redis_query_wait, redis_query_chunk_iter, \
+    redis_query_chunk, redis_query_result_dict
+
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+class PubSubMock(object):
+    def __init__(self, messages):
+        self._messages = messages
+        self.patterns = []
+
+    def psubscribe(self, pattern):
+        self.patterns.append(pattern)
+
+    def listen(self):
+        while True:
+            yield self._messages.get()
+
+    def close(self):
+        pass
+
+
+class OpServerQueryTest(unittest.TestCase):
+
+    QID = 'b2e4f0a4-0ac2-4d1c-8dd1-3d2dbf0a5c4e'
+
+    def setUp(self):
+        self._progress = 0
+        self._status_reads = 0
+        self._messages = gevent.queue.Queue()
+        self._pubsub = PubSubMock(self._messages)
+        redish = mock.MagicMock()
+        redish.pubsub.return_value = self._pubsub
+        self._patches = [
+            mock.patch.object(opserver, 'redis_query_status',
+                              side_effect=self._query_status),
+            mock.patch.object(QueryReplyListener, '_redis',
+                              return_value=redish)]
+        for patch in self._patches:
+            patch.start()
+
+    def tearDown(self):
+        for listener in QueryReplyListener._listeners.itervalues():
+            listener._greenlet.kill()
+        QueryReplyListener._listeners.clear()
+        for patch in self._patches:
+            patch.stop()
+
+    def _query_status(self, host, port, redis_password, redis_ssl_params,
+                      qid):
+        self._status_reads += 1
+        return {'progress': self._progress, 'chunks': []}
+
+    def _set_progress(self, progress, publish):
+        self._progress = progress
+        if publish:
+            self._messages.put({'type': 'pmessage', 'pattern': 'REPLY:*',
+                                'channel': 'REPLY:' + self.QID,
+                                'data': '{"progress": %d}' % progress})
+
+    def _wait(self, timeout, poll_interval):
+        start = time.time()
+        resp = redis_query_wait('127.0.0.1', 6379, None, None, self.QID, 0,
+                                timeout, poll_interval)
+        return resp, time.time() - start
+
+    def test_query_wait_published(self):
+        logging.info("%%% Running test_query_wait_published %%%")
+
+        # The published update wakes up the waiter before the next poll
+        gevent.spawn_later(0.2, self._set_progress, 50, True)
+        resp, elapsed = self._wait(timeout=10, poll_interval=5)
+        self.assertEqual(50, resp['progress'])
+        self.assertTrue(elapsed < 2)
+        self.assertEqual(['REPLY:*'], self._pubsub.patterns)
+        listener = QueryReplyListener.get('127.0.0.1', 6379, None, None)
+        self.assertEqual({}, listener._waiters)
+
+    def test_query_wait_missed(self):
+        logging.info("%%% Running test_query_wait_missed %%%")
+
+        # An update that is not published is read by the next poll
+        gevent.spawn_later(0.2, self._set_progress, 50, False)
+        resp, elapsed = self._wait(timeout=10, poll_interval=1)
+        self.assertEqual(50, resp['progress'])
+        self.assertTrue(0.9 <= elapsed < 5)
+
+    def test_query_wait_timeout(self):
+        logging.info("%%% Running test_query_wait_timeout %%%")
+
+        # Updates of other queries do not change the status
+        self._messages.put({'type': 'pmessage', 'pattern': 'REPLY:*',
+                            'channel': 'REPLY:other', 'data': '{}'})
+        resp, elapsed = self._wait(timeout=0.5, poll_interval=0.2)
+        self.assertEqual(0, resp['progress'])
+        self.assertTrue(elapsed >= 0.5)
+        self.assertTrue(self._status_reads >= 3)
+
+# end class OpServerQueryTest
+
+
+class QueryResultCacheTest(unittest.TestCase):
+
+    QUERY = {'table': 'StatTable.FieldNames.fields',
+             'start_time': 'now-10m', 'end_time': 'now',
+             'select_fields': ['name']}
+
+    def setUp(self):
+        self._now = 1000.0
+        self._time_patch = mock.patch.object(opserver, 'time')
+        time_mock = self._time_patch.start()
+        time_mock.time.side_effect = lambda: self._now
+
+    def tearDown(self):
+        self._time_patch.stop()
+
+    def test_key(self):
+        logging.info("%%% Running test_key %%%")
+
+        cache = QueryResultCache(ttl=60, max_size=1000)
+        key = cache.key(self.QUERY)
+        self.assertEqual(key, cache.key(dict(reversed(self.QUERY.items()))))
+        # Relative times map to the same key within a ttl long bucket
+        self._now = 1019.0
+        self.assertEqual(key, cache.key(self.QUERY))
+        self._now = 1020.0
+        self.assertNotEqual(key, cache.key(self.QUERY))
+        # Absolute times do not depend on the time of the request
+        query = dict(self.QUERY, start_time=1000000, end_time=2000000)
+        key = cache.key(query)
+        self._now = 5000.0
+        self.assertEqual(key, cache.key(query))
+        self.assertNotEqual(key,
+            cache.key(dict(query, select_fields=['name', 'fields'])))
+
+    def test_ttl(self):
+        logging.info("%%% Running test_ttl %%%")
+
+        cache = QueryResultCache(ttl=60, max_size=1000)
+        cache.put('q1', ['{"value": []}'], 13)
+        self._now += 59
+        self.assertEqual(['{"value": []}'], cache.get('q1'))
+        self._now += 1
+        self.assertIsNone(cache.get('q1'))
+        self.assertEqual({'entries': 0, 'size': 0, 'hits': 1, 'misses': 1,
+                          'bypasses': 0}, cache.stats())
+
+    def test_max_size(self):
+        logging.info("%%% Running test_max_size %%%")
+
+        cache = QueryResultCache(ttl=60, max_size=10)
+        cache.put('q1', ['1111'], 4)
+        cache.put('q2', ['2222'], 4)
+        # q1 is used, so q2 is the least recently used entry
+        self.assertEqual(['1111'], cache.get('q1'))
+        cache.put('q3', ['3333'], 4)
+        self.assertIsNone(cache.get('q2'))
+        self.assertEqual(['1111'], cache.get('q1'))
+        self.assertEqual(8, cache.stats()['size'])
+        # Results larger than the cache are not cached
+        cache.put('q4', ['4' * 11], 11)
+        self.assertIsNone(cache.get('q4'))
+        self.assertEqual(['3333'], cache.get('q3'))
+        self.assertEqual({'entries': 2, 'size': 8, 'hits': 3, 'misses': 2,
+                          'bypasses': 0}, cache.stats())
+
+# end class QueryResultCacheTest
+
+
+class RedisMock(object):
+    def __init__(self):
+        self.db = {}
+        self.persisted = []
+        self.deleted = []
+
+    def rpush(self, key, *values):
+        self.db.setdefault(key, []).extend(values)
+
+    def lrange(self, key, start, end):
+        return self.db.get(key, [])[start:end + 1]
+
+    def persist(self, key):
+        self.persisted.append(key)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.deleted.append(key)
+            self.db.pop(key, None)
+
+
+class OpServerQueryResultTest(unittest.TestCase):
+
+    QID = 'b2e4f0a4-0ac2-4d1c-8dd1-3d2dbf0a5c4e'
+
+    def setUp(self):
+        self._redis = RedisMock()
+        self._redis.db['QUERY:' + self.QID] = ['query']
+        self._redis.db['RESULT:other:0'] = ['{"name": "other"}']
+        self._patches = [
+            mock.patch.object(opserver.redis_pools, 'client',
+                              return_value=self._redis),
+            mock.patch.object(opserver, 'redis_query_status',
+                return_value={'progress': 100, 'chunks': [
+                    {'href': '/analytics/query/%s/chunk-final/0' % \
+                        self.QID}]})]
+        for patch in self._patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self._patches:
+            patch.stop()
+
+    def _add_result(self, counts):
+        rows = []
+        for line, count in enumerate(counts):
+            lrows = [{'name': 'row-%d-%d' % (line, idx), 'value': idx} \
+                     for idx in range(count)]
+            self._redis.rpush('RESULT:%s:%d' % (self.QID, line),
+                              *[json.dumps(row) for row in lrows])
+            rows.extend(lrows)
+        return rows
+
+    def _result_keys(self, count):
+        return ['RESULT:%s:%d' % (self.QID, line) for line in range(count)]
+
+    def test_query_chunk_iter(self):
+        logging.info("%%% Running test_query_chunk_iter %%%")
+
+        # Result lines of exactly batch_size rows, of several batches,
+        # and of less than batch_size rows
+        rows = self._add_result([3, 7, 6, 2])
+        batches = list(redis_query_chunk_iter('127.0.0.1', 6379, None, None,
+                                              self.QID, 0, batch_size=3))
+        self.assertEqual([3, 3, 3, 1, 3, 3, 2, 0],
+                         [len(batch) for batch in batches])
+        self.assertEqual(rows, [json.loads(elem) for batch in batches \
+                                for elem in batch])
+        self.assertEqual(self._result_keys(5), self._redis.persisted)
+        # Only the result lines of the query are deleted
+        self.assertEqual(self._result_keys(4), self._redis.deleted)
+        self.assertEqual(['QUERY:' + self.QID, 'RESULT:other:0'],
+                         sorted(self._redis.db.keys()))
+
+    def test_query_chunk(self):
+        logging.info("%%% Running test_query_chunk %%%")
+
+        rows = self._add_result([1000, 2500, 1])
+        resp = ''.join(redis_query_chunk('127.0.0.1', 6379, None, None,
+                                         self.QID, 0))
+        self.assertEqual({'value': rows}, json.loads(resp))
+        self.assertEqual(self._result_keys(3), self._redis.deleted)
+
+        # A query without results
+        resp = ''.join(redis_query_chunk('127.0.0.1', 6379, None, None,
+                                         self.QID, 0))
+        self.assertEqual({'value': []}, json.loads(resp))
+        self.assertEqual(self._result_keys(3), self._redis.deleted)
+
+    def test_query_result_dict(self):
+        logging.info("%%% Running test_query_result_dict %%%")
+
+        rows = self._add_result([1000, 1001])
+        self.assertEqual((100, rows), redis_query_result_dict('127.0.0.1',
+            6379, None, None, self.QID))
+        self.assertEqual(self._result_keys(2), self._redis.deleted)
+        self.assertEqual(['QUERY:' + self.QID, 'RESULT:other:0'],
+                         sorted(self._redis.db.keys()))
+
+# end class OpServerQueryResultTest
+
+
+class RequestMock(object):
+    def __init__(self, query, headers=None):
+        self.json = query
+        self._headers = headers or {}
+
+    def get_header(self, name, default=None):
+        return self._headers.get(name, default)
+
+
+class OpServerQueryCacheTest(unittest.TestCase):
+
+    QUERY = {'table': 'StatTable.FieldNames.fields',
+             'start_time': 'now-10m', 'end_time': 'now',
+             'select_fields': ['name']}
+
+    def setUp(self):
+        self._op = OpServer.__new__(OpServer)
+        self._op._logger = mock.MagicMock()
+        self._op._sandesh = mock.MagicMock()
+        self._op._args = mock.MagicMock(host_ip='127.0.0.1',
+            redis_query_port=6379, redis_password=None)
+        self._op._VIRTUAL_TABLES = []
+        self._op._query_cache = QueryResultCache(ttl=60, max_size=1000)
+        self._op.check_perms_and_update_where_clause = mock.MagicMock()
+        self._op._sync_query = mock.MagicMock(
+            side_effect=lambda request, qid: iter(self._result))
+        self._result = ['{"value": [', '{"name": "a"}', ']}']
+        self._stats = mock.MagicMock()
+        self._patches = [
+            mock.patch.object(opserver, 'redis_query_start', return_value=0),
+            mock.patch.object(opserver, 'AnalyticsApiStatistics',
+                              return_value=self._stats),
+            mock.patch.object(bottle, 'response')]
+        for patch in self._patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self._patches:
+            patch.stop()
+
+    def _query(self, headers=None):
+        self._stats.reset_mock()
+        return list(self._op._query(RequestMock(dict(self.QUERY), headers)))
+
+    def _cache_status(self):
+        if not self._stats.collect.called:
+            return None
+        return self._stats.collect.call_args[0][2]
+
+    def test_query_cache(self):
+        logging.info("%%% Running test_query_cache %%%")
+
+        result = self._result
+        self.assertEqual(result, self._query())
+        self.assertEqual('miss', self._cache_status())
+        self._stats.collect.assert_called_with(0, len(''.join(result)),
+                                               'miss')
+        self._stats.sendwith.assert_called_with()
+        self.assertEqual(result, self._query())
+        self.assertEqual('hit', self._cache_status())
+        self.assertEqual(1, self._op._sync_query.call_count)
+        self.assertEqual(1, opserver.redis_query_start.call_count)
+
+        # no-store runs the query, without using the cache
+        self._result = ['{"value": [', '{"name": "b"}', ']}']
+        self.assertEqual(self._result,
+                         self._query({'Cache-Control': 'no-store'}))
+        self.assertEqual('bypass', self._cache_status())
+        self.assertEqual(result, self._query())
+
+        # no-cache runs the query, and refreshes the cache
+        self.assertEqual(self._result,
+                         self._query({'Cache-Control': 'no-cache'}))
+        self.assertEqual('bypass', self._cache_status())
+        self.assertEqual(self._result, self._query())
+        self.assertEqual('hit', self._cache_status())
+        self.assertEqual({'entries': 1, 'size': len(''.join(self._result)),
+                          'hits': 3, 'misses': 1, 'bypasses': 2},
+                         self._op._query_cache.stats())
+
+    def test_query_cache_not_cached(self):
+        logging.info("%%% Running test_query_cache_not_cached %%%")
+
+        # Errors, incomplete results and results larger than the cache
+        # are not cached
+        for result in [[bottle.HTTPError(500, 'Query failed')], [{}],
+                       ['{"value": [', '{"name": "' + 'a' * 1000 + '"}',
+                        ']}']]:
+            self._result = result
+            for idx in range(2):
+                self.assertEqual(result, self._query())
+                self.assertEqual('miss', self._cache_status())
+        self.assertEqual(6, self._op._sync_query.call_count)
+        self.assertEqual(0, self._op._query_cache.stats()['entries'])
+
+        # Asynchronous queries are not cached
+        self._result = ['{"value": []}']
+        for idx in range(2):
+            resp = self._query({'Expect': '202-accepted'})
+            self.assertEqual(202, resp[0].status_code)
+            self.assertIsNone(self._cache_status())
+        self.assertEqual(6, self._op._sync_query.call_count)
+        self.assertEqual({'entries': 0, 'size': 0, 'hits': 0, 'misses': 6,
+                          'bypasses': 0}, self._op._query_cache.stats())
+
+# end class OpServerQueryCacheTest
+
+
+if __name__ == '__main__':
+    unittest.main()
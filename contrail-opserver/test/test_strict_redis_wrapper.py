@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2017 Juniper Networks, Inc. All rights reserved.
+#
+
+#
+# StrictRedisWrapperTest
+#
+# Unit Tests for the shared pools of redis connections
+#
+
+import logging
+import unittest
+import mock
+import redis
+
+from opserver.strict_redis_wrapper import RedisPoolManager, \
+    RedisConnectionPool, PooledConnection, PooledSSLConnection
+
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+class RedisPoolManagerTest(unittest.TestCase):
+
+    SSL_PARAMS = {'ssl': True, 'ssl_keyfile': '/etc/redis/redis.key',
+                  'ssl_certfile': '/etc/redis/redis.crt',
+                  'ssl_ca_certs': '/etc/redis/ca.crt'}
+
+    def test_pool_key(self):
+        logging.info("%%% Running test_pool_key %%%")
+
+        pools = RedisPoolManager()
+        pool = pools.client('127.0.0.1', 6379).connection_pool
+        self.assertIs(pool, pools.client('127.0.0.1', '6379').connection_pool)
+        self.assertIs(PooledConnection, pool.connection_class)
+        self.assertIsNot(pool,
+            pools.client('127.0.0.1', 6379, db=1).connection_pool)
+        self.assertIsNot(pool,
+            pools.client('127.0.0.1', 6380).connection_pool)
+        self.assertIs(pool, pools.client('127.0.0.1', 6379,
+            ssl_params={'ssl': False}).connection_pool)
+        self.assertEqual(3, len(pools.stats()))
+
+    def test_pool_key_password(self):
+        logging.info("%%% Running test_pool_key_password %%%")
+
+        pools = RedisPoolManager()
+        pool = pools.client('127.0.0.1', 6379).connection_pool
+        pool1 = pools.client('127.0.0.1', 6379,
+                             password='secret1').connection_pool
+        pool2 = pools.client('127.0.0.1', 6379,
+                             password='secret2').connection_pool
+        self.assertEqual(3, len(set([pool, pool1, pool2])))
+        self.assertIs(pool1, pools.client('127.0.0.1', 6379,
+            password='secret1').connection_pool)
+        self.assertEqual('secret2', pool2.connection_kwargs['password'])
+        # The passwords are not reported with the stats
+        for stats in pools.stats():
+            self.assertEqual(5, len(stats))
+            self.assertNotIn('secret1', stats)
+            self.assertNotIn('secret2', stats)
+
+    def test_pool_key_ssl(self):
+        logging.info("%%% Running test_pool_key_ssl %%%")
+
+        pools = RedisPoolManager()
+        pool = pools.client('127.0.0.1', 6379).connection_pool
+        ssl_pool = pools.client('127.0.0.1', 6379,
+                                ssl_params=self.SSL_PARAMS).connection_pool
+        self.assertIsNot(pool, ssl_pool)
+        self.assertIs(PooledSSLConnection, ssl_pool.connection_class)
+        self.assertNotIn('ssl', ssl_pool.connection_kwargs)
+        self.assertEqual('/etc/redis/ca.crt',
+                         ssl_pool.connection_kwargs['ssl_ca_certs'])
+        self.assertIs(ssl_pool, pools.client('127.0.0.1', 6379,
+            ssl_params=dict(self.SSL_PARAMS)).connection_pool)
+        # Callers with other certificates get a pool of their own
+        other_pool = pools.client('127.0.0.1', 6379,
+            ssl_params=dict(self.SSL_PARAMS,
+                            ssl_certfile='/etc/redis/other.crt')
+            ).connection_pool
+        self.assertIsNot(ssl_pool, other_pool)
+        self.assertEqual(set([('127.0.0.1', 6379, 0, False),
+                              ('127.0.0.1', 6379, 0, True)]),
+                         set(stats[:4] for stats in pools.stats()))
+
+# end class RedisPoolManagerTest
+
+
+class RedisConnectionPoolTest(unittest.TestCase):
+
+    def _pool(self, max_connections=2, port=6379):
+        return RedisConnectionPool(max_connections=max_connections,
+                                   timeout=0.1,
+                                   connection_class=PooledConnection,
+                                   host='127.0.0.1', port=port)
+
+    def _counters(self, pool):
+        stats = pool.stats()
+        return dict((k, stats[k]) for k in \
+                    ['created', 'in_use', 'waits', 'wait_timeouts'])
+
+    def test_counters(self):
+        logging.info("%%% Running test_counters %%%")
+
+        pool = self._pool()
+        conn1 = pool.get_connection('GET')
+        conn2 = pool.get_connection('GET')
+        self.assertEqual({'created': 2, 'in_use': 2, 'waits': 0,
+                          'wait_timeouts': 0}, self._counters(pool))
+        pool.release(conn1)
+        # Released connections are reused
+        conn1 = pool.get_connection('GET')
+        self.assertEqual({'created': 2, 'in_use': 2, 'waits': 0,
+                          'wait_timeouts': 0}, self._counters(pool))
+        pool.release(conn1)
+        pool.release(conn2)
+        # A connection released twice is only counted once
+        pool.release(conn2)
+        self.assertEqual({'created': 2, 'in_use': 0, 'waits': 0,
+                          'wait_timeouts': 0}, self._counters(pool))
+
+    def test_wait_timeout(self):
+        logging.info("%%% Running test_wait_timeout %%%")
+
+        pool = self._pool(max_connections=1)
+        conn = pool.get_connection('GET')
+        self.assertRaises(redis.exceptions.ConnectionError,
+                          pool.get_connection, 'GET')
+        self.assertEqual({'created': 1, 'in_use': 1, 'waits': 1,
+                          'wait_timeouts': 1}, self._counters(pool))
+        pool.release(conn)
+        pool.release(pool.get_connection('GET'))
+        self.assertEqual({'created': 1, 'in_use': 0, 'waits': 1,
+                          'wait_timeouts': 1}, self._counters(pool))
+
+    def _get_connection_and_connect(self, pool, command_name, *keys,
+                                    **options):
+        # Newer versions of redis-py connect to redis when the connection
+        # is taken from the pool, and release it when that fails
+        connection = pool.pool.get(block=True, timeout=pool.timeout)
+        if connection is None:
+            connection = pool.make_connection()
+        try:
+            connection.connect()
+        except redis.exceptions.ConnectionError:
+            pool.release(connection)
+            raise
+        return connection
+
+    def test_connect_failure(self):
+        logging.info("%%% Running test_connect_failure %%%")
+
+        # Nothing listens on port 1
+        pool = self._pool(max_connections=1, port=1)
+        with mock.patch.object(redis.BlockingConnectionPool,
+                               'get_connection', autospec=True,
+                               side_effect=self._get_connection_and_connect):
+            for idx in range(2):
+                self.assertRaises(redis.exceptions.ConnectionError,
+                                  pool.get_connection, 'GET')
+        self.assertEqual({'created': 1, 'in_use': 0, 'waits': 0,
+                          'wait_timeouts': 0}, self._counters(pool))
+        stats = pool.stats()
+        self.assertEqual(2, stats['connect_failures'])
+        self.assertFalse(stats['healthy'])
+
+# end class RedisConnectionPoolTest
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,8 +17,10 @@ import copy
 import unittest
 import pdb
 import json
+import fnmatch
+from collections import OrderedDict
 
-from opserver.uveserver import UVEServer
+from opserver.uveserver import UVEServer, RedisInst, RedisInstKey
 from opserver.uveserver import ParallelAggregator
 from opserver.opserver_util import OpServerUtils
 
@@ -26,8 +28,80 @@ from opserver.opserver_util import OpServerUtils
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(message)s')
 
+class RedisPipelineMock(object):
+    def __init__(self, redis_mock):
+        self._redis = redis_mock
+        self._cmds = []
+
+    def __getattr__(self, name):
+        def queue(*args):
+            self._cmds.append((name, args))
+        return queue
+
+    def execute(self):
+        self._redis.executes += 1
+        return [getattr(self._redis, name)(*args) for name, args in self._cmds]
+
+
 class RedisMock(object):
-    pass
+    def __init__(self):
+        self.db = {}
+        self.executes = 0
+        self.scans = 0
+        self.sscans = 0
+        self.smembers_calls = 0
+
+    def pipeline(self):
+        return RedisPipelineMock(self)
+
+    def sadd(self, key, member):
+        self.db.setdefault(key, set()).add(member)
+
+    def smembers(self, key):
+        self.smembers_calls += 1
+        return set(self.db.get(key, set()))
+
+    def sscan_iter(self, key, match=None, count=None):
+        self.sscans += 1
+        return iter([member for member in self.db.get(key, set()) \
+                     if match is None or fnmatch.fnmatchcase(member, match)])
+
+    def scan_iter(self, match=None, count=None):
+        self.scans += 1
+        return iter([key for key in self.db \
+                     if match is None or fnmatch.fnmatchcase(key, match)])
+
+    def exists(self, key):
+        return key in self.db
+
+    def hset(self, key, field, value):
+        self.db.setdefault(key, {})[field] = value
+
+    def hgetall(self, key):
+        return dict(self.db.get(key, {}))
+
+    def hget(self, key, field):
+        return self.db.get(key, {}).get(field)
+
+    def hmget(self, key, *fields):
+        return [self.hget(key, field) for field in fields]
+
+    def add_uve(self, table, key, origin, attrs):
+        typ = origin.rsplit(':', 1)[1]
+        if typ == 'UVEAlarms':
+            self.sadd('ALARM_TABLE:' + table, table + ':' + key + ':' + origin)
+            self.sadd('ALARM_ORIGINS:' + table + ':' + key, origin)
+            self.sadd('ALARM_TABLES', table)
+        else:
+            self.sadd('TABLE:' + table, table + ':' + key + ':' + origin)
+            self.sadd('ORIGINS:' + table + ':' + key, origin)
+            self.sadd('TABLES', table)
+        for attr, aval in attrs.iteritems():
+            anno = 'type="%s"' % aval[0]
+            if len(aval) > 2:
+                anno += ' aggtype="%s"' % aval[2]
+            self.hset('VALUES:' + table + ':' + key + ':' + origin, attr,
+                '<%s %s>%s</%s>' % (attr, anno, aval[1], attr))
 
 
 def MakeBasic(typ, val, aggtype=None):
@@ -426,6 +500,298 @@ class UVEServerTest(unittest.TestCase):
             "UVEVirtualNetwork"]["in_stats"]["sample"]
         self.assertEqual(in_stats, res['UVEVirtualNetwork']['in_stats'])
 
+    def _add_redis(self, rmock, ip):
+        rinst = RedisInst()
+        rinst.redis_handle = rmock
+        rinst.collector_pid = ip + ':Analytics:contrail-collector:0'
+        self._oss._redis_uve_map[RedisInstKey(ip=ip, port=6379)] = rinst
+
+    def test_get_uves(self):
+        logging.info("%%% Running test_get_uves %%%")
+
+        self._oss = UVEServer([], logging, uve_batch_size=8)
+        redis1 = RedisMock()
+        redis2 = RedisMock()
+        self._add_redis(redis1, '10.10.10.10')
+        self._add_redis(redis2, '10.10.10.11')
+        keys = []
+        for idx in range(20):
+            key = 'vn-%02d' % idx
+            keys.append('ObjectVNTable:' + key)
+            redis1.add_uve('ObjectVNTable', key,
+                '10.10.10.10:Config:contrail-schema:0:UVEVirtualNetwork',
+                {'total_acl_rules' : ('i32', idx),
+                 'total_virtual_machines' : ('i32', 1, 'sum')})
+            redis2.add_uve('ObjectVNTable', key,
+                '10.10.10.11:Compute:contrail-vrouter-agent:0:' \
+                    'UVEVirtualNetwork',
+                {'total_virtual_machines' : ('i32', 2, 'sum')})
+        redis2.add_uve('ObjectVNTable', 'vn-03',
+            '10.10.10.11:Analytics:contrail-alarm-gen:0:UVEAlarms',
+            {'alarms' : ('string', 'alarm-03')})
+
+        for flat in [True, False]:
+            _, uves = self._oss.get_uves(keys, flat)
+            self.assertEqual(sorted(keys), sorted(uves.keys()))
+            for key in keys:
+                _, uve = self._oss.get_uve(key, flat)
+                self.assertEqual(uve, uves[key])
+
+        # All the keys are read with two pipelines per redis instance
+        redis1.executes = 0
+        _, uves = self._oss.get_uves(keys, True)
+        self.assertEqual(2, redis1.executes)
+        self.assertEqual(3, uves['ObjectVNTable:vn-05'][
+            'UVEVirtualNetwork']['total_virtual_machines'])
+
+        # filters are applied to every key in the batch
+        _, uves = self._oss.get_uves(keys, True,
+            {'sfilt' : '10.10.10.11', 'cfilt' : {'UVEAlarms' : []}})
+        self.assertEqual({'UVEAlarms' : {'alarms' : 'alarm-03'}},
+                         uves['ObjectVNTable:vn-03'])
+        self.assertEqual({}, uves['ObjectVNTable:vn-04'])
+
+        # cfilts overrides the cfilt for the given keys
+        _, uves = self._oss.get_uves(keys[3:5], True,
+            cfilts={'ObjectVNTable:vn-03' : {'UVEAlarms' : set()},
+                    'ObjectVNTable:vn-04' : None})
+        self.assertEqual({'UVEAlarms' : {'alarms' : 'alarm-03'}},
+                         uves['ObjectVNTable:vn-03'])
+        _, uve = self._oss.get_uve('ObjectVNTable:vn-04', True)
+        self.assertEqual(uve, uves['ObjectVNTable:vn-04'])
+
+        # multi_uve_get fetches the table in batches of uve_batch_size
+        redis1.executes = 0
+        res = list(self._oss.multi_uve_get('ObjectVNTable', True, {}))
+        self.assertEqual(20, len(res))
+        self.assertEqual(2 * 3, redis1.executes)
+        for elem in res:
+            _, uve = self._oss.get_uve('ObjectVNTable:' + elem['name'], True)
+            self.assertEqual(uve, elem['value'])
+
+    def test_attr_cache(self):
+        logging.info("%%% Running test_attr_cache %%%")
+
+        # Without the cache, the parsed attributes are used as they are
+        self._oss = UVEServer([], logging, attr_cache_max_size=0)
+        self.assertIsNone(self._oss.get_attr_cache_stats())
+        value = '<total_acl_rules type="i32">4</total_acl_rules>'
+        snhdict = self._oss._parse_uve_attr('ObjectVNTable:vn-00',
+            'contrail-schema:UVEVirtualNetwork', 'total_acl_rules', value)
+        self.assertIsInstance(snhdict['total_acl_rules'], OrderedDict)
+        self.assertEqual('4', snhdict['total_acl_rules']['#text'])
+
+        self._oss = UVEServer([], logging, attr_cache_max_size=256)
+        redis1 = RedisMock()
+        self._add_redis(redis1, '10.10.10.10')
+        origin = '10.10.10.10:Config:contrail-schema:0:UVEVirtualNetwork'
+        redis1.add_uve('ObjectVNTable', 'vn-00', origin,
+            {'total_acl_rules' : ('i32', 4)})
+
+        _, uve = self._oss.get_uve('ObjectVNTable:vn-00', False)
+        uve['UVEVirtualNetwork']['total_acl_rules'][0][0]['#text'] = '0'
+        _, uve = self._oss.get_uve('ObjectVNTable:vn-00', True)
+        self.assertEqual(4, uve['UVEVirtualNetwork']['total_acl_rules'])
+        stats = self._oss.get_attr_cache_stats()
+        self.assertEqual((1, 1, 1),
+            (stats['entries'], stats['hits'], stats['misses']))
+        entry_size = stats['size']
+
+        # A changed attribute value is parsed again
+        redis1.add_uve('ObjectVNTable', 'vn-00', origin,
+            {'total_acl_rules' : ('i32', 5)})
+        _, uve = self._oss.get_uve('ObjectVNTable:vn-00', True)
+        self.assertEqual(5, uve['UVEVirtualNetwork']['total_acl_rules'])
+        stats = self._oss.get_attr_cache_stats()
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual((1, entry_size), (stats['entries'], stats['size']))
+
+        # The cache is bounded by the bytes of the cached attributes
+        for idx in range(1, 10):
+            redis1.add_uve('ObjectVNTable', 'vn-%02d' % idx, origin,
+                {'total_acl_rules' : ('i32', idx)})
+            self._oss.get_uve('ObjectVNTable:vn-%02d' % idx, True)
+        stats = self._oss.get_attr_cache_stats()
+        self.assertEqual(256 // entry_size, stats['entries'])
+        self.assertEqual(stats['entries'] * entry_size, stats['size'])
+
+    def test_get_tables(self):
+        logging.info("%%% Running test_get_tables %%%")
+
+        self._oss = UVEServer([], logging, freq=300)
+        redis1 = RedisMock()
+        self._add_redis(redis1, '10.10.10.10')
+        origin = '10.10.10.10:Config:contrail-schema:0:UVEVirtualNetwork'
+        redis1.add_uve('ObjectVNTable', 'vn-00', origin,
+            {'total_acl_rules' : ('i32', 4)})
+        redis1.add_uve('ObjectVMTable', 'vm-00', origin,
+            {'total_acl_rules' : ('i32', 4)})
+        self.assertEqual(set(['ObjectVNTable', 'ObjectVMTable']),
+                         self._oss.get_tables())
+
+        # The tables are cached until the collector changes
+        redis1.sadd('TABLES', 'ObjectSITable')
+        self.assertEqual(set(['ObjectVNTable', 'ObjectVMTable']),
+                         self._oss.get_tables())
+        self._oss._redis_uve_map[RedisInstKey(ip='10.10.10.10',
+            port=6379)].collector_pid += '1'
+        self.assertEqual(
+            set(['ObjectVNTable', 'ObjectVMTable', 'ObjectSITable']),
+            self._oss.get_tables())
+        self.assertEqual(0, redis1.scans)
+
+        # Collectors that do not keep TABLES are scanned
+        redis2 = RedisMock()
+        redis2.sadd('TABLE:ObjectVRouter', 'vr-00:10.10.10.11:x:y:0:T')
+        self._add_redis(redis2, '10.10.10.11')
+        self.assertEqual(
+            set(['ObjectVNTable', 'ObjectVMTable', 'ObjectSITable',
+                 'ObjectVRouter']),
+            self._oss.get_tables())
+        self.assertEqual(1, redis2.scans)
+
+    def test_get_uve_list(self):
+        logging.info("%%% Running test_get_uve_list %%%")
+
+        self._oss = UVEServer([], logging, uve_batch_size=8)
+        redis1 = RedisMock()
+        self._add_redis(redis1, '10.10.10.10')
+        origin = '10.10.10.10:Config:contrail-schema:0:UVEVirtualNetwork'
+        for idx in range(20):
+            redis1.add_uve('ObjectVNTable', 'default:vn-%02d' % idx, origin,
+                {'total_acl_rules' : ('i32', idx)})
+        redis1.add_uve('ObjectVNTable', 'default:vn-10.1', origin,
+            {'total_virtual_machines' : ('i32', 1)})
+        redis1.add_uve('ObjectVNTable', 'default:vn-03',
+            '10.10.10.10:Analytics:contrail-alarm-gen:0:UVEAlarms',
+            {'alarms' : ('string', 'alarm-03')})
+
+        def uve_list(filters, parse_afilter=False):
+            redis1.sscans = redis1.smembers_calls = 0
+            return self._oss.get_uve_list('ObjectVNTable', filters,
+                                          parse_afilter)
+
+        # UVE keys without wildcards are looked up in their ORIGINS
+        self.assertEqual(set(['default:vn-03', 'default:vn-05']),
+            uve_list({'kfilt' : ['default:vn-03', 'default:vn-05',
+                                 'default:vn-99']}))
+        self.assertEqual(0, redis1.sscans)
+        self.assertEqual(['default:vn-03'], list(uve_list(
+            {'kfilt' : ['default:vn-03'],
+             'cfilt' : {'UVEAlarms' : set()}})))
+
+        # Other globs are matched by redis and then by the kfilt regex
+        self.assertEqual(set(['default:vn-%02d' % idx for idx in \
+                              range(10, 20)]),
+            uve_list({'kfilt' : ['default:vn-1.']}))
+        self.assertEqual(set(['default:vn-%02d' % idx for idx in \
+                              range(10, 20)] + ['default:vn-10.1']),
+            uve_list({'kfilt' : ['*:vn-1*']}))
+        self.assertEqual(2, redis1.sscans)
+        self.assertEqual(0, redis1.smembers_calls)
+        self.assertEqual(set(['default:vn-10.1']),
+            uve_list({'kfilt' : ['default:vn-10.1']}))
+        self.assertEqual(set(['default:vn-03']),
+            uve_list({'kfilt' : ['default:vn-0[3]']}))
+        self.assertEqual(2, redis1.smembers_calls)
+        self.assertEqual(21, len(uve_list({})))
+
+        # The attributes of the cfilt are read with pipelines
+        redis1.executes = 0
+        self.assertEqual(set(['default:vn-10.1']), uve_list(
+            {'cfilt' : {'UVEVirtualNetwork' : set(['total_virtual_machines',
+                                                   'vn_name'])}}, True))
+        self.assertEqual(3, redis1.executes)
+        self.assertEqual(21, len(uve_list(
+            {'cfilt' : {'UVEVirtualNetwork' : set(['total_acl_rules',
+                                                   'total_virtual_machines'])}},
+            True)))
+
+    def test_get_alarms(self):
+        logging.info("%%% Running test_get_alarms %%%")
+
+        self._oss = UVEServer([], logging, uve_batch_size=2)
+        redis1 = RedisMock()
+        self._add_redis(redis1, '10.10.10.10')
+        origin = '10.10.10.10:Config:contrail-schema:0:UVEVirtualNetwork'
+        alarm_origin = '10.10.10.10:Analytics:contrail-alarm-gen:0:UVEAlarms'
+        for idx in range(100):
+            redis1.add_uve('ObjectVNTable', 'vn-%02d' % idx, origin,
+                {'total_acl_rules' : ('i32', idx)})
+            redis1.add_uve('ObjectVMTable', 'vm-%02d' % idx, origin,
+                {'total_acl_rules' : ('i32', idx)})
+        for key in ['vn-03', 'vn-04', 'vn-05']:
+            redis1.add_uve('ObjectVNTable', key, alarm_origin,
+                {'alarms' : ('string', 'alarm-' + key)})
+        redis1.add_uve('ObjectCollectorInfo', 'a6s1', alarm_origin,
+            {'alarms' : ('string', 'alarm-a6s1')})
+
+        filters = {'cfilt' : {'UVEAlarms' : set()}}
+        self.assertEqual({
+            'ObjectVNTable' : dict((key, {'UVEAlarms' :
+                {'alarms' : 'alarm-' + key}}) \
+                for key in ['vn-03', 'vn-04', 'vn-05']),
+            'ObjectCollectorInfo' : {'a6s1' : {'UVEAlarms' :
+                {'alarms' : 'alarm-a6s1'}}}},
+            self._oss.get_alarms(filters))
+        # Only the alarm sets are read: ALARM_TABLES, the ALARM_TABLE
+        # of the two tables and the ALARM_ORIGINS of the four UVEs
+        self.assertEqual(7, redis1.smembers_calls)
+        self.assertEqual(0, redis1.scans)
+
+        self.assertEqual(['ObjectCollectorInfo'], self._oss.get_alarms(
+            dict(filters, tablefilt=['ObjectCollectorInfo',
+                                     'ObjectVMTable'])).keys())
+        self.assertEqual(['vn-04'], self._oss.get_alarms(
+            dict(filters, kfilt=['vn-04']))['ObjectVNTable'].keys())
+        self.assertEqual({}, self._oss.get_alarms(
+            dict(filters, sfilt='10.10.10.11')))
+
+        # Collectors that do not keep ALARM_TABLES are scanned
+        redis2 = RedisMock()
+        redis2.add_uve('ObjectBgpRouter', 'bgp-00', alarm_origin,
+            {'alarms' : ('string', 'alarm-bgp-00')})
+        del redis2.db['ALARM_TABLES']
+        self._add_redis(redis2, '10.10.10.11')
+        self.assertEqual(set(['ObjectVNTable', 'ObjectCollectorInfo',
+                              'ObjectBgpRouter']),
+                         set(self._oss.get_alarms(filters).keys()))
+        self.assertEqual(1, redis2.scans)
+
+    def test_attr_flatten(self):
+        logging.info("%%% Running test_attr_flatten %%%")
+
+        uvevn = MakeUVEVirtualNetwork(
+            None, "abc-corp:vn-00", "10.10.10.10",
+            attached_policies=[
+                ("100", "allow-some"), ("200", "deny-others")],
+            connected_networks=["vn-01", "vn-02"],
+            mstr={2:"xxx"},
+            ifstats={"name":"foo", "inbytes":4}
+        )
+        attrs = uvevn["abc-corp:vn-00"]['UVEVirtualNetwork']
+        self.assertEqual(
+            [{'vnp_num': 100, 'vnp_name': 'allow-some'},
+             {'vnp_num': 200, 'vnp_name': 'deny-others'}],
+            OpServerUtils.uve_attr_flatten(
+                attrs['attached_policies']["10.10.10.10"]))
+        self.assertEqual(["vn-01", "vn-02"], OpServerUtils.uve_attr_flatten(
+            attrs['connected_networks']["10.10.10.10"]))
+        self.assertEqual({2: "xxx"}, OpServerUtils.uve_attr_flatten(
+            attrs['mstr']["10.10.10.10"]))
+        self.assertEqual({"name": "foo", "inbytes": 4},
+            OpServerUtils.uve_attr_flatten(attrs['ifstats']["10.10.10.10"]))
+
+        # Attributes nested deeper than the recursion limit
+        depth = sys.getrecursionlimit() * 2
+        attr = MakeBasic("u64", 1)
+        for idx in range(depth):
+            attr = {'@type': 'struct', 'Nested': {'child': attr}}
+        flat = OpServerUtils.uve_attr_flatten(attr)
+        for idx in range(depth):
+            flat = flat["child"]
+        self.assertEqual(1, flat)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2017 Juniper Networks, Inc. All rights reserved.
+#
+
+#
+# VncCfgApiClientTest
+#
+# Unit Tests for the caching of the answers of the config API server
+#
+
+import logging
+import unittest
+import mock
+
+from cfgm_common.exceptions import PermissionDenied
+from opserver.vnc_cfg_api_client import VncCfgApiClient, VncCfgApiCache
+
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+class VncCfgApiCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._now = 1000.0
+        self._time_patch = mock.patch('opserver.vnc_cfg_api_client.time')
+        time_mock = self._time_patch.start()
+        time_mock.time.side_effect = lambda: self._now
+
+    def tearDown(self):
+        self._time_patch.stop()
+
+    def test_ttl(self):
+        logging.info("%%% Running test_ttl %%%")
+
+        cache = VncCfgApiCache(ttl=30, size=10)
+        self.assertEqual((False, None), cache.get(('token1', 'vn1')))
+        cache.put(('token1', 'vn1'), {'permissions': 'R'})
+        self._now += 29
+        self.assertEqual((True, {'permissions': 'R'}),
+                         cache.get(('token1', 'vn1')))
+        self._now += 1
+        self.assertEqual((False, None), cache.get(('token1', 'vn1')))
+        self.assertEqual({'size': 0, 'hits': 1, 'misses': 2}, cache.stats())
+
+    def test_lru(self):
+        logging.info("%%% Running test_lru %%%")
+
+        cache = VncCfgApiCache(ttl=30, size=2)
+        cache.put(('token1', 'vn1'), 1)
+        cache.put(('token1', 'vn2'), 2)
+        # vn1 is used, so vn2 is the least recently used entry
+        self.assertEqual((True, 1), cache.get(('token1', 'vn1')))
+        cache.put(('token1', 'vn3'), 3)
+        self.assertEqual((False, None), cache.get(('token1', 'vn2')))
+        self.assertEqual((True, 1), cache.get(('token1', 'vn1')))
+        self.assertEqual((True, 3), cache.get(('token1', 'vn3')))
+
+    def test_invalidate(self):
+        logging.info("%%% Running test_invalidate %%%")
+
+        cache = VncCfgApiCache(ttl=30, size=10)
+        cache.put(('token1', 'vn1'), 1)
+        cache.put(('token1', 'vn2'), 2)
+        cache.put(('token2', 'vn1'), 3)
+        cache.invalidate('token1')
+        self.assertEqual((False, None), cache.get(('token1', 'vn1')))
+        self.assertEqual((False, None), cache.get(('token1', 'vn2')))
+        self.assertEqual((True, 3), cache.get(('token2', 'vn1')))
+        cache.invalidate()
+        self.assertEqual((False, None), cache.get(('token2', 'vn1')))
+
+# end class VncCfgApiCacheTest
+
+
+class VncCfgApiClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self._client = self._create_client(rbac_cache_ttl=30)
+        self._vnc = self._client._vnc_api_client
+
+    def _create_client(self, rbac_cache_ttl):
+        conf_info = {
+            'api_servers': ['127.0.0.1:8082'],
+            'cloud_admin_role': 'admin',
+            'rbac_cache_ttl': rbac_cache_ttl,
+            'rbac_cache_size': 100
+        }
+        client = VncCfgApiClient(conf_info, mock.MagicMock(),
+                                 mock.MagicMock())
+        client._vnc_api_client = mock.MagicMock()
+        client._vnc_api_client._headers = {}
+        client._vnc_api_client.fq_name_to_id.return_value = 'vn1-uuid'
+        return client
+
+    def _token_info(self, roles):
+        if roles is None:
+            return {'token_info': {'user': 'user1'}}
+        return {'token_info': {'token': {'roles': [{'name': role} \
+                for role in roles]}}}
+
+    def test_cache_disabled(self):
+        logging.info("%%% Running test_cache_disabled %%%")
+
+        client = self._create_client(rbac_cache_ttl=0)
+        self.assertEqual({}, client.cache_stats())
+        for idx in range(2):
+            self.assertEqual({'permissions': 'R'},
+                client.get_obj_perms_by_name('domain:project:vn1',
+                    'virtual_network', 'token1'))
+        self.assertEqual(2,
+            client._vnc_api_client.virtual_network_read.call_count)
+
+    def test_obj_perms(self):
+        logging.info("%%% Running test_obj_perms %%%")
+
+        for idx in range(2):
+            self.assertEqual({'permissions': 'R'},
+                self._client.get_obj_perms_by_name('domain:project:vn1',
+                    'virtual_network', 'token1'))
+        self._vnc.virtual_network_read.assert_called_once_with(
+            id='vn1-uuid')
+        self.assertEqual({}, self._vnc._headers)
+
+        # The answers are cached per token
+        self._client.get_obj_perms_by_name('domain:project:vn1',
+            'virtual_network', 'token2')
+        self.assertEqual(2, self._vnc.virtual_network_read.call_count)
+        self._client.invalidate_cache('token1')
+        self._client.get_obj_perms_by_name('domain:project:vn1',
+            'virtual_network', 'token1')
+        self.assertEqual(3, self._vnc.virtual_network_read.call_count)
+
+    def test_obj_perms_denied(self):
+        logging.info("%%% Running test_obj_perms_denied %%%")
+
+        # A denial by the API server is cached
+        self._vnc.virtual_network_read.side_effect = PermissionDenied(
+            'Permission Denied')
+        for idx in range(2):
+            self.assertIsNone(self._client.get_obj_perms_by_name(
+                'domain:project:vn1', 'virtual_network', 'token1'))
+        self.assertEqual(1, self._vnc.virtual_network_read.call_count)
+        self.assertEqual({}, self._vnc._headers)
+
+    def test_obj_perms_failure(self):
+        logging.info("%%% Running test_obj_perms_failure %%%")
+
+        # Failures to get an answer from the API server are not cached
+        self._vnc.fq_name_to_id.side_effect = Exception('Connection refused')
+        for idx in range(2):
+            self.assertIsNone(self._client.get_obj_perms_by_name(
+                'domain:project:vn1', 'virtual_network', 'token1'))
+        self.assertEqual(2, self._vnc.fq_name_to_id.call_count)
+
+        self._vnc.fq_name_to_id.side_effect = None
+        self._vnc.virtual_network_read.side_effect = Exception(
+            'Connection refused')
+        for idx in range(2):
+            self.assertIsNone(self._client.get_obj_perms_by_name(
+                'domain:project:vn1', 'virtual_network', 'token1'))
+        self.assertEqual(2, self._vnc.virtual_network_read.call_count)
+        self.assertEqual({}, self._vnc._headers)
+
+        self._client._vnc_api_client = None
+        self.assertIsNone(self._client.get_obj_perms_by_name(
+            'domain:project:vn1', 'virtual_network', 'token1'))
+        self.assertEqual(0, self._client.cache_stats()['obj_perms']['size'])
+
+        # The API server answers again
+        self._client._vnc_api_client = self._vnc
+        self._vnc.virtual_network_read.side_effect = None
+        self.assertEqual({'permissions': 'R'},
+            self._client.get_obj_perms_by_name('domain:project:vn1',
+                'virtual_network', 'token1'))
+
+    def test_token_info(self):
+        logging.info("%%% Running test_token_info %%%")
+
+        self._vnc.obj_perms.return_value = self._token_info(['admin'])
+        for idx in range(2):
+            self.assertTrue(self._client.is_role_cloud_admin('token1'))
+        self.assertEqual(1, self._vnc.obj_perms.call_count)
+        # The permissions on the UVEs without config are those of the
+        # cloud admin role
+        self.assertEqual({'permissions': 'RWX'},
+            self._client.get_obj_perms_by_name('vn1', 'null', 'token1'))
+        self.assertEqual(1, self._vnc.obj_perms.call_count)
+
+        self._vnc.obj_perms.return_value = self._token_info(['member'])
+        for idx in range(2):
+            self.assertFalse(self._client.is_role_cloud_admin('token2'))
+        self.assertEqual(2, self._vnc.obj_perms.call_count)
+
+        # Token infos without roles are not cached
+        self._vnc.obj_perms.return_value = self._token_info(None)
+        for idx in range(2):
+            self.assertFalse(self._client.is_role_cloud_admin('token3'))
+        self.assertEqual(4, self._vnc.obj_perms.call_count)
+        self._vnc.obj_perms.return_value = {'token_info': None}
+        for idx in range(2):
+            self.assertFalse(self._client.is_role_cloud_admin('token4'))
+        self.assertEqual(6, self._vnc.obj_perms.call_count)
+        self.assertEqual(2, self._client.cache_stats()['token_info']['size'])
+
+# end class VncCfgApiClientTest
+
+
+if __name__ == '__main__':
+    unittest.main()
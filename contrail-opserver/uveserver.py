@@ -10,12 +10,13 @@
 
 import gevent
 import json
-import copy
 import xmltodict
 import redis
 import datetime
 import sys
 import socket
+import hashlib
+import time
 from opserver_util import OpServerUtils
 import re
 from gevent.lock import BoundedSemaphore
@@ -25,7 +26,7 @@ from sandesh.viz.constants import UVE_MAP
 from pysandesh.gen_py.process_info.ttypes import ConnectionType,\
      ConnectionStatus
 import traceback
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from strict_redis_wrapper import StrictRedisWrapper
 from kazoo.client import KazooClient
 from kazoo.client import KazooState
@@ -39,11 +40,59 @@ class RedisInst(object):
         self.collector_pid = None
         self.deleted = False
 
+class UVEAttrCache(object):
+    '''
+    LRU cache of parsed UVE attribute values, keyed by
+    (key, origin, attribute). Every entry records the digest of the
+    sandesh XML it was parsed from; a lookup with a different digest
+    invalidates the entry, so updated attributes are re-parsed. The
+    JSON encoding of every entry is kept, up to max_size bytes over
+    all the entries; the attributes of deleted UVEs age out.
+    '''
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._size = 0
+        self._cache = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, ckey, digest):
+        entry = self._cache.pop(ckey, None)
+        if entry is None:
+            self._misses += 1
+            return None
+        if entry[0] != digest:
+            self._size -= len(entry[1])
+            self._misses += 1
+            return None
+        # move to the most recently used end
+        self._cache[ckey] = entry
+        self._hits += 1
+        return entry[1]
+
+    def put(self, ckey, digest, encoded):
+        if len(encoded) > self._max_size:
+            return
+        entry = self._cache.pop(ckey, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+        self._cache[ckey] = (digest, encoded)
+        self._size += len(encoded)
+        while self._size > self._max_size:
+            self._size -= len(self._cache.popitem(last=False)[1][1])
+
+    def stats(self):
+        return {'entries': len(self._cache), 'size': self._size,
+                'hits': self._hits, 'misses': self._misses}
+
+# end UVEAttrCache
+
 class UVEServer(object):
 
     def __init__(self, redis_uve_list, logger,
             redis_password=None, redis_ssl_params=None, \
-            uvedbcache=None, usecache=False, freq=5):
+            uvedbcache=None, usecache=False, freq=5, uve_batch_size=500,
+            attr_cache_max_size=16*1024*1024):
         self._logger = logger
         self._redis = None
         self._uvedbcache = uvedbcache
@@ -53,7 +102,13 @@ class UVEServer(object):
         self._redis_ssl_params = redis_ssl_params;
         self._uve_reverse_map = {}
         self._freq = freq
+        self._uve_batch_size = uve_batch_size
+        self._attr_cache = None
+        if attr_cache_max_size:
+            self._attr_cache = UVEAttrCache(attr_cache_max_size)
         self._active_collectors = []
+        # RedisInstKey -> (collector pid, expiry time, set of tables)
+        self._tables_cache = {}
 
         for h,m in UVE_MAP.iteritems():
             self._uve_reverse_map[m] = h
@@ -136,6 +191,7 @@ class UVEServer(object):
                         r_ip = rkey[0]
                         r_port = rkey[1]
                         del self._redis_uve_map[rkey]
+                        self._tables_cache.pop(rkey, None)
                         ConnectionState.delete(ConnectionType.REDIS_UVE,\
                             r_ip+":"+str(r_port))
                         continue
@@ -232,16 +288,74 @@ class UVEServer(object):
                                % (str(e), r_ip, r_port, traceback.format_exc()))
         return r_ip + ":" + str(r_port) , gen_uves
 
+    @staticmethod
+    def _read_tables(redish):
+        # The collector keeps the names of the tables in TABLES. Older
+        # collectors do not, so the TABLE:<table> keys are looked for
+        # with SCAN, which does not block redis like KEYS does
+        tables = redish.smembers("TABLES")
+        if tables:
+            return tables
+        return set(elem.split(":",1)[1] for elem in \
+                   redish.scan_iter(match="TABLE:*", count=1000))
+    # end _read_tables
+
+    @staticmethod
+    def _read_alarm_tables(redish):
+        # The collectors that keep TABLES also keep ALARM_TABLES, which
+        # may well be empty. The ALARM_TABLE:<table> keys of older
+        # collectors are looked for with SCAN
+        ppe = redish.pipeline()
+        ppe.smembers("ALARM_TABLES")
+        ppe.exists("TABLES")
+        tables, indexed = ppe.execute()
+        if tables or indexed:
+            return tables
+        return set(elem.split(":",1)[1] for elem in \
+                   redish.scan_iter(match="ALARM_TABLE:*", count=1000))
+    # end _read_alarm_tables
+
+    def get_alarm_tables(self):
+        '''
+        Returns the set of UVE tables that have alarms in any of the
+        redis instances
+        '''
+        tables = set()
+        for r_key, r_inst in self._redis_uve_map.iteritems():
+            if  r_inst.redis_handle is None or r_inst.collector_pid is None:
+                continue
+            try:
+                tables.update(self._read_alarm_tables(r_inst.redis_handle))
+            except Exception as e:
+                self._logger.error("get_alarm_tables failed %s for : (%s,%s) tb %s" \
+                               % (str(e), str(r_key), str(r_inst.collector_pid),\
+                                  traceback.format_exc()))
+        return tables
+    # end get_alarm_tables
+
     def get_tables(self):
+        '''
+        Returns the set of UVE tables in all the redis instances. The
+        tables of every redis instance are cached for freq seconds, or
+        until its collector changes
+        '''
         tables = set()
+        now = time.time()
         for r_key, r_inst in self._redis_uve_map.iteritems():
             if  r_inst.redis_handle is None or r_inst.collector_pid is None:
                 continue
             else:
                 redish = r_inst.redis_handle
+            cached = self._tables_cache.get(r_key)
+            if cached is not None and cached[0] == r_inst.collector_pid \
+                    and cached[1] > now:
+                tables.update(cached[2])
+                continue
             try:
-                tbs = [elem.split(":",1)[1] for elem in redish.keys("TABLE:*")]
-                tables.update(set(tbs))
+                tbs = self._read_tables(redish)
+                self._tables_cache[r_key] = (r_inst.collector_pid,
+                                             now + self._freq, tbs)
+                tables.update(tbs)
             except Exception as e:
                 self._logger.error("get_tables failed %s for : (%s,%s) tb %s" \
                                % (str(e), str(r_key), str(r_inst.collector_pid),\
@@ -249,6 +363,148 @@ class UVEServer(object):
 
         return tables
 
+    @staticmethod
+    def _is_alarm_filter(tfilter):
+        # UVEAlarms are only sent by alarmgen, as alarms, so only the
+        # ALARM_ sets need to be read if the cfilt has just UVEAlarms
+        if tfilter == "UVEAlarms":
+            return True
+        return isinstance(tfilter, dict) and tfilter.keys() == ["UVEAlarms"]
+    # end _is_alarm_filter
+
+    def _get_uve_origins(self, origsets, tfilter, sfilter, mfilter):
+        # Pick the ORIGINS/ALARM_ORIGINS members of a UVE that pass
+        # the cfilt, sfilt and mfilt filters
+        origins = []
+        for origset in origsets:
+            for smt in origset:
+                tt = smt.rsplit(":",1)[1]
+                sm = smt.rsplit(":",1)[0]
+                source = sm.split(":", 1)[0]
+                mdule = sm.split(":", 1)[1]
+                if tfilter is not None:
+                    if tt not in tfilter:
+                        continue
+                if sfilter is not None:
+                    if sfilter != source:
+                        continue
+                if mfilter is not None:
+                    if mfilter != mdule:
+                        continue
+                if smt not in origins:
+                    origins.append(smt)
+        return origins
+    # end _get_uve_origins
+
+    def _parse_uve_attr(self, key, origs, attr, value):
+        # Parse the sandesh XML of an attribute. Single element lists
+        # are normalized to python lists here, so that the cached form
+        # is ready for aggregation.
+        # With the cache, the result is decoded from its cached JSON
+        # encoding, which is much cheaper than xmltodict.parse and gives
+        # every caller its own copy to modify.
+        ckey = (key, origs, attr)
+        if self._attr_cache is not None:
+            digest = hashlib.md5(value).digest()
+            encoded = self._attr_cache.get(ckey, digest)
+            if encoded is not None:
+                return json.loads(encoded)
+        snhdict = xmltodict.parse(value)
+        if snhdict[attr]['@type'] == 'list':
+            sname = ParallelAggregator.get_list_name(snhdict[attr])
+            if snhdict[attr]['list']['@size'] == '1':
+                if not isinstance(snhdict[attr]['list'][sname], list):
+                    snhdict[attr]['list'][sname] = [
+                        snhdict[attr]['list'][sname]]
+        if self._attr_cache is None:
+            return snhdict
+        encoded = json.dumps(snhdict)
+        self._attr_cache.put(ckey, digest, encoded)
+        return json.loads(encoded)
+    # end _parse_uve_attr
+
+    def get_attr_cache_stats(self):
+        if self._attr_cache is None:
+            return None
+        return self._attr_cache.stats()
+    # end get_attr_cache_stats
+
+    def _fill_uve_state(self, state, key, origins, odictlist, flat,
+                        tfilter, ackfilter):
+        # Parse the VALUES:<key>:<origin> hashes read from one redis
+        # instance into state, which is keyed by key/type/attr/source
+        for origs, odict in zip(origins, odictlist):
+
+            info = origs.rsplit(":", 1)
+            dsource = info[0]
+            typ = info[1]
+
+            afilter_list = set()
+            if tfilter is not None:
+                afilter_list = tfilter[typ]
+
+            del_uvealarms = False
+            for attr, value in odict.iteritems():
+                if len(afilter_list):
+                    if attr not in afilter_list:
+                        continue
+
+                if value[0] == '<':
+                    try:
+                        snhdict = self._parse_uve_attr(key, origs, attr,
+                                                       value)
+                    except:
+                        self._logger.error("xml parsing failed key %s, struct %s: %s" \
+                            % (key, typ, str(value)))
+                        continue
+
+                    if snhdict[attr]['@type'] == 'list':
+                        sname = ParallelAggregator.get_list_name(
+                                snhdict[attr])
+                        if snhdict[attr]['list']['@size'] == '0':
+                            continue
+                        if typ == 'UVEAlarms' and attr == 'alarms' and \
+                                ackfilter is not None:
+                            alarms = []
+                            for alarm in snhdict[attr]['list'][sname]:
+                                ack_attr = alarm.get('ack')
+                                if ack_attr:
+                                    ack = ack_attr['#text']
+                                else:
+                                    ack = 'false'
+                                if ack == ackfilter:
+                                    alarms.append(alarm)
+                            if not len(alarms):
+                                del_uvealarms = True
+                                continue
+                            snhdict[attr]['list'][sname] = alarms
+                            snhdict[attr]['list']['@size'] = \
+                                str(len(alarms))
+                else:
+                    continue
+
+                # print "Attr %s Value %s" % (attr, snhdict)
+                if typ not in state[key]:
+                    state[key][typ] = {}
+                if attr not in state[key][typ]:
+                    state[key][typ][attr] = {}
+                if dsource in state[key][typ][attr]:
+                    self._logger.debug(\
+                    "Found Dup %s:%s:%s:%s = %s" % \
+                        (key, typ, attr, dsource, state[
+                        key][typ][attr][dsource]))
+                # To timestamp, we only keep latest source
+                if attr == '__T' and flat:
+                    if len(state[key][typ][attr]) > 0:
+                        if state[key][typ][attr].values()[0] > snhdict[attr]:
+                            continue
+                        else:
+                            state[key][typ][attr].clear()
+                state[key][typ][attr][dsource] = snhdict[attr]
+            if del_uvealarms and 'UVEAlarms' in state[key]:
+                del state[key]['UVEAlarms']
+    # end _fill_uve_state
+
     def get_uve(self, key, flat, filters=None, base_url=None):
 
         filters = filters or {}
@@ -259,131 +515,34 @@ class UVEServer(object):
         if flat and not sfilter and not mfilter and self._usecache:
             return self._uvedbcache.get_uve(key, filters)
 
-        is_alarm = False
-        if tfilter == "UVEAlarms":
-            is_alarm = True
+        is_alarm = self._is_alarm_filter(tfilter)
 
         state = {}
         state[key] = {}
         rsp = {}
         failures = False
 
-        tab = key.split(":",1)[0]
-
         for r_key, r_inst in self._redis_uve_map.iteritems():
             if r_inst.redis_handle is None or r_inst.collector_pid is None:
                 continue
             else:
                 redish = r_inst.redis_handle
             try:
-                qmap = {}
-
                 ppe = redish.pipeline()
                 ppe.smembers("ALARM_ORIGINS:" + key)
                 if not is_alarm:
                     ppe.smembers("ORIGINS:" + key)
                 pperes = ppe.execute()
-                origins = set()
-                for origset in pperes:
-                    for smt in origset:
-                        tt = smt.rsplit(":",1)[1]
-                        sm = smt.rsplit(":",1)[0]
-                        source = sm.split(":", 1)[0]
-                        mdule = sm.split(":", 1)[1]
-                        if tfilter is not None:
-                            if tt not in tfilter:
-                                continue
-                        if sfilter is not None:
-                            if sfilter != source:
-                                continue
-                        if mfilter is not None:
-                            if mfilter != mdule:
-                                continue
-                        origins.add(smt)
+                origins = self._get_uve_origins(pperes, tfilter,
+                                                sfilter, mfilter)
 
                 ppeval = redish.pipeline()
                 for origs in origins:
                     ppeval.hgetall("VALUES:" + key + ":" + origs)
                 odictlist = ppeval.execute()
 
-                idx = 0
-                for origs in origins:
-
-                    odict = odictlist[idx]
-                    idx = idx + 1
-
-                    info = origs.rsplit(":", 1)
-                    dsource = info[0]
-                    typ = info[1]
-
-                    afilter_list = set()
-                    if tfilter is not None:
-                        afilter_list = tfilter[typ]
-
-                    del_uvealarms = False
-                    for attr, value in odict.iteritems():
-                        if len(afilter_list):
-                            if attr not in afilter_list:
-                                continue
-
-                        if value[0] == '<':
-                            try:
-                                snhdict = xmltodict.parse(value)
-                            except:
-                                self._logger.error("xml parsing failed key %s, struct %s: %s" \
-                                    % (key, typ, str(value)))
-                                continue
-
-                            if snhdict[attr]['@type'] == 'list':
-                                sname = ParallelAggregator.get_list_name(
-                                        snhdict[attr])
-                                if snhdict[attr]['list']['@size'] == '0':
-                                    continue
-                                elif snhdict[attr]['list']['@size'] == '1':
-                                    if not isinstance(
-                                        snhdict[attr]['list'][sname], list):
-                                        snhdict[attr]['list'][sname] = [
-                                            snhdict[attr]['list'][sname]]
-                                if typ == 'UVEAlarms' and attr == 'alarms' and \
-                                        ackfilter is not None:
-                                    alarms = []
-                                    for alarm in snhdict[attr]['list'][sname]:
-                                        ack_attr = alarm.get('ack')
-                                        if ack_attr:
-                                            ack = ack_attr['#text']
-                                        else:
-                                            ack = 'false'
-                                        if ack == ackfilter:
-                                            alarms.append(alarm)
-                                    if not len(alarms):
-                                        del_uvealarms = True
-                                        continue
-                                    snhdict[attr]['list'][sname] = alarms
-                                    snhdict[attr]['list']['@size'] = \
-                                        str(len(alarms))
-                        else:
-                            continue
-
-                        # print "Attr %s Value %s" % (attr, snhdict)
-                        if typ not in state[key]:
-                            state[key][typ] = {}
-                        if attr not in state[key][typ]:
-                            state[key][typ][attr] = {}
-                        if dsource in state[key][typ][attr]:
-                            self._logger.debug(\
-                            "Found Dup %s:%s:%s:%s:%s = %s" % \
-                                (key, typ, attr, source, mdule, state[
-                                key][typ][attr][dsource]))
-                        # To timestamp, we only keep latest source
-                        if attr == '__T' and flat:
-                            if len(state[key][typ][attr]) > 0:
-                                if state[key][typ][attr].values()[0] > snhdict[attr]:
-                                    continue
-                                else:
-                                    state[key][typ][attr].clear()
-                        state[key][typ][attr][dsource] = snhdict[attr]
-                    if del_uvealarms and 'UVEAlarms' in state[key]:
-                        del state[key]['UVEAlarms']
+                self._fill_uve_state(state, key, origins, odictlist, flat,
+                                     tfilter, ackfilter)
 
                 pa = ParallelAggregator(state, self._uve_reverse_map)
                 rsp = pa.aggregate(key, flat, base_url)
@@ -398,6 +557,91 @@ class UVEServer(object):
         return failures, rsp
     # end get_uve
 
+    def get_uves(self, keys, flat, filters=None, base_url=None,
+                 cfilts=None):
+        '''
+        Batched version of get_uve. The ORIGINS and VALUES lookups of
+        all the given keys are done with two pipelines per redis
+        instance, and the UVEs are aggregated in a single pass.
+        cfilts is an optional dict of key to the cfilt of that key,
+        which overrides the cfilt in filters.
+        Returns the failure status and a dict of key to UVE value.
+        '''
+        filters = filters or {}
+        sfilter = filters.get('sfilt')
+        mfilter = filters.get('mfilt')
+        tfilter = filters.get('cfilt')
+        ackfilter = filters.get('ackfilt')
+        keys = list(keys)
+        tfilters = {}
+        for key in keys:
+            if cfilts is not None and key in cfilts:
+                tfilters[key] = cfilts[key]
+            else:
+                tfilters[key] = tfilter
+        if flat and not sfilter and not mfilter and self._usecache:
+            failures = False
+            rsp = {}
+            for key in keys:
+                kfilters = dict(filters)
+                kfilters['cfilt'] = tfilters[key]
+                kfail, rsp[key] = self._uvedbcache.get_uve(key, kfilters)
+                failures = failures or kfail
+            return failures, rsp
+
+        is_alarm = all(self._is_alarm_filter(tfilters[key]) for key in keys)
+        nsets = 1 if is_alarm else 2
+
+        state = {}
+        for key in keys:
+            state[key] = {}
+        failures = False
+
+        for r_key, r_inst in self._redis_uve_map.iteritems():
+            if r_inst.redis_handle is None or r_inst.collector_pid is None:
+                continue
+            else:
+                redish = r_inst.redis_handle
+            try:
+                ppe = redish.pipeline()
+                for key in keys:
+                    ppe.smembers("ALARM_ORIGINS:" + key)
+                    if not is_alarm:
+                        ppe.smembers("ORIGINS:" + key)
+                pperes = ppe.execute()
+
+                korigins = []
+                ppeval = redish.pipeline()
+                for kidx, key in enumerate(keys):
+                    origins = self._get_uve_origins(
+                        pperes[kidx * nsets:(kidx + 1) * nsets],
+                        tfilters[key], sfilter, mfilter)
+                    korigins.append(origins)
+                    for origs in origins:
+                        ppeval.hgetall("VALUES:" + key + ":" + origs)
+                odictlist = ppeval.execute()
+
+                idx = 0
+                for key, origins in zip(keys, korigins):
+                    self._fill_uve_state(state, key, origins,
+                        odictlist[idx:idx + len(origins)], flat,
+                        tfilters[key], ackfilter)
+                    idx += len(origins)
+            except Exception as e:
+                self._logger.error("redis-uve failed %s for %d keys: (%s,%s) tb %s" \
+                               % (str(e), len(keys), str(r_key),
+                                  str(r_inst.collector_pid),
+                                  traceback.format_exc()))
+                failures = True
+
+        pa = ParallelAggregator(state, self._uve_reverse_map)
+        rsp = {}
+        for key in keys:
+            rsp[key] = pa.aggregate(key, flat, base_url)
+        self._logger.debug("Computed %d UVEs" % len(rsp))
+        return failures, rsp
+    # end get_uves
+
     def get_uve_regex(self, key):
         regex = ''
         if key[0] != '*':
@@ -409,37 +653,52 @@ class UVEServer(object):
     # end get_uve_regex
 
     def get_alarms(self, filters):
+        '''
+        Returns table -> uve key -> UVE for the UVEs with alarms. Only
+        the tables in ALARM_TABLES and their ALARM_TABLE sets are read,
+        so this does not depend on the number of UVEs without alarms
+        '''
         tablesfilt = filters.get('tablefilt')
         kfilter = filters.get('kfilt')
+        sfilter = filters.get('sfilt')
+        mfilter = filters.get('mfilt')
         patterns = None
         if kfilter is not None:
             patterns = set()
             for filt in kfilter:
                 patterns.add(self.get_uve_regex(filt))
-        if self._usecache:
-            rsp = self._uvedbcache.get_uve_list(tables, filters, patterns, False)
+        if not sfilter and not mfilter and self._usecache:
+            rsp = self._uvedbcache.get_uve_list(tablesfilt, filters,
+                                                patterns, False)
         else:
-            tables = self.get_tables()
+            tables = self.get_alarm_tables()
+            if tablesfilt is not None:
+                tables = tables.intersection(tablesfilt)
             rsp = {}
             for table in tables:
                 uve_list = {}
-                if tablesfilt is not None:
-                    if table not in tablesfilt:
-                        continue
-                uve_keys = self.get_uve_list(table, filters, False)
-                for uve_key in uve_keys:
-                    _,uve_val = self.get_uve(
-                        table + ':' + uve_key, True, filters)
-                    if uve_val == {}:
-                        continue
-                    else:
-                        uve_list[uve_key] = uve_val
+                uve_keys = list(self.get_uve_list(table, filters, False))
+                for bidx in range(0, len(uve_keys), self._uve_batch_size):
+                    _, uves = self.get_uves([table + ':' + uve_key \
+                        for uve_key in \
+                        uve_keys[bidx:bidx + self._uve_batch_size]],
+                        True, filters)
+                    for key, uve_val in uves.iteritems():
+                        if uve_val == {}:
+                            continue
+                        uve_list[key.split(':', 1)[1]] = uve_val
                 if len(uve_list):
                     rsp[table] = uve_list
         return rsp
     # end get_alarms
 
-    def multi_uve_get(self, table, flat, filters=None, base_url=None):
+    def multi_uve_get(self, table, flat, filters=None, base_url=None,
+                      encoded=False):
+        '''
+        Yields {'name': uve name, 'value': UVE} for the UVEs of the table.
+        If encoded is set, the UVEs read from the UVE cache may be given
+        as JSON text in 'json' instead of 'value'
+        '''
         sfilter = filters.get('sfilt')
         mfilter = filters.get('mfilt')
         kfilter = filters.get('kfilt')
@@ -451,30 +710,96 @@ class UVEServer(object):
                 patterns.add(self.get_uve_regex(filt))
 
         if not sfilter and not mfilter and self._usecache:
-            rsp = self._uvedbcache.get_uve_list([table], filters, patterns, False)
+            rsp = self._uvedbcache.get_uve_list([table], filters, patterns,
+                                                False, encoded)
             if table in rsp:
-                for uve_name in rsp[table]:
-                    yield {'name': uve_name, 'value': rsp[table][uve_name]}
+                for uve_name, uve_val in rsp[table].iteritems():
+                    if isinstance(uve_val, basestring):
+                        yield {'name': uve_name, 'json': uve_val}
+                    else:
+                        yield {'name': uve_name, 'value': uve_val}
         else:
             # get_uve_list cannot handle attribute names very efficiently,
             # so we don't pass them here
-            uve_list = self.get_uve_list(table, filters, False)
-
-            for uve_name in uve_list:
-                _,uve_val = self.get_uve(
-                    table + ':' + uve_name, flat, filters,  base_url)
-                if uve_val == {}:
-                    continue
-                else:
-                    yield {'name': uve_name, 'value': uve_val}
+            uve_list = list(self.get_uve_list(table, filters, False))
+
+            # Fetch the UVEs in batches, so that each batch needs only
+            # a couple of pipelined round-trips per redis instance
+            for bidx in range(0, len(uve_list), self._uve_batch_size):
+                uve_names = uve_list[bidx:bidx + self._uve_batch_size]
+                _,uve_vals = self.get_uves(
+                    [table + ':' + uve_name for uve_name in uve_names],
+                    flat, filters, base_url)
+                for uve_name in uve_names:
+                    uve_val = uve_vals[table + ':' + uve_name]
+                    if uve_val == {}:
+                        continue
+                    else:
+                        yield {'name': uve_name, 'value': uve_val}
     # end multi_uve_get
 
+    @staticmethod
+    def _kfilt_scan_pattern(filt):
+        '''
+        Returns the redis glob pattern that matches at least the UVE keys
+        matched by the kfilt, or None if the kfilt cannot be expressed
+        as a redis glob. kfilts are matched as regexes with * turned
+        into .*?, so . matches any character like ? does in a glob
+        '''
+        if re.search(r'[\^$+?{}\[\]\\|()]', filt):
+            return None
+        return filt.replace('.', '?')
+    # end _kfilt_scan_pattern
+
+    def _get_table_entries(self, redish, table, is_alarm, kfilter):
+        '''
+        Returns the entries of the TABLE and ALARM_TABLE sets of the
+        table. If the kfilts can be matched by redis, only the entries
+        that may match them are read:
+        - the ORIGINS of the UVEs of kfilts without wildcards
+        - the entries matching the other kfilts, with SSCAN MATCH
+        The entries still need to be matched against the kfilts.
+        '''
+        # For UVE queries, we wanna read both UVE and Alarm table
+        prefixes = ['ALARM_']
+        if not is_alarm:
+            prefixes.append('')
+        globs = None
+        if kfilter is not None:
+            globs = [self._kfilt_scan_pattern(filt) for filt in kfilter]
+            if None in globs:
+                globs = None
+        entries = set()
+        if globs is None:
+            for prefix in prefixes:
+                entries.update(redish.smembers(prefix + 'TABLE:' + table))
+            return entries
+        keys = [glob for glob in globs if '*' not in glob and '?' not in glob]
+        if keys:
+            ppe = redish.pipeline()
+            for key in keys:
+                for prefix in prefixes:
+                    ppe.smembers(prefix + 'ORIGINS:' + table + ':' + key)
+            origins = ppe.execute()
+            for kidx, key in enumerate(keys):
+                for origs in origins[kidx * len(prefixes):
+                                     (kidx + 1) * len(prefixes)]:
+                    entries.update(table + ':' + key + ':' + orig \
+                                   for orig in origs)
+        for glob in globs:
+            if glob in keys:
+                continue
+            for prefix in prefixes:
+                entries.update(redish.sscan_iter(prefix + 'TABLE:' + table,
+                    match=table + ':' + glob + ':*', count=1000))
+        return entries
+    # end _get_table_entries
+
     def get_uve_list(self, table, filters=None, parse_afilter=False):
         is_alarm = False
         filters = filters or {}
         tfilter = filters.get('cfilt')
-        if tfilter == "UVEAlarms":
-            is_alarm = True
+        is_alarm = self._is_alarm_filter(tfilter)
         uve_list = set()
         kfilter = filters.get('kfilt')
         sfilter = filters.get('sfilt')
@@ -498,10 +823,11 @@ class UVEServer(object):
             else:
                 redish = r_inst.redis_handle
             try:
-                # For UVE queries, we wanna read both UVE and Alarm table
-                entries = redish.smembers('ALARM_TABLE:' + table)
-                if not is_alarm:
-                    entries = entries.union(redish.smembers('TABLE:' + table))
+                entries = self._get_table_entries(redish, table, is_alarm,
+                                                  kfilter)
+                # (uve key, VALUES key, attributes) of the UVEs that are
+                # listed only if they have one of the attributes
+                afilter_checks = []
                 for entry in entries:
                     info = (entry.split(':', 1)[1]).rsplit(':', 5)
                     uve_key = info[0]
@@ -529,14 +855,24 @@ class UVEServer(object):
                         if tfilter is not None and len(tfilter[typ]):
                             valkey = "VALUES:" + table + ":" + uve_key + \
                                 ":" + src + ":" + module + ":" + typ
-                            for afilter in tfilter[typ]:
-                                attrval = redish.hget(valkey, afilter)
-                                if attrval is not None:
-                                    break
-                            if attrval is None:
-                                continue
+                            afilter_checks.append((uve_key, valkey,
+                                                   list(tfilter[typ])))
+                            continue
                     uve_list.add(uve_key)
 
+                afilter_checks = [check for check in afilter_checks \
+                                  if check[0] not in uve_list]
+                for bidx in range(0, len(afilter_checks),
+                                  self._uve_batch_size):
+                    batch = afilter_checks[bidx:bidx + self._uve_batch_size]
+                    ppe = redish.pipeline()
+                    for uve_key, valkey, afilters in batch:
+                        ppe.hmget(valkey, *afilters)
+                    for (uve_key, _, _), attrvals in \
+                            zip(batch, ppe.execute()):
+                        if any(attrval is not None for attrval in attrvals):
+                            uve_list.add(uve_key)
+
             except Exception as e:
                 self._logger.error("get_uve_list failed %s for : (%s,%s) tb %s" \
                                % (str(e), str(r_key), str(r_inst.collector_pid),\
@@ -562,6 +898,12 @@ class UVEServer(object):
         return self._uvedbcache.get_uvedb_cache_uve(table, uve_key)
     # end get_uvedb_cache_uve
 
+    def get_uvedb_cache_memory(self):
+        if not self._usecache:
+            return None
+        return self._uvedbcache.get_uvedb_cache_memory()
+    # end get_uvedb_cache_memory
+
     def get_active_collectors(self):
         return self._active_collectors
     # endif get_active_collectors
@@ -576,18 +918,19 @@ class ParallelAggregator:
         self._rev_map = rev_map
 
     def _default_agg(self, oattr):
-        itemset = set()
+        # value -> [value, source1, source2, ...]
+        itemmap = {}
         result = []
         for source in oattr.keys():
             elem = oattr[source]
             hdelem = json.dumps(elem)
-            if hdelem not in itemset:
-                itemset.add(hdelem)
-                result.append([elem, source])
+            items = itemmap.get(hdelem)
+            if items is None:
+                items = [elem, source]
+                itemmap[hdelem] = items
+                result.append(items)
             else:
-                for items in result:
-                    if elem in items:
-                        items.append(source)
+                items.append(source)
         return result
 
     def _is_elem_sum(self, oattr):
@@ -663,7 +1006,8 @@ class ParallelAggregator:
 
     def _struct_sum_agg(self, oattr):
         akey = oattr.keys()[0]
-        result = copy.deepcopy(oattr[akey])
+        # The struct itself is replaced below, a shallow copy will do
+        result = dict(oattr[akey])
         sname = None
         for sattr in result.keys():
             if sattr[0] != '@':
@@ -690,7 +1034,7 @@ class ParallelAggregator:
 
     def _elem_sum_agg(self, oattr):
         akey = oattr.keys()[0]
-        result = copy.deepcopy(oattr[akey])
+        result = dict(oattr[akey])
         count = 0
         for source in oattr.keys():
             count += int(oattr[source]['#text'])
@@ -703,6 +1047,8 @@ class ParallelAggregator:
         for anno in oattr[akey].keys():
             if anno[0] == "@":
                 result[anno] = oattr[akey][anno]
+        # Strings are hashed as they are, other elements by their json
+        strset = set()
         itemset = set()
         sname = ParallelAggregator.get_list_name(oattr[akey])
         result['list'] = {}
@@ -713,6 +1059,12 @@ class ParallelAggregator:
             if isinstance(oattr[source]['list'][sname], basestring):
                 oattr[source]['list'][sname] = [oattr[source]['list'][sname]]
             for elem in oattr[source]['list'][sname]:
+                if isinstance(elem, basestring):
+                    if elem not in strset:
+                        strset.add(elem)
+                        result['list'][sname].append(elem)
+                        siz += 1
+                    continue
                 hdelem = json.dumps(elem)
                 if hdelem not in itemset:
                     itemset.add(hdelem)
@@ -744,7 +1096,6 @@ class ParallelAggregator:
         for source in oattr.keys():
             if sname is None:
                 for subidx in range(0,int(oattr[source]['map']['@size'])):
-                    print "map_union_agg Content %s" % (oattr[source]['map'])
                     result['map']['element'].append(source + ":" + \
                             json.dumps(oattr[source]['map']['element'][subidx*2]))
                     result['map']['element'].append(\
@@ -769,7 +1120,9 @@ class ParallelAggregator:
 
     def _append_agg(self, oattr):
         akey = oattr.keys()[0]
-        result = copy.deepcopy(oattr[akey])
+        # Only the list is replaced; the elements are not modified
+        result = dict(oattr[akey])
+        result['list'] = dict(oattr[akey]['list'])
         sname = ParallelAggregator.get_list_name(oattr[akey])
         result['list'][sname] = []
         siz = 0
@@ -806,31 +1159,32 @@ class ParallelAggregator:
         # If the list's underlying struct has a listkey present,
         # we need to further aggregate entries that have the
         # same listkey
-        mod_result = copy.deepcopy(result[typ][objattr])
+        mod_result = dict(result[typ][objattr])
+        mod_result['list'] = dict(mod_result['list'])
         mod_result['list'][applist] = []
-        res_size = 0
-        mod_result['list']['@size'] = int(res_size)
 
         # Add up stats
+        res_map = {}
         for items in result[typ][objattr]['list'][applist]:
-            matched = False
-            for res_items in mod_result['list'][applist]:
-                if items[appkey]['#text'] in [res_items[appkey]['#text']]:
-                    for ctrs in ParallelAggregator._list_agg_attrs(items):
-                        res_items[ctrs]['#text'] += int(items[ctrs]['#text'])
-                    matched = True
-            if not matched:
-                newitem = copy.deepcopy(items)
-                for ctrs in ParallelAggregator._list_agg_attrs(items):
+            ctrs_list = list(ParallelAggregator._list_agg_attrs(items))
+            res_items = res_map.get(items[appkey]['#text'])
+            if res_items is not None:
+                for ctrs in ctrs_list:
+                    res_items[ctrs]['#text'] += int(items[ctrs]['#text'])
+            else:
+                # Only the counters are modified, so only they are copied
+                newitem = dict(items)
+                for ctrs in ctrs_list:
+                    newitem[ctrs] = dict(items[ctrs])
                     newitem[ctrs]['#text'] = int(items[ctrs]['#text'])
+                res_map[items[appkey]['#text']] = newitem
                 mod_result['list'][applist].append(newitem)
-                res_size += 1
 
         # Convert results back into strings
         for res_items in mod_result['list'][applist]:
             for ctrs in ParallelAggregator._list_agg_attrs(res_items):
                 res_items[ctrs]['#text'] = str(res_items[ctrs]['#text'])
-        mod_result['list']['@size'] = str(res_size)
+        mod_result['list']['@size'] = str(len(mod_result['list'][applist]))
         return mod_result
 
     def aggregate(self, key, flat, base_url = None):
@@ -5,12 +5,60 @@
 import time
 import requests
 import bottle
+try:
+    from collections import OrderedDict
+except ImportError:
+    # python 2.6 or earlier, use backport
+    from ordereddict import OrderedDict
 from pysandesh.connection_info import ConnectionState
 from pysandesh.gen_py.process_info.ttypes import ConnectionType,\
     ConnectionStatus
 from vnc_api import vnc_api
+from cfgm_common.exceptions import PermissionDenied
 from functools import wraps
 
+class VncCfgApiCache(object):
+    '''
+    LRU cache of the answers of the config API server, with a TTL.
+    Every key is a tuple that starts with the user token, so that the
+    entries of a token can be invalidated together.
+    '''
+    def __init__(self, ttl, size):
+        self._ttl = ttl
+        self._size = size
+        self._cache = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, ckey):
+        entry = self._cache.pop(ckey, None)
+        if entry is None or entry[0] <= time.time():
+            self._misses += 1
+            return False, None
+        # move to the most recently used end
+        self._cache[ckey] = entry
+        self._hits += 1
+        return True, entry[1]
+
+    def put(self, ckey, value):
+        self._cache.pop(ckey, None)
+        self._cache[ckey] = (time.time() + self._ttl, value)
+        while len(self._cache) > self._size:
+            self._cache.popitem(last=False)
+
+    def invalidate(self, token=None):
+        if token is None:
+            self._cache.clear()
+            return
+        for ckey in [ck for ck in self._cache if ck[0] == token]:
+            del self._cache[ckey]
+
+    def stats(self):
+        return {'size': len(self._cache), 'hits': self._hits,
+                'misses': self._misses}
+
+# end class VncCfgApiCache
+
 class VncCfgApiClient(object):
 
     # Global config object to special fq-name prefix mappings
@@ -30,8 +78,43 @@ class VncCfgApiClient(object):
         self._sandesh_instance = sandesh_instance
         self._logger = logger
         self._vnc_api_client = None
+        # The token info, resource lists and object permissions given
+        # by the API server are cached per token
+        self._caches = {}
+        cache_ttl = conf_info.get('rbac_cache_ttl', 0)
+        if cache_ttl > 0:
+            for name in ('token_info', 'resource_list', 'obj_perms'):
+                self._caches[name] = VncCfgApiCache(cache_ttl,
+                    conf_info.get('rbac_cache_size', 10000))
     # end __init__
 
+    def _cache_get(self, name, ckey):
+        cache = self._caches.get(name)
+        if cache is None:
+            return False, None
+        return cache.get(ckey)
+    # end _cache_get
+
+    def _cache_put(self, name, ckey, value):
+        cache = self._caches.get(name)
+        if cache is not None:
+            cache.put(ckey, value)
+    # end _cache_put
+
+    def invalidate_cache(self, token=None):
+        """
+        Drops the cached answers for the given token, or for all the
+        tokens if no token is given
+        """
+        for cache in self._caches.itervalues():
+            cache.invalidate(token)
+    # end invalidate_cache
+
+    def cache_stats(self):
+        return dict((name, cache.stats()) for name, cache in \
+                    self._caches.iteritems())
+    # end cache_stats
+
     def _update_connection_state(self, status, message = ''):
         ConnectionState.update(conn_type=ConnectionType.APISERVER, 
             name='ApiServer', status=status, message=message,
@@ -62,6 +145,7 @@ class VncCfgApiClient(object):
     def update_api_servers(self, api_servers):
         self._conf_info['api_servers'] = api_servers
         self._vnc_api_client = None
+        self.invalidate_cache()
         self.connect()
     # end update_api_servers
 
@@ -94,13 +178,33 @@ class VncCfgApiClient(object):
     # end connect
 
     def get_obj_perms_by_name(self, name, cfg_type, token):
+        ckey = (token, cfg_type, name)
+        found, rv_obj_perms = self._cache_get('obj_perms', ckey)
+        if found:
+            return rv_obj_perms
+        rv_obj_perms, definite = self._get_obj_perms_by_name(name, cfg_type,
+                                                             token)
+        # Failures to reach the API server are not cached
+        if definite:
+            self._cache_put('obj_perms', ckey, rv_obj_perms)
+        return rv_obj_perms
+    # end get_obj_perms_by_name
+
+    def _get_obj_perms_by_name(self, name, cfg_type, token):
+        """
+        Returns the permissions of the token on the object, and whether
+        the API server gave a definite answer: the object was read, or
+        the read was denied
+        """
+        rv_obj_perms = None
+        definite = False
+        fq_name = None
         try:
-            rv_obj_perms = None
             uuid = None
             if cfg_type == 'null':
                 if self.is_role_cloud_admin(token):
                     rv_obj_perms = {'permissions':'RWX'}
-                return rv_obj_perms
+                return rv_obj_perms, True
             if cfg_type in self.config_obj_to_fq_name_prefix_map:
                 fq_name = self.config_obj_to_fq_name_prefix_map[\
                         cfg_type].split(":")
@@ -126,27 +230,40 @@ class VncCfgApiClient(object):
                 self._vnc_api_client._headers['X-USER-TOKEN'] = token
                 obj = getattr(self._vnc_api_client, obj_get_method) (id = uuid)
                 rv_obj_perms = {'permissions':'R'}
+                definite = True
+            except PermissionDenied as e:
+                self._logger.error("fq_name:%s cfg_type:%s uuid:%s Denied: %s", \
+                    (fq_name, cfg_type, uuid, str(e)) )
+                definite = True
             except Exception as e:
                 self._logger.error("fq_name:%s cfg_type:%s uuid:%s Exception: %s", \
                     (fq_name, cfg_type, uuid, str(e)) )
             finally:
-                if 'X-USER-TOKEN' in self._vnc_api_client._headers:
+                if self._vnc_api_client is not None and \
+                        'X-USER-TOKEN' in self._vnc_api_client._headers:
                     del self._vnc_api_client._headers['X-USER-TOKEN']
-        return rv_obj_perms
+        return rv_obj_perms, definite
     # end get_obj_perms_from_name
 
     def get_resource_list(self, obj_type, token):
+        ckey = (token, obj_type)
+        found, res_list = self._cache_get('resource_list', ckey)
+        if found:
+            return res_list
         try:
             res_list = self._get_resource_list(obj_type, token)
         except Exception as e:
             self._logger.error('VNC Config API Client NOT FOUND: %s' % str(e))
             return dict()
         else:
+            self._cache_put('resource_list', ckey, res_list)
             return res_list
     # end get_resource_list
 
     def is_role_cloud_admin(self, user_token, user_token_info=None):
-        result = self._get_user_token_info(user_token)
+        found, result = self._cache_get('token_info', (user_token,))
+        if not found:
+            result = self._get_user_token_info(user_token)
         if not result or not result['token_info']:
             self._logger.error(
                     'Token info for %s NOT FOUND' % str(user_token))
@@ -165,6 +282,9 @@ class VncCfgApiClient(object):
             self._logger.error('Role info for %s NOT FOUND: %s' % \
                     (str(user_token), str(token_info)))
             return False
+        # Only the token infos with roles are cached
+        if not found:
+            self._cache_put('token_info', (user_token,), result)
         return self._conf_info['cloud_admin_role'] in roles_list
     # end is_role_cloud_admin
 
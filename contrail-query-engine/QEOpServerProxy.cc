@@ -281,12 +281,10 @@ public:
 
                 // Update query status
                 RedisAsyncConnection * rac = conns_[res.inp.redis_host_idx][res.inp.cnum].get();
-                string rkey = "REPLY:" + res.inp.qp.qid;
                 char stat[40];
                 uint prg = 10 + (chunknum * 75)/inp.chunk_size.size();
                 sprintf(stat,"{\"progress\":%d}", prg);
-                RedisAsyncArgCommand(rac, NULL, 
-                    list_of(string("RPUSH"))(rkey)(stat));
+                QueryStatusUpdate(rac, res.inp.qp.qid, stat);
 
                return boost::bind(&QueryEngine::QueryExecWhere, qosp_->qe_,
                       _1, inp.qp, chunknum, 0);
@@ -385,12 +383,10 @@ public:
 
                 // Update query status
                 RedisAsyncConnection * rac = conns_[res.inp.redis_host_idx][res.inp.cnum].get();
-                string rkey = "REPLY:" + res.inp.qp.qid;
                 char stat[40];
                 uint prg = 10 + (chunknum * 75)/inp.chunk_size.size();
                 sprintf(stat,"{\"progress\":%d}", prg);
-                RedisAsyncArgCommand(rac, NULL, 
-                    list_of(string("RPUSH"))(rkey)(stat));         
+                QueryStatusUpdate(rac, res.inp.qp.qid, stat);
                 return boost::bind(&QueryEngine::QueryExecWhere, qosp_->qe_,
                         _1, inp.qp, chunknum, 0);
             } else {
@@ -502,6 +498,7 @@ public:
         Input inp;
         uint32_t redis_time;
         bool ret_code;
+        string status;
     };
     ExternalBase::Efn QueryResp(uint32_t inst, const vector<RedisT*> & exts,
             const Stage0Merge & inp, Output & ret) {
@@ -560,6 +557,7 @@ public:
                     uint64_t now = UTCTimestampUsec();
                     ret.redis_time = static_cast<uint32_t>((now - then)/1000);
                     QE_LOG_NOQID(DEBUG,  "QE Query Result is " << stat);
+                    ret.status = stat;
                     return boost::bind(&RedisAsyncArgCommand,
                             conns_[ret.inp.redis_host_idx][ret.inp.cnum].get(), _1,
                             list_of(string("RPUSH"))(key)(stat));   
@@ -568,6 +566,10 @@ public:
                     string key = "REPLY:" + ret.inp.qp.qid;
                     RedisAsyncArgCommand(rac, NULL,
                         list_of(string("EXPIRE"))(key)("300"));
+                    // The final status is in the REPLY list now; wake up
+                    // the clients waiting for it
+                    RedisAsyncArgCommand(rac, NULL,
+                        list_of(string("PUBLISH"))(key)(ret.status));
 
                     key = "QUERY:" + ret.inp.qp.qid;
                     RedisAsyncArgCommand(rac, NULL,
@@ -707,6 +709,17 @@ public:
         return minindex;
     }
 
+    // Append the status of a query to its REPLY list and publish it on
+    // the channel of the same name, for the clients waiting on the query
+    void QueryStatusUpdate(RedisAsyncConnection * rac, const string &qid,
+            const string &stat) {
+        string rkey = "REPLY:" + qid;
+        RedisAsyncArgCommand(rac, NULL,
+            list_of(string("RPUSH"))(rkey)(stat));
+        RedisAsyncArgCommand(rac, NULL,
+            list_of(string("PUBLISH"))(rkey)(stat));
+    }
+
     void QueryError(int redis_host_idx, string qid, int ret_code) {
         string redis_host = redis_host_port_pairs_[redis_host_idx].first;
         int redis_port = redis_host_port_pairs_[redis_host_idx].second;
@@ -751,6 +764,9 @@ public:
             key.c_str(), stat);
         
         freeReplyObject(reply);
+        reply = (redisReply *) redisCommand(c, "PUBLISH %s %s",
+            key.c_str(), stat);
+        freeReplyObject(reply);
         redisFree(c);
     }
 
@@ -940,11 +956,7 @@ public:
         
         // Update query status
         RedisAsyncConnection * rac = conns_[redis_host_idx][inp.get()->cnum].get();
-        string rkey = "REPLY:" + qid;
-        char stat[40];
-        sprintf(stat,"{\"progress\":15}");
-        RedisAsyncArgCommand(rac, NULL, 
-            list_of(string("RPUSH"))(rkey)(stat));
+        QueryStatusUpdate(rac, qid, "{\"progress\":15}");
 
 
     }